@@ -0,0 +1,30 @@
+'''Measures the wall time of starting the wal command line tool
+
+Usage: python benchmarks/startup.py [runs] [expression]
+'''
+import statistics
+import subprocess
+import sys
+import time
+
+
+def startup_time(expression):
+    '''Returns the wall time of evaluating expression with wal -c'''
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'wal', '-c', expression], check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    expression = sys.argv[2] if len(sys.argv) > 2 else '1'
+
+    # the first run fills the parser and std lib caches
+    cold = startup_time(expression)
+    times = [startup_time(expression) for _ in range(runs)]
+    print(f'wal -c {expression}: cold {cold * 1000:.0f} ms, '
+          f'warm min {min(times) * 1000:.0f} ms, median {statistics.median(times) * 1000:.0f} ms ({runs} runs)')
+
+
+if __name__ == '__main__':
+    main()
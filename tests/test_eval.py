@@ -1,14 +1,20 @@
 '''Test wal eval logic'''
+import sys
 import unittest
 import math
-from unittest.mock import patch
+import pickle
+from unittest.mock import Mock, patch
 from io import StringIO
 
 from wal.core import Wal
 from wal.reader import read_wal_sexpr
+from wal.passes import expand
 from wal.ast_defs import Symbol as S
 from wal.ast_defs import Operator
 from wal.ast_defs import WalEvalError
+from wal.ast_defs import Frame, UNDEFINED
+from wal import vectorize
+from wal.implementation import special
 
 
 class OpTest(unittest.TestCase):
@@ -530,3 +536,631 @@ class MultipleTracesTest(unittest.TestCase):
         self.w.eval_str('(define x 0)')
         self.w.eval_str('(whenever (!= a^INDEX b^INDEX) (inc x))')
         self.checkEqual('x', 0)
+
+
+class SignalBindingTest(unittest.TestCase):
+    '''Test that signals bound by compiled symbols are rebound when traces or aliases change'''
+
+    def setUp(self):
+        self.w = Wal()
+        self.w.load('tests/traces/counter.vcd', tid='a')
+        self.seval = self.w.eval_context
+        # the same symbol is evaluated again and again like in a loop
+        self.counter = read_wal_sexpr('tb.dut.counter')
+        self.c = read_wal_sexpr('c')
+
+    def test_step(self):
+        '''bound signals are read at the current index'''
+        for _ in range(10):
+            self.assertEqual(self.seval.eval(self.counter), self.w.traces.signal_value('tb.dut.counter'))
+            self.w.step()
+
+    def test_aliases(self):
+        '''symbols are rebound when aliases change'''
+        self.w.step(8)
+        self.w.eval_str('(define c 42)')
+        self.assertEqual(self.seval.eval(self.c), 42)
+        self.w.eval_str('(alias c "tb.dut.counter")')
+        self.assertEqual(self.seval.eval(self.c), self.seval.eval(self.counter))
+        self.w.eval_str('(unalias c)')
+        self.assertEqual(self.seval.eval(self.c), 42)
+
+    def test_traces(self):
+        '''symbols are rebound when traces are loaded, unloaded or resampled'''
+        self.w.step(8)
+        value = self.seval.eval(self.counter)
+        self.w.traces.unload('a')
+        with patch('sys.stdout', new=StringIO()):
+            with self.assertRaises(WalEvalError):
+                self.seval.eval(self.counter)
+
+        self.w.load('tests/traces/counter.vcd', tid='b', lazy=True)
+        self.assertEqual(self.seval.eval(self.counter), 0)
+        self.w.step(8)
+        self.assertEqual(self.seval.eval(self.counter), value)
+
+        self.w.eval_str("(sample-at '(0 70))")
+        self.w.step(1)
+        self.assertEqual(self.seval.eval(self.counter), self.w.traces.signal_value('tb.dut.counter'))
+
+
+class SharedReadTest(unittest.TestCase):
+    '''Test that signals and common subexpressions are only read once per step'''
+
+    def setUp(self):
+        self.w = Wal()
+        self.w.load('tests/traces/counter.vcd', tid='a')
+        self.trace = self.w.traces.traces['a']
+
+    def test_read_cache(self):
+        '''repeated reads at one index access the signal data once'''
+        self.w.step(5)
+        with patch.object(self.trace, 'access_signal_data', wraps=self.trace.access_signal_data) as access:
+            for _ in range(3):
+                self.assertEqual(self.trace.signal_value('tb.dut.counter', 1), self.trace.access_signal_data('tb.dut.counter', 6))
+            self.assertEqual(access.call_count, 4)
+
+            self.w.step()
+            self.trace.signal_value('tb.dut.counter', 1)
+            self.assertEqual(access.call_count, 5)
+
+    def test_shared(self):
+        '''common subexpressions are evaluated once and the results do not change'''
+        txt = '(count (|| (&& (= tb.clk 0) (= (reval tb.clk 1) 1)) (&& (= tb.clk 1) (= (reval tb.clk 1) 0))))'
+        with patch('wal.compiler.common_subexpressions', return_value=set()):
+            expected = Wal()
+            expected.load('tests/traces/counter.vcd')
+            expected = expected.eval_str(txt)
+
+        self.assertEqual(self.w.eval_str(txt), expected)
+        self.w.step(4)
+        dispatch = self.w.eval_context.dispatch
+        with patch.dict(dispatch, {'reval': Mock(wraps=dispatch['reval'])}):
+            # INDEX is not recorded in the trace and reval steps to read it
+            self.assertTrue(self.w.eval_str('(&& (!= (reval INDEX 1) 2) (= (reval INDEX 1) (reval INDEX 1)))'))
+            self.assertEqual(dispatch['reval'].call_count, 1)
+
+    def test_side_effects(self):
+        '''values read before a side effect are not reused after it'''
+        for txt in ["(if (= tb.clk 0) (do (step 1) (= tb.clk 0)) 'no)",
+                    '(&& (= tb.clk 0) (do (step 1) #t) (= tb.clk 0))',
+                    '(&& (= tb.clk 0) (= tb.clk 0) (do (step 1) #t) (= tb.clk 0))']:
+            with self.subTest(txt=txt):
+                self.w.eval_str('(step (- 0 INDEX))')
+                with patch('wal.compiler.common_subexpressions', return_value=set()):
+                    expected = self.w.eval_str(txt)
+                self.w.eval_str('(step (- 0 INDEX))')
+                self.assertEqual(self.w.eval_str(txt), expected)
+                self.assertFalse(expected)
+
+    def test_recursion(self):
+        '''recursive evaluations of an expression do not share values'''
+        self.w.eval_str('(defun f [n] (if (&& (> n 0) (= (reval tb.dut.counter n) (reval tb.dut.counter n))) (+ (reval tb.dut.counter n) (f (- n 1))) 0))')
+        self.w.step(5)
+        self.assertEqual(self.w.eval_str('(f 3)'), self.w.eval_str('(+ tb.dut.counter@1 tb.dut.counter@2 tb.dut.counter@3)'))
+
+
+class RelativeEvalTest(unittest.TestCase):
+    '''Test that reval reads signals at an offset without stepping the traces'''
+
+    EXPRESSIONS = [
+        '(reval tb.dut.counter 1)',
+        'tb.dut.counter@-2',
+        '(reval (+ tb.dut.counter (reval tb.dut.counter 2)) -1)',
+        '(reval (reval tb.dut.counter 1) -1)',
+        '(do (define n 3) tb.dut.counter@n)',
+        '(reval tb.dut.counter 1000)',
+        '(reval tb.dut.counter -1000)',
+        '(reval (list INDEX tb.dut.counter) 2)',
+        '(reval (+ INDEX tb.dut.counter@1) 2)',
+        '(count (|| (rising tb.clk) (falling tb.clk)))',
+        '(find (stable tb.dut.counter))',
+    ]
+
+    def eval_both(self, txt):
+        '''evaluates txt with and without reading at offsets'''
+        fast = Wal()
+        fast.load('tests/traces/counter.vcd')
+        fast.step(5)
+        slow = Wal()
+        slow.load('tests/traces/counter.vcd')
+        slow.step(5)
+        with patch('wal.compiler.relocatable', return_value=False):
+            expected = slow.eval_str(txt)
+        return fast.eval_str(txt), expected
+
+    def test_same_results(self):
+        '''results must not depend on how reval reads signals'''
+        for txt in RelativeEvalTest.EXPRESSIONS:
+            with self.subTest(txt=txt):
+                res, expected = self.eval_both(txt)
+                self.assertEqual(res, expected)
+
+    def test_no_stepping(self):
+        '''signal expressions are read at the offset'''
+        w = Wal()
+        w.load('tests/traces/counter.vcd')
+        w.step(5)
+        with patch.object(w.traces, 'step', wraps=w.traces.step) as step:
+            self.assertEqual(w.eval_str('(reval (+ tb.dut.counter tb.dut.counter@1) 1)'),
+                             w.traces.signal_value('tb.dut.counter', 1) + w.traces.signal_value('tb.dut.counter', 2))
+            self.assertEqual(step.call_count, 0)
+            # special signals are read at the current index of the traces
+            self.assertEqual(w.eval_str('(reval INDEX 2)'), 7)
+            self.assertEqual(step.call_count, 1)
+
+    def test_aliases(self):
+        '''expressions are analyzed again when aliases change'''
+        w = Wal()
+        w.load('tests/traces/counter.vcd')
+        w.step(5)
+        sexpr = read_wal_sexpr('x@1')
+        w.eval_str('(alias x "tb.dut.counter")')
+        self.assertEqual(w.eval_context.eval(sexpr), w.traces.signal_value('tb.dut.counter', 1))
+        w.eval_str('(unalias x)')
+        w.eval_str('(alias x "INDEX")')
+        self.assertEqual(w.eval_context.eval(sexpr), 6)
+
+
+class EdgeTest(unittest.TestCase):
+    '''Test the edge and change operators'''
+
+    EXPRESSIONS = [
+        ('(find (rising tb.clk))', '(find (&& (= tb.clk 0) (= (reval tb.clk 1) 1)))'),
+        ('(find (falling tb.overflow))', '(find (&& (= tb.overflow 1) (= (reval tb.overflow 1) 0)))'),
+        ('(find (changed? tb.dut.counter))', '(find (&& (> INDEX 0) (!= tb.dut.counter (reval tb.dut.counter -1))))'),
+        ('(find (&& (rising tb.clk) (> tb.dut.counter 3)))', '(find (&& (= tb.clk 0) (= tb.clk@1 1) (> tb.dut.counter 3)))'),
+        ('(find (|| (rising tb.overflow) (changed? tb.reset)))',
+         '(find (|| (&& (= tb.overflow 0) (= tb.overflow@1 1)) (&& (> INDEX 0) (!= tb.reset tb.reset@-1))))'),
+        ('(find (falling (+ tb.clk 0)))', '(find (&& (= tb.clk 1) (= (reval tb.clk 1) 0)))'),
+    ]
+
+    def setUp(self):
+        self.w = Wal()
+        self.w.load('tests/traces/counter.vcd')
+
+    def test_same_results(self):
+        '''edges are found with and without change points'''
+        for txt, expected in EdgeTest.EXPRESSIONS:
+            with self.subTest(txt=txt):
+                expected = self.w.eval_str(expected)
+                self.assertTrue(expected)
+                self.assertEqual(self.w.eval_str(txt), expected)
+                with patch('wal.vectorize.vector_ranges', return_value=None):
+                    self.assertEqual(self.w.eval_str(txt), expected)
+                with patch('wal.implementation.special.condition_ranges', return_value=None):
+                    self.assertEqual(self.w.eval_str(txt), expected)
+
+    def test_bounds(self):
+        '''like reval, edges compare with false outside of the trace'''
+        self.assertEqual(self.w.eval_str('(falling 1)'), False)
+        self.assertEqual(self.w.eval_str('(changed? INDEX)'), False)
+        self.w.step()
+        self.assertEqual(self.w.eval_str('(changed? INDEX)'), True)
+        self.w.eval_str('(step (- MAX-INDEX INDEX))')
+        self.assertEqual(self.w.eval_str('(falling 1)'), True)
+        self.assertEqual(self.w.eval_str('(rising 0)'), False)
+        self.assertEqual(self.w.eval_str('(changed? INDEX)'), True)
+
+    def test_last_index(self):
+        '''edges at the last index are found like by the rising and falling macros'''
+        self.w.eval_str("(trim-trace 'DEFAULT (last (find (= tb.clk 1))))")
+        for txt, expected in [('(find (falling tb.clk))', '(find (&& (= tb.clk 1) (= (reval tb.clk 1) 0)))'),
+                              ('(find (rising tb.clk))', '(find (&& (= tb.clk 0) (= (reval tb.clk 1) 1)))'),
+                              ('(count (falling tb.clk))', '(count (&& (= tb.clk 1) (= (reval tb.clk 1) 0)))')]:
+            with self.subTest(txt=txt):
+                expected = self.w.eval_str(expected)
+                self.assertEqual(self.w.eval_str(txt), expected)
+                with patch('wal.vectorize.vector_ranges', return_value=None):
+                    self.assertEqual(self.w.eval_str(txt), expected)
+                with patch('wal.implementation.special.condition_ranges', return_value=None):
+                    self.assertEqual(self.w.eval_str(txt), expected)
+
+        self.assertEqual(self.w.eval_str('(last (find (falling tb.clk)))'), self.w.eval_str('MAX-INDEX'))
+
+    def test_changes(self):
+        '''next-change and prev-change find the surrounding changes'''
+        changes = self.w.eval_str('(find (changed? tb.dut.counter))')
+        for index in [0, changes[0], changes[3] - 1, changes[-1], self.w.eval_str('MAX-INDEX')]:
+            self.w.eval_str(f'(step (- {index} INDEX))')
+            expected_next = next((change for change in changes if change > index), False)
+            expected_prev = next((change for change in reversed(changes) if change < index), False)
+            with self.subTest(index=index):
+                # signals are looked up in their change list, other expressions are evaluated
+                for expr in ['tb.dut.counter', '(+ tb.dut.counter 0)']:
+                    self.assertEqual(self.w.eval_str(f'(next-change {expr})'), expected_next)
+                    self.assertEqual(self.w.eval_str(f'(prev-change {expr})'), expected_prev)
+
+
+class SeekTest(unittest.TestCase):
+    '''Test find-first, find-next and find-prev'''
+
+    CONDITIONS = [
+        '(rising tb.clk)',
+        '(= tb.dut.counter 3)',
+        '(&& (rising tb.clk) (= tb.dut.counter 7))',
+        '(> tb.dut.counter 12)',
+        '(= tb.dut.counter 100)',
+        '(= INDEX 80)',
+        '(= INDEX 0)',
+    ]
+
+    def setUp(self):
+        self.w = Wal()
+        self.w.load('tests/traces/counter.vcd')
+
+    def check(self, condition, index):
+        '''compares the results at index with the indices found by find'''
+        found = self.w.eval_str(f'(find {condition})')
+        self.w.step(index)
+        expected = [next((i for i in found if i >= index), False),
+                    next((i for i in found if i > index), False),
+                    next((i for i in reversed(found) if i < index), False)]
+        res = [self.w.eval_str(f'({op} {condition})') for op in ['find-first', 'find-next', 'find-prev']]
+        self.assertEqual(res, expected)
+        self.assertEqual(self.w.eval_str('INDEX'), index)
+        self.w.step(-index)
+
+    def test_seek(self):
+        '''the searches find the same indices as find'''
+        for condition in SeekTest.CONDITIONS:
+            for index in [0, 20, 80]:
+                with self.subTest(condition=condition, index=index):
+                    self.check(condition, index)
+                    # small windows grow until the search is done
+                    with patch('wal.implementation.special.SEEK_WINDOW', 1):
+                        self.check(condition, index)
+                    with patch('wal.implementation.special.indexed_trace', return_value=None):
+                        self.check(condition, index)
+
+    def test_early_termination(self):
+        '''conditions are only evaluated close to the first match'''
+        self.w.eval_str('(define n 0)')
+        self.w.eval_str('(defun check [] (inc n) (= tb.clk 1))')
+        self.assertEqual(self.w.eval_str('(find-next (check))'), 1)
+        self.assertEqual(self.w.eval_str('n'), 1)
+
+        with patch('wal.implementation.special.true_ranges', wraps=special.true_ranges) as search:
+            self.assertEqual(self.w.eval_str('(find-next (rising tb.clk))'), 2)
+            (low, high), = search.call_args.args[3]
+            self.assertLess(high - low, self.w.eval_str('MAX-INDEX'))
+
+
+class ChangePointTest(unittest.TestCase):
+    '''Test that conditions evaluated at change points match stepping through the trace'''
+
+    EXPRESSIONS = [
+        '(find (rising tb.clk))',
+        '(find (= tb.dut.counter 3))',
+        '(find (&& tb.clk (= (reval tb.dut.counter -1) 2)))',
+        '(find (&& (> tb.dut.counter 2) (rising tb.clk) (! tb.reset)))',
+        '(find (reval tb.reset 3))',
+        '(find/g (stable tb.dut.counter))',
+        '(count (&& tb.clk (|| tb.overflow (= tb.dut.counter 1))))',
+        '(do (step 5) (find (= tb.clk 1)))',
+        '(do (define acc 0) (whenever (rising tb.clk) (set [acc (+ acc tb.dut.counter)])) acc)',
+        '(do (step 3) (define l (list)) (whenever tb.clk (set [l (append l INDEX)])) (list l INDEX))',
+        '(do (define n 0) (whenever (= tb.clk 1) (set [n (+ n 1)]) (step 1)) n)',
+    ]
+
+    def eval_both(self, txt):
+        '''evaluates txt with and without change points'''
+        fast = Wal()
+        fast.load('tests/traces/counter.vcd')
+        slow = Wal()
+        slow.load('tests/traces/counter.vcd')
+        with patch('wal.implementation.special.condition_ranges', return_value=None):
+            expected = slow.eval_str(txt)
+        return fast.eval_str(txt), expected
+
+    def test_same_results(self):
+        '''results must not depend on change points'''
+        for txt in ChangePointTest.EXPRESSIONS:
+            with self.subTest(txt=txt):
+                res, expected = self.eval_both(txt)
+                self.assertEqual(res, expected)
+
+    def test_sparse_evaluation(self):
+        '''conditions on rarely changing signals are evaluated only where they can change'''
+        w = Wal()
+        w.load('tests/traces/counter.vcd')
+        w.eval_str('(define n 0)')
+        w.eval_str('(defun check [] (inc n) (= tb.overflow 1))')
+        # the condition calls a function and must be evaluated at every index
+        self.assertEqual(w.eval_str('(count (check))'), w.eval_str('(count (= tb.overflow 1))'))
+        self.assertEqual(w.eval_str('n'), w.eval_str('(+ MAX-INDEX 1)'))
+
+        with patch.object(w.eval_context, 'eval', wraps=w.eval_context.eval) as evaluate:
+            w.eval_str('(count (= tb.overflow 1))')
+            self.assertLess(evaluate.call_count, 50)
+
+
+@unittest.skipIf(vectorize.np is None, 'requires NumPy')
+class VectorizeTest(unittest.TestCase):
+    '''Test that vectorized conditions match the interpreter'''
+
+    EXPRESSIONS = [
+        '(find (&& (rising tb.clk) (> (+ tb.dut.counter tb.dut.counter@2) 20)))',
+        '(find (= (slice tb.dut.counter 1 0) 2))',
+        '(find (|| (= (bxor tb.dut.counter 5) 0) (= (* tb.dut.counter 2) 14)))',
+        '(find (if tb.reset (= tb.clk 0) (< (/ tb.dut.counter 3) 1)))',
+        '(find (!= (band tb.dut.counter@-1 1) (slice tb.dut.counter 0)))',
+        '(count (&& tb.clk (! tb.reset)))',
+        '(do (define n 0) (whenever (&& (rising tb.clk) (= tb.dut.counter 4)) (inc n)) n)',
+    ]
+
+    def eval_both(self, txt):
+        '''evaluates txt with and without NumPy'''
+        fast = Wal()
+        fast.load('tests/traces/counter.vcd')
+        slow = Wal()
+        slow.load('tests/traces/counter.vcd')
+        with patch.object(vectorize, 'np', None):
+            expected = slow.eval_str(txt)
+        return fast.eval_str(txt), expected
+
+    def test_same_results(self):
+        '''results must not depend on vectorization'''
+        for txt in VectorizeTest.EXPRESSIONS:
+            with self.subTest(txt=txt):
+                res, expected = self.eval_both(txt)
+                self.assertEqual(res, expected)
+
+    def test_compile(self):
+        '''only the pure subset of WAL is vectorized'''
+        w = Wal()
+        w.load('tests/traces/counter.vcd')
+        trace = w.traces.traces['DEFAULT']
+        self.assertIsNotNone(vectorize.compile_condition(w.eval_context, trace, read_wal_sexpr('(&& tb.clk (= tb.dut.counter@1 3))')))
+        self.assertIsNone(vectorize.compile_condition(w.eval_context, trace, read_wal_sexpr('(= tb.dut.counter "3")')))
+        self.assertIsNone(vectorize.compile_condition(w.eval_context, trace, read_wal_sexpr('(= tb.dut.counter x)')))
+
+    def test_no_interpretation(self):
+        '''conditions without x or z values are not interpreted'''
+        w = Wal()
+        w.load('tests/traces/counter.vcd')
+        w.eval_str('(step 1)')
+        with patch.object(w.eval_context, 'eval', wraps=w.eval_context.eval) as evaluate:
+            w.eval_str('(find (&& tb.clk (= tb.dut.counter 3)))')
+            self.assertLess(evaluate.call_count, 5)
+
+
+class NoNumpyTest(unittest.TestCase):
+    '''Test that conditions are interpreted if NumPy is not installed'''
+
+    def eval(self, txt):
+        w = Wal()
+        w.load('tests/traces/counter.vcd')
+        return w.eval_str(txt)
+
+    def test_same_results(self):
+        '''queries do not fail without NumPy'''
+        expected = [self.eval(txt) for txt in VectorizeTest.EXPRESSIONS]
+        with patch.dict(sys.modules, {'numpy': None}):
+            del sys.modules['wal.vectorize']
+            for txt, result in zip(VectorizeTest.EXPRESSIONS, expected):
+                with self.subTest(txt=txt):
+                    self.assertEqual(self.eval(txt), result)
+
+            self.assertIsNone(sys.modules['wal.vectorize'].np)
+
+
+class CompilerTest(unittest.TestCase):
+    '''Test compilation of expressions into closures'''
+
+    def setUp(self):
+        self.w = Wal()
+
+    def test_cached(self):
+        '''expressions are compiled once and the code is stored on the expression'''
+        sexpr = read_wal_sexpr('(+ 1 2)')
+        self.assertEqual(self.w.eval_context.eval(sexpr), 3)
+        code = sexpr.code
+        self.assertIsNotNone(code)
+        self.assertEqual(self.w.eval_context.eval(sexpr), 3)
+        self.assertIs(sexpr.code, code)
+
+    def test_specialized(self):
+        '''specialized operators behave like their implementations'''
+        self.assertEqual(self.w.eval_str('(do (define x 0) (while (< x 10) (set [x (+ x 3)])) x)'), 12)
+        self.assertEqual(self.w.eval_str('(list (+ "a" 1) (+ (list 1) 2) (- 5) (* 2 2.5) (= 1 1.0) (!= 1 2) (! 0))'),
+                         ['a1', [1, 2], -5, 5.0, True, True, True])
+        self.assertEqual(self.w.eval_str('(do (defun f [x] (if (> x 1) (* x (f (- x 1))) 1)) (f 5))'), 120)
+        self.assertEqual(self.w.eval_str('(let ([y 1]) (set [y (+ y 1)]) y)'), 2)
+
+    def test_errors(self):
+        '''errors in compiled code are reported like in the interpreter'''
+        for txt in ['(> 1 "a")', '(! "a")', '(- 1 "a")', 'undefined-variable', '(1 2)']:
+            with self.subTest(txt=txt):
+                with patch('sys.stdout', new=StringIO()) as out:
+                    with self.assertRaises(WalEvalError):
+                        self.w.eval_str(txt)
+                self.assertIn('WAL Runtime error!', out.getvalue())
+
+    def test_pickle(self):
+        '''compiled code is not stored when expressions are pickled'''
+        sexpr = read_wal_sexpr('(+ 1 2)')
+        self.w.eval_context.eval(sexpr)
+        copied = pickle.loads(pickle.dumps(sexpr))
+        self.assertIsNone(copied.code)
+        self.assertEqual(copied, sexpr)
+
+
+class FrameTest(unittest.TestCase):
+    '''Test lexically addressed frames of functions and lets'''
+
+    def setUp(self):
+        self.w = Wal()
+
+    def test_closures(self):
+        '''closures capture the frames of their definitions'''
+        self.assertEqual(self.w.eval_str('(do (defun adder [n] (fn [x] (+ x n))) ((adder 3) 4))'), 7)
+        self.assertEqual(self.w.eval_str('''(do (defun counter [] (let ([c 0]) (fn [] (set [c (+ c 1)]))))
+                                                (define cnt (counter)) (cnt) (cnt) (cnt))'''), 3)
+        self.assertEqual(self.w.eval_str('(do (define va (fn xs xs)) (va 1 2 3))'), [1, 2, 3])
+
+    def test_definitions(self):
+        '''variables defined inside of functions are stored in their frames'''
+        self.assertEqual(self.w.eval_str('(do (defun f [a] (define b (* a 2)) (let ([c 1]) (+ a b c))) (f 2))'), 7)
+        self.assertEqual(self.w.eval_str('(do (defun g [a] (eval (quote (define d 5))) (+ a d)) (g 1))'), 6)
+        self.assertEqual(self.w.eval_str('(do (defun h [l] (define s 0) (for [x l] (set [s (+ s x)])) s) (h (list 1 2 3)))'), 6)
+
+    def test_outer_writes(self):
+        '''set writes to the variables of enclosing frames'''
+        self.assertEqual(self.w.eval_str('(do (define x 1) (let ([y 2]) (let ([z 3]) (set [x (+ y z)] [y 0]))) x)'), 5)
+        self.assertEqual(self.w.eval_str('(let ([y 2]) (let ([z 3]) (set [y z])) y)'), 3)
+
+    def test_errors(self):
+        '''errors in frames are reported like in environments'''
+        for txt in ['(do (defun f [a] a) (f 1 2))', '(let ([a 1] [a 2]) a)']:
+            with self.subTest(txt=txt):
+                with patch('sys.stdout', new=StringIO()):
+                    with self.assertRaises(WalEvalError):
+                        self.w.eval_str(txt)
+
+    def test_pickle(self):
+        '''frames keep their undefined slots when pickled'''
+        frame = Frame({'a': 0, 'b': 1}, [1, UNDEFINED])
+        copied = pickle.loads(pickle.dumps(frame))
+        self.assertIs(copied.slots[1], UNDEFINED)
+        self.assertEqual(copied.read('a'), 1)
+
+
+class MacroCacheTest(unittest.TestCase):
+    '''Test the reuse of macro expansions'''
+
+    def setUp(self):
+        self.w = Wal()
+        self.seval = self.w.eval_context
+
+    def expand(self, txt):
+        return self.w.eval_str(f"(macroexpand '{txt})")
+
+    def test_reuse(self):
+        '''structurally equal arguments are expanded once'''
+        self.w.eval_str('(defmacro twice [x] `(* 2 ,x))')
+        first = self.expand('(twice (+ a 1))')
+        second = self.expand('(twice (+ a 1))')
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        self.assertEqual(self.seval.macro_expansions['twice'], 1)
+        self.assertEqual(self.seval.macro_hits['twice'], 1)
+
+        self.assertEqual(self.expand('(twice (+ a 2))'), read_wal_sexpr('(* 2 (+ a 2))'))
+        self.assertEqual(self.seval.macro_expansions['twice'], 2)
+
+        # expansions are cached per macro
+        self.w.eval_str('(defmacro double [x] `(+ ,x ,x))')
+        self.assertEqual(self.expand('(double (+ a 1))'), read_wal_sexpr('(+ (+ a 1) (+ a 1))'))
+        self.assertEqual(self.seval.macro_hits['double'], 0)
+
+    def test_gensym(self):
+        '''symbols created by gensym are fresh in every expansion'''
+        self.w.eval_str('(defmacro tmp [x] (define t (gensym)) `(let ([,t ,x]) (+ ,t ,t)))')
+        first = self.expand('(tmp 1)')
+        second = self.expand('(tmp 1)')
+        self.assertEqual(self.seval.macro_hits['tmp'], 1)
+        self.assertNotEqual(first[1][0][0], second[1][0][0])
+        self.assertEqual(second[1][0][0], second[2][1])
+        self.assertEqual(self.w.eval_str('(tmp (tmp 2))'), 8)
+
+    def test_arguments(self):
+        '''reused expansions contain the argument forms of their call site'''
+        self.w.eval_str('(defmacro pick [xs] (second xs))')
+        self.expand('(pick (a b))')
+        sexpr = read_wal_sexpr('(pick (a b))')
+        self.assertIs(expand(self.seval, sexpr, parent=self.seval.global_environment), sexpr[1][1])
+        self.assertEqual(self.seval.macro_hits['pick'], 1)
+
+    def test_runtime(self):
+        '''macros that are defined after their use are expanded when they are applied'''
+        self.w.eval_str('(defun total [xs] (add-all xs))')
+        self.w.eval_str('(defun scaled [x] (with-one (* x one)))')
+        self.w.eval_str('(defmacro add-all [ys] `(fold (fn [acc y] (+ acc y)) 0 ,ys))')
+        self.w.eval_str('(defmacro with-one [body] `(let ([one 1]) ,body))')
+        self.assertEqual(self.w.eval_str("(total '(1 2 3))"), 6)
+        self.assertEqual(self.w.eval_str("(total '(4 5))"), 9)
+        self.assertEqual(self.w.eval_str('(scaled 5)'), 5)
+        self.assertEqual(self.seval.macro_expansions['add-all'], 1)
+
+    def test_dependencies(self):
+        '''macros that read variables or have side effects are expanded at every call site'''
+        self.w.eval_str('(define n 1)')
+        self.w.eval_str('(defmacro m [] `(+ ,n 0))')
+        self.assertEqual(self.w.eval_str('(m)'), 1)
+        self.w.eval_str('(set [n 2])')
+        self.assertEqual(self.w.eval_str('(m)'), 2)
+        self.assertEqual(self.seval.macro_hits['m'], 0)
+
+        self.w.eval_str('(define expansions 0)')
+        self.w.eval_str('(defmacro counted [x] (set [expansions (+ expansions 1)]) x)')
+        self.w.eval_str('(counted 1)')
+        self.w.eval_str('(counted 1)')
+        self.assertEqual(self.w.eval_str('expansions'), 2)
+
+    def test_functions(self):
+        '''expansions are dropped when a global function called by the macro is redefined'''
+        self.w.eval_str('(defun wrap [x] `(list ,x))')
+        self.w.eval_str('(defmacro wrapped [x] (wrap x))')
+        self.assertEqual(self.expand('(wrapped 1)'), read_wal_sexpr('(list 1)'))
+        self.assertEqual(self.expand('(wrapped 1)'), read_wal_sexpr('(list 1)'))
+        self.assertEqual(self.seval.macro_hits['wrapped'], 1)
+
+        self.w.eval_str('(set [wrap (fn [x] `(first ,x))])')
+        self.assertEqual(self.expand('(wrapped 1)'), read_wal_sexpr('(first 1)'))
+        self.assertEqual(self.seval.macro_hits['wrapped'], 1)
+
+    def test_pickle(self):
+        '''expansions are not stored when macros are pickled'''
+        self.w.eval_str('(defmacro twice [x] `(* 2 ,x))')
+        self.expand('(twice 1)')
+        macro = self.seval.global_environment.read('twice')
+        self.assertEqual(len(macro.expansions), 1)
+        self.assertEqual(pickle.loads(pickle.dumps(macro)).expansions, {})
+
+
+class ProfileTest(unittest.TestCase):
+    '''Test the WAL profiler'''
+
+    def setUp(self):
+        self.w = Wal()
+        self.w.eval_str('(defun fib [n] (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))')
+
+    def test_counts(self):
+        '''operators, functions and lines are counted'''
+        with self.w.profile() as profile:
+            self.assertEqual(self.w.eval_str('(fib 10)'), 55)
+            self.w.eval_str('(when #t 1)')
+
+        self.assertEqual(profile.functions[('function', 'fib')][0], 177)
+        self.assertEqual(profile.functions[('operator', '-')][0], 176)
+        self.assertIn('<string>:1', profile.lines)
+        self.assertEqual(profile.macros['when'], [1, 0])
+        for calls, total, own in profile.functions.values():
+            self.assertGreaterEqual(total, own)
+        # recursive calls are only counted once towards the total time
+        self.assertLessEqual(profile.functions[('function', 'fib')][1], profile.time)
+
+    def test_stop(self):
+        '''the evaluation context is restored after profiling'''
+        with self.w.profile():
+            self.w.eval_str('(fib 5)')
+
+        seval = self.w.eval_context
+        self.assertIsNone(seval.profile)
+        self.assertNotIn('eval', seval.__dict__)
+        self.assertEqual(self.w.eval_str('(fib 6)'), 8)
+
+    def test_output(self):
+        '''profiles are printed as tables and as collapsed stacks'''
+        with self.w.profile() as profile:
+            self.w.eval_str('(fib 12)')
+
+        stacks = profile.collapsed().split('\n')
+        for line in stacks:
+            self.assertRegex(line, r'^\S+ \d+$')
+        self.assertTrue(any(line.startswith('fib;do;if;+;fib') for line in stacks))
+
+        out = StringIO()
+        profile.print(file=out)
+        self.assertIn('fib (function)', out.getvalue())
@@ -1,11 +1,15 @@
 '''Test wal parsers'''
 # pylint: disable=C0103, W0611, C0116, W0201
+import glob
+import os
+import tempfile
 import unittest
+from unittest.mock import patch
 
 from lark import Lark
 
-from wal.reader import read, WAL_GRAMMAR, ParseError, read_wal_sexpr, read_wal_sexprs
-from wal.ast_defs import Symbol as S, WList
+from wal.reader import read, WAL_GRAMMAR, ParseError, read_wal_sexpr, read_wal_sexprs, parser, SexprReader
+from wal.ast_defs import Symbol as S, WList, Unquote, UnquoteSplice
 from wal.ast_defs import Operator as Op
 
 test_readers = {}
@@ -246,3 +250,71 @@ class SimpleProgramFileTest(unittest.TestCase):
         with open('tests/files/p3.wal', encoding='utf-8') as f:
             p = f.read()
             self.assertRaises(ParseError, read_wal_sexprs, p)
+
+
+class ParserCacheTest(unittest.TestCase):
+    '''Test caching of the parser tables'''
+
+    def tearDown(self):
+        parser.cache_clear()
+
+    def test_cache(self):
+        '''parsers are built once per process and their tables are stored on disk'''
+        with tempfile.TemporaryDirectory() as tmp:
+            with patch.dict(os.environ, {'WAL_CACHE_DIR': tmp}):
+                parser.cache_clear()
+                self.assertIs(parser('sexpr'), parser('sexpr'))
+                self.assertEqual(os.listdir(os.path.join(tmp, 'parser')), ['wal-sexpr.lark'])
+
+                # a new process loads the tables from the cache
+                parser.cache_clear()
+                self.assertEqual(read_wal_sexpr('(+ 1 2)'), WList([Op.ADD, 1, 2]))
+                self.assertEqual(read_wal_sexprs('(+ 1 2) x'), [[Op.ADD, 1, 2], S('x')])
+
+
+class SexprReaderTest(unittest.TestCase):
+    '''Test that the recursive descent reader is equivalent to the Lark parser'''
+
+    CASES = ['0x1f', '1.5', '1.', '+1', '-1', '(- 1)', '**', 'true', 'trueish', '~true', '#t', '#f', '#x', '~x',
+             '"a\\"b"', '"a\\nb"', '(print "\\\\")', '.5', 'a.b', '(a,b)', '\\foo[bar]', '(define x 1)',
+             '(a[x:y])', '(a [0])', 'a[0 : 1]', '(a[ 0 ])', 'a[0][1]', '(f x)[1:0]', '(~a[0])', '(#a[0])', '#t[0]',
+             'a@1[0]', 'a[0]@1[2]', "(x@'a b)", '(,a@1)', "'a @1", "'a[0]", "(list 'a [0])", "(list 'a\n[0])",
+             "(list `a ,b [0])", "(',a [1])", "`(a ,b ,@c)", '(a ,@ b)', "'a'b", '(a)(b)', '(list 0b101)', '(1.5.3)',
+             '[a b]', '{1 2}', '(a ;c\n[0])', "(a\n 'b\n ;x\n c)", '(a\r\nb)', 'x\t\ty', "'(a b) ;c",
+             '#!/bin/wal\n(a)', '#!x\n', '  ', ';c',
+             # invalid programs
+             '', '( )', 'x@1@2', 'x@ 1', '(a\n@1)', '(~a @1)', '(a b', '(a]', '(a ;c)', 'a(b)', '#!x', '"\\x"', "'"]
+
+    def dump(self, expr):
+        '''Returns expr with the line information of all nodes'''
+        if isinstance(expr, WList):
+            return ('list', expr.line_info, [self.dump(e) for e in expr])
+        if isinstance(expr, S):
+            return ('symbol', expr.name, expr.line_info)
+        if isinstance(expr, (Unquote, UnquoteSplice)):
+            return (type(expr).__name__, self.dump(expr.content))
+        return (type(expr).__name__, expr)
+
+    def assertEquivalent(self, code):
+        for start, method in (('sexpr', 'read_sexpr'), ('sexpr_list', 'read_sexprs')):
+            with self.subTest(code=code, start=start):
+                try:
+                    expected = self.dump(read(code, parser(start), 'file.wal'))
+                except ParseError:
+                    with self.assertRaises(ParseError):
+                        getattr(SexprReader(code, 'file.wal'), method)()
+                else:
+                    self.assertEqual(self.dump(getattr(SexprReader(code, 'file.wal'), method)()), expected)
+
+    def test_cases(self):
+        for code in SexprReaderTest.CASES:
+            self.assertEquivalent(code)
+
+    def test_files(self):
+        '''all WAL programs in this repository are read the same'''
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        files = glob.glob(os.path.join(root, '**', '*.wal'), recursive=True)
+        self.assertTrue(files)
+        for filename in files:
+            with open(filename, encoding='utf-8') as f:
+                self.assertEquivalent(f.read())
@@ -1,9 +1,15 @@
 '''Test wal std lib'''
+import os
+import pickle
+import tempfile
 import unittest
+from unittest.mock import patch
 
 from wal.core import Wal
+from wal import snapshot, wo
 from wal.reader import read_wal_sexpr
 from wal.ast_defs import Symbol as S
+from wal.version import __version__
 
 
 class TestStdLib(unittest.TestCase):
@@ -55,3 +61,130 @@ class TestStdLib(unittest.TestCase):
         d3 = [2.985083115516691, 4.7400205187137985, 0.909180684224796, -4.915339076938174, -3.9490000858501464, -1.8560664973030851, 1.5853221560298012, 0.26734205313593495, -3.377537010105016, 3.5624745106983813]
         self.w.eval_context.environment.define('d3', d3)
         self.checkEqual("(sort d3)", sorted(d3))
+
+
+class TestSnapshot(unittest.TestCase):
+    '''Test snapshots of the global state after loading the std lib'''
+
+    def test_isolation(self):
+        '''contexts restored from the same snapshot do not share state'''
+        a = Wal()
+        b = Wal()
+        a.eval_str('(define x 5)')
+        a.eval_str('(set [CS "top"])')
+        self.assertFalse(b.eval_str("(defined? 'x)"))
+        self.assertEqual(b.eval_str('CS'), '')
+        self.assertEqual(a.eval_str('CS'), 'top')
+        # closures of the std lib are bound to the environment of their context
+        env = a.eval_context.global_environment
+        self.assertIs(env.read('reverse').environment, env)
+        self.assertEqual(a.eval_str("(reverse '(1 2 3))"), [3, 2, 1])
+
+    def test_run(self):
+        '''run restores the state after loading the std lib'''
+        w = Wal()
+        w.eval_str('(define x 5)')
+        self.assertEqual(w.run_str("(filter (fn [x] (> x 1)) '(1 2 3))"), [2, 3])
+        self.assertFalse(w.eval_str("(defined? 'x)"))
+
+    def test_disk(self):
+        '''snapshots are stored on disk and loaded by later processes'''
+        with tempfile.TemporaryDirectory() as tmp:
+            with patch.dict(os.environ, {'WAL_CACHE_DIR': tmp}), patch.dict(snapshot.SNAPSHOTS, clear=True):
+                Wal()
+                files = os.listdir(os.path.join(tmp, 'stdlib'))
+                self.assertEqual(len(files), 1)
+                snapshot.SNAPSHOTS.clear()
+
+                with patch('wal.snapshot.load_stdlib') as load:
+                    w = Wal()
+                load.assert_not_called()
+                self.assertEqual(w.eval_str("(reverse '(1 2))"), [2, 1])
+
+    def test_pickle(self):
+        '''snapshots survive pickling'''
+        w = Wal()
+        copied = pickle.loads(pickle.dumps(snapshot.Snapshot(w.eval_context)))
+        copied.restore(w.eval_context)
+        self.assertEqual(w.eval_str("(reverse '(1 2))"), [2, 1])
+
+
+class TestWalObjects(unittest.TestCase):
+    '''Test .wo files and the cache of compiled WAL files'''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory() # pylint: disable=R1732
+        self.env = patch.dict(os.environ, {'WAL_CACHE_DIR': os.path.join(self.tmp.name, 'cache')})
+        self.env.start()
+        self.module = os.path.join(self.tmp.name, 'lib')
+        self.write('(defmacro twice [x] `(* 2 ,x))\n(defun f [y] (twice y))')
+        # the std lib files are cached as well
+        Wal()
+        self.stdlib = len(self.cached())
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def write(self, code):
+        with open(self.module + '.wal', 'w', encoding='utf-8') as f:
+            f.write(code)
+
+    def cached(self):
+        return os.listdir(os.path.join(self.tmp.name, 'cache', 'wo'))
+
+    def load(self):
+        w = Wal()
+        w.eval_context.walpath = [self.tmp.name]
+        w.eval_str('(eval-file lib)')
+        return w
+
+    def test_cache(self):
+        '''compiled files are cached and reused while the source is unchanged'''
+        self.assertEqual(self.load().eval_str('(f 4)'), 8)
+        self.assertEqual(len(self.cached()), self.stdlib + 1)
+
+        with patch('wal.wo.read_wal_sexprs') as read:
+            w = self.load()
+        read.assert_not_called()
+        self.assertEqual(w.eval_str('(f 4)'), 8)
+
+        self.write('(defmacro twice [x] `(* 2 ,x))\n(defun f [y] (twice (+ y 1)))')
+        self.assertEqual(self.load().eval_str('(f 4)'), 10)
+
+    def test_environment(self):
+        '''cached files are only reused in the same environment'''
+        self.load()
+        w = Wal()
+        w.eval_context.walpath = [self.tmp.name]
+        w.eval_str('(define g 1)')
+        w.eval_str('(eval-file lib)')
+        self.assertEqual(w.eval_str('(f 4)'), 8)
+        self.assertEqual(len(self.cached()), self.stdlib + 2)
+
+    def test_format(self):
+        '''.wo files record their source and can be read back'''
+        sexprs = [read_wal_sexpr('(define x 5)')]
+        wo.encode(self.module + '.wo', wo.WalObject(sexprs, wo.source_hash('(define x 5)')))
+        decoded = wo.decode(self.module + '.wo')
+        self.assertEqual(decoded.sexprs, sexprs)
+        self.assertEqual(decoded.version, __version__)
+        self.assertFalse(decoded.resolved)
+        self.assertEqual(decoded.source, wo.source_hash('(define x 5)'))
+
+        self.write('(define x 5)')
+        self.assertFalse(wo.stale(self.module + '.wo'))
+        self.write('(define x 6)')
+        self.assertTrue(wo.stale(self.module + '.wo'))
+        self.assertEqual(self.load().eval_str('x'), 6)
+
+    def test_legacy(self):
+        '''.wo files of older versions only contain the pickled expressions'''
+        os.remove(self.module + '.wal')
+        with open(self.module + '.wo', 'wb') as f:
+            pickle.dump([read_wal_sexpr('(define x 5)')], f)
+
+        decoded = wo.decode(self.module + '.wo')
+        self.assertIsNone(decoded.version)
+        self.assertFalse(wo.stale(self.module + '.wo'))
+        self.assertEqual(self.load().eval_str('x'), 5)
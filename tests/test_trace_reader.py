@@ -1,8 +1,16 @@
 '''Test wal trace readers'''
+import io
+import os
+import tempfile
 import unittest
+from unittest.mock import patch
 
 from wal.core import Wal
 from wal.ast_defs import WalEvalError
+from wal.trace import sidecar, vcd
+from wal.trace.changes import ChangeList, BitChangeList, VectorChangeList, WideChangeList, RealChangeList
+from wal.trace.vcd import TraceVcd, tokenize
+from wal.trace.csvtrace import TraceCsv
 
 class BasicParserTest(unittest.TestCase):
     '''Test trace readers'''
@@ -32,3 +40,431 @@ class ReadUndefinedSignalTest(unittest.TestCase):
 
             with self.assertRaises(WalEvalError):
                 wal.eval_str('(in-group "TOP.tb.data<0>" #.wrongname)')
+
+
+SPARSE_VCD = '''$timescale 1ps $end
+$scope module top $end
+$var reg 1 ! clk $end
+$var reg 4 " data [3:0] $end
+$var wire 1 # idle $end
+$upscope $end
+$enddefinitions $end
+#0
+$dumpvars
+0!
+b0000 "
+x#
+$end
+#5
+1!
+#10
+0!
+b0101 "
+#15
+1!
+#20
+0!
+b0101 "
+'''
+
+
+class SparseVcdTest(unittest.TestCase):
+    '''Test the change list based storage of the vcd reader'''
+
+    def setUp(self):
+        self.trace = TraceVcd(SPARSE_VCD, 't0', None, from_string=True)
+
+    def test_values(self):
+        '''Values are reconstructed correctly at every index'''
+        self.assertEqual([self.trace.access_signal_data('top.clk', i) for i in range(5)], [0, 1, 0, 1, 0])
+        self.assertEqual([self.trace.access_signal_data('top.data', i) for i in range(5)], [0, 0, 5, 5, 5])
+        self.assertEqual([self.trace.access_signal_data('top.idle', i) for i in range(5)], ['x'] * 5)
+
+    def test_only_changes_stored(self):
+        '''Only actual value changes are stored'''
+        self.assertEqual(list(self.trace.data['top.clk'].indices), [0, 1, 2, 3, 4])
+        self.assertEqual(list(self.trace.data['top.data'].indices), [0, 2])
+        self.assertEqual(list(self.trace.data['top.idle'].indices), [0])
+
+    def test_decoded_values(self):
+        '''Values are decoded once while parsing'''
+        trace = TraceVcd('''$scope module top $end
+$var reg 4 ! data [3:0] $end
+$var real 64 " voltage $end
+$upscope $end
+$enddefinitions $end
+#0
+b1x01 !
+r1.5 "
+#1
+b1101 !
+''', 't0', None, from_string=True)
+        self.assertEqual([trace.data['top.data'].value(i) for i in range(2)], ['1x01', 13])
+        self.assertEqual(trace.data['top.voltage'].value(0), 1.5)
+        self.assertEqual(trace.access_signal_data('top.data', 0), '1x01')
+        self.assertEqual(trace.access_signal_data('top.voltage', 1), 1.5)
+
+    def test_logic_values(self):
+        '''Values with x or z bits are stored as planes and can be sliced'''
+        with tempfile.TemporaryDirectory() as tmp:
+            trace_file = os.path.join(tmp, 'logic.vcd')
+            with open(trace_file, 'w', encoding='utf-8') as f:
+                f.write('''$scope module top $end
+$var reg 4 ! data [3:0] $end
+$var reg 1 " bit $end
+$upscope $end
+$enddefinitions $end
+#0
+bz1 !
+x"
+#1
+b1x01 !
+1"
+''')
+
+            wal = Wal()
+            wal.load(trace_file, 't0', cache=False)
+
+        self.assertEqual(wal.eval_str('top.data'), 'zzz1')
+        self.assertEqual(wal.eval_str('top.bit'), 'x')
+        self.assertEqual(wal.eval_str('(slice top.data 0)'), 1)
+        self.assertEqual(wal.eval_str('(slice top.data 3)'), 'z')
+        wal.step()
+        self.assertEqual(wal.eval_str('top.bit'), 1)
+        self.assertTrue(wal.eval_str('(= top.data "1x01")'))
+        self.assertEqual(wal.eval_str('(slice top.data 3 2)'), '1x')
+        self.assertEqual(wal.eval_str('(slice top.data 1 0)'), 1)
+        trace = wal.traces.traces['t0']
+        self.assertEqual(trace.data['top.data'].values.typecode, 'B')
+        self.assertIsInstance(trace.data['top.bit'].values, bytearray)
+
+    def test_packed_fallback(self):
+        '''Values that do not fit into a packed change list are kept'''
+        for changes in [BitChangeList(), VectorChangeList(4), WideChangeList(100), RealChangeList()]:
+            changes.change(0, 1.5 if isinstance(changes, RealChangeList) else 1)
+            changes.change(1, 'string')
+            self.assertEqual(type(changes), ChangeList)
+            self.assertEqual([changes.at(i) for i in range(2)], [1.5 if changes.width is None else 1, 'string'])
+
+    def test_record(self):
+        '''Recording changes at once stores the same changes as recording them one by one'''
+        runs = [([1, 2, 3, 5, 6], [1, 1, 0, 'x', 'X']),
+                ([1, 1, 2, 2, 3], [1, 0, 0, 1, 1]),
+                ([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], [0, 1, 0, 1, 1, 'z', 1, 0, 1, 0]),
+                ([1, 2, 3], [5, 5, 300]),
+                ([1, 2, 3], [1.0, 0, 1]),
+                ([1, 2, 3], ['x', '1x', 3])]
+        kinds = [ChangeList, BitChangeList, lambda: VectorChangeList(8), lambda: WideChangeList(100), RealChangeList]
+        for indices, values in runs:
+            for kind in kinds:
+                with self.subTest(values=values, kind=kind):
+                    expected, recorded = kind(), kind()
+                    # the first change starts a new byte of a bit change list
+                    for changes in [expected, recorded]:
+                        changes.change(0, 1)
+                        changes.change(1, 0)
+                        changes.change(2, 1)
+
+                    for index, value in zip(indices, values):
+                        expected.change(index + 2, value)
+
+                    recorded.record([index + 2 for index in indices], values)
+                    self.assertEqual(type(recorded), type(expected))
+                    self.assertEqual(list(recorded.indices), list(expected.indices))
+                    self.assertEqual([recorded.value(i) for i in range(len(recorded))],
+                                     [expected.value(i) for i in range(len(expected))])
+
+    def test_mixed_tokens(self):
+        '''Scalar and vector value changes can be mixed for all signals'''
+        trace = TraceVcd('''$scope module top $end
+$var reg 4 ! data [3:0] $end
+$var reg 1 " bit $end
+$upscope $end
+$enddefinitions $end
+#0
+b101 !
+b1 "
+#1
+1!
+bx "
+#2
+bx1 !
+0"
+#3
+b0011 !
+''', 't0', None, from_string=True)
+        self.assertEqual([trace.access_signal_data('top.data', i) for i in range(4)], [5, 1, 'xxx1', 3])
+        self.assertEqual([trace.access_signal_data('top.bit', i) for i in range(4)], [1, 'x', 0, 0])
+
+    def test_tokenize_blocks(self):
+        '''Tokens split across block boundaries are reassembled'''
+        data = SPARSE_VCD.encode('utf-8')
+        for block_size in [1, 2, 3, 7, 64]:
+            self.assertEqual(list(tokenize(io.BytesIO(data), block_size)), SPARSE_VCD.split())
+
+
+class SidecarCacheTest(unittest.TestCase):
+    '''Test the persistent trace cache'''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.trace_file = os.path.join(self.tmp.name, 'sparse.vcd')
+        with open(self.trace_file, 'w', encoding='utf-8') as f:
+            f.write(SPARSE_VCD)
+
+        self.env = patch.dict(os.environ, {'WAL_CACHE_DIR': os.path.join(self.tmp.name, 'cache')})
+        self.min_size = patch.object(sidecar, 'MIN_SIZE', 0)
+        self.env.start()
+        self.min_size.start()
+
+    def tearDown(self):
+        self.min_size.stop()
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        '''A cached trace contains the same data as a parsed one'''
+        parsed = TraceVcd(self.trace_file, 't0', None)
+        self.assertTrue(os.path.isfile(sidecar.sidecar_path(self.trace_file, None)))
+
+        with patch.object(TraceVcd, 'parse') as parse:
+            cached = TraceVcd(self.trace_file, 't0', None)
+            parse.assert_not_called()
+
+        self.assertEqual(cached.rawsignals, parsed.rawsignals)
+        self.assertEqual(list(cached.timestamps), list(parsed.timestamps))
+        for signal in parsed.rawsignals:
+            self.assertEqual([cached.access_signal_data(signal, i) for i in range(5)],
+                             [parsed.access_signal_data(signal, i) for i in range(5)])
+
+    def test_invalidation(self):
+        '''Changing the trace file invalidates the cache'''
+        TraceVcd(self.trace_file, 't0', None)
+        with open(self.trace_file, 'a', encoding='utf-8') as f:
+            f.write('#25\n1!\n')
+
+        self.assertIsNone(sidecar.load(self.trace_file, None, 'vcd'))
+        self.assertEqual(TraceVcd(self.trace_file, 't0', None).max_index, 5)
+
+    def test_keep_signals_key(self):
+        '''Traces loaded with different keep_signals use different caches'''
+        TraceVcd(self.trace_file, 't0', None)
+        self.assertIsNone(sidecar.load(self.trace_file, {'top.clk'}, 'vcd'))
+        trace = TraceVcd(self.trace_file, 't0', None, keep_signals=['top.clk'])
+        self.assertEqual(trace.rawsignals, ['top.clk'])
+
+
+AMBIGUOUS_VCD = '''$timescale 1ps $end
+$scope module top $end
+$var reg 4 #1 a [3:0] $end
+$var reg 1 ! clk $end
+$var reg 4 1! b [3:0] $end
+$var reg 4 bq c [3:0] $end
+$var reg 4 b0 d [3:0] $end
+$upscope $end
+$enddefinitions $end
+#0
+$dumpvars
+b0000 #1
+0!
+b0001 1!
+b0010 bq
+b0011 b0
+$end
+#1
+1!
+b1111 #1
+#2
+b1 bq
+b0 b0
+#3
+0!
+b1 1!
+#4
+b10 b0
+b11 #1
+'''
+
+COMMENTED_VCD = '''$timescale 1ps $end
+$scope module top $end
+$var reg 1 ! clk $end
+$var reg 4 " data [3:0] $end
+$upscope $end
+$enddefinitions $end
+#0
+$dumpvars
+0!
+b0000 "
+$end
+$comment
+#20
+1!
+b1111 "
+$end
+#5
+1!
+$comment #7 0! $end
+#10
+0!
+b0101 "
+$comment b0011 " #30 $end
+#15
+1!
+'''
+
+
+class LazyVcdTest(unittest.TestCase):
+    '''Test lazy loading of vcd traces'''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def load(self, content):
+        trace_file = os.path.join(self.tmp.name, 'trace.vcd')
+        with open(trace_file, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+        return TraceVcd(trace_file, 't0', None, cache=False), TraceVcd(trace_file, 't0', None, lazy=True)
+
+    def test_header_only(self):
+        '''Signals and timestamps are available without decoding any changes'''
+        eager, lazy = self.load(SPARSE_VCD)
+        self.assertEqual(lazy.rawsignals, eager.rawsignals)
+        self.assertEqual(lazy.scopes, eager.scopes)
+        self.assertEqual(list(lazy.timestamps), list(eager.timestamps))
+        self.assertEqual(len(lazy.cache), 0)
+
+        lazy.access_signal_data('top.clk', 0)
+        self.assertEqual(list(lazy.cache.columns), [lazy.name2id['top.clk']])
+
+    def test_same_values(self):
+        '''Lazily decoded signals equal eagerly parsed ones, even with value-like identifiers'''
+        for content in [SPARSE_VCD, AMBIGUOUS_VCD]:
+            eager, lazy = self.load(content)
+            self.assertEqual(list(lazy.timestamps), list(eager.timestamps))
+            for signal in eager.rawsignals:
+                self.assertEqual([lazy.access_signal_data(signal, i) for i in range(eager.max_index + 1)],
+                                 [eager.access_signal_data(signal, i) for i in range(eager.max_index + 1)])
+
+    def test_comments(self):
+        '''Timestamps and changes inside of comments in the dump section are ignored'''
+        eager, lazy = self.load(COMMENTED_VCD)
+        self.assertEqual(list(eager.timestamps), [0, 5, 10, 15])
+        self.assertEqual(list(lazy.timestamps), list(eager.timestamps))
+        for signal in eager.rawsignals:
+            self.assertEqual([lazy.access_signal_data(signal, i) for i in range(eager.max_index + 1)],
+                             [eager.access_signal_data(signal, i) for i in range(eager.max_index + 1)])
+
+    def test_wal_load(self):
+        '''Lazily loaded traces can be used from WAL'''
+        wal = Wal()
+        wal.load('tests/traces/counter.vcd', lazy=True)
+        self.assertEqual(wal.eval_str('(length SIGNALS)'), len(wal.traces.traces['DEFAULT'].rawsignals))
+        self.assertEqual(wal.eval_str('(count (= tb.overflow 1))'), 4)
+
+
+class ParallelVcdTest(unittest.TestCase):
+    '''Test parsing vcd traces in multiple processes'''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # parse even tiny traces in parallel on machines with a single CPU
+        self.chunk_size = patch.object(vcd, 'PARALLEL_CHUNK_SIZE', 1)
+        self.cpu_count = patch('os.cpu_count', return_value=8)
+        self.chunk_size.start()
+        self.cpu_count.start()
+
+    def tearDown(self):
+        self.cpu_count.stop()
+        self.chunk_size.stop()
+        self.tmp.cleanup()
+
+    def test_jobs(self):
+        '''Small files and the sidecar cache are not parsed in parallel'''
+        trace_file = os.path.join(self.tmp.name, 'trace.vcd')
+        with open(trace_file, 'w', encoding='utf-8') as f:
+            f.write(SPARSE_VCD)
+
+        size = os.path.getsize(trace_file)
+        self.assertEqual(vcd.parallel_jobs(trace_file, 4), 4)
+        self.assertEqual(vcd.parallel_jobs(trace_file, 1), 1)
+        self.assertEqual(vcd.parallel_jobs(trace_file, 16), 8)
+        with patch.object(vcd, 'PARALLEL_CHUNK_SIZE', size // 2):
+            self.assertEqual(vcd.parallel_jobs(trace_file, 4), 2)
+
+        with patch.object(vcd, 'PARALLEL_CHUNK_SIZE', size + 1), \
+             patch.object(TraceVcd, 'parse_parallel') as parse_parallel:
+            TraceVcd(trace_file, 't0', None, cache=False, jobs=4)
+            parse_parallel.assert_not_called()
+
+        with patch.dict(os.environ, {'WAL_CACHE_DIR': os.path.join(self.tmp.name, 'cache')}), \
+             patch.object(sidecar, 'MIN_SIZE', 0):
+            TraceVcd(trace_file, 't0', None)
+            with patch.object(TraceVcd, 'parse_parallel') as parse_parallel:
+                TraceVcd(trace_file, 't0', None, jobs=4)
+                parse_parallel.assert_not_called()
+
+    def test_same_changes(self):
+        '''Traces parsed in parallel equal sequentially parsed ones'''
+        trace_file = os.path.join(self.tmp.name, 'trace.vcd')
+        for content in [SPARSE_VCD, AMBIGUOUS_VCD, COMMENTED_VCD]:
+            with open(trace_file, 'w', encoding='utf-8') as f:
+                f.write(content)
+
+            sequential = TraceVcd(trace_file, 't0', None, cache=False)
+            for jobs in [2, 3, 8]:
+                parallel = TraceVcd(trace_file, 't0', None, cache=False, jobs=jobs)
+                self.assertEqual(list(parallel.timestamps), list(sequential.timestamps))
+                for signal in sequential.rawsignals:
+                    self.assertEqual(list(parallel.data[signal].indices), list(sequential.data[signal].indices))
+                    self.assertEqual(parallel.data[signal].values, sequential.data[signal].values)
+
+
+class FstBlockTest(unittest.TestCase):
+    '''Test block-wise decoding of fst traces'''
+
+    def test_decode_on_access(self):
+        '''Only accessed and kept signals are decoded'''
+        from wal.trace.fst import TraceFst # pylint: disable=C0415
+        trace = TraceFst('tests/traces/counter.fst', 't0', None, keep_signals=['tb.clk'])
+        self.assertEqual(len(trace.cache), 1)
+
+        vcd = TraceVcd('tests/traces/counter.vcd', 't0', None, cache=False)
+        for signal in ['tb.clk', 'tb.dut.counter']:
+            self.assertEqual([trace.access_signal_data(signal, i) for i in range(trace.max_index + 1)],
+                             [vcd.access_signal_data(signal, i) for i in range(vcd.max_index + 1)])
+
+        self.assertEqual(len(trace.cache), 2)
+
+    def test_cache_budget(self):
+        '''Decoded signals are evicted when the cache budget is exceeded'''
+        wal = Wal()
+        wal.load('tests/traces/counter.fst', cache_mb=1)
+        trace = wal.traces.traces['DEFAULT']
+        trace.cache.budget = 1
+        wal.eval_str('(whenever tb.clk tb.reset tb.dut.counter)')
+        stats = wal.eval_str('CACHE-STATS')
+        self.assertEqual(stats['columns'], 1)
+        self.assertEqual(stats['misses'], stats['evictions'] + 1)
+        self.assertEqual(wal.eval_str("(geta CACHE-STATS 'budget)"), 1)
+
+
+class CsvTraceTest(unittest.TestCase):
+    '''Test the csv reader'''
+
+    def test_columns(self):
+        '''Timestamps are converted to nanoseconds and repeated values are collapsed'''
+        trace = TraceCsv('''Time [s],Channel 0,Channel 1
+0.000000000,0,1
+0.000000500,0,1
+0.000001,1,1
+2,1,0
+''', 't0', None, from_string=True)
+        self.assertEqual(trace.rawsignals, ['Channel_0', 'Channel_1'])
+        self.assertEqual(list(trace.timestamps), [0, 500, 1000, 2000000000])
+        self.assertEqual([trace.access_signal_data('Channel_0', i) for i in range(4)], [0, 0, 1, 1])
+        self.assertEqual([trace.access_signal_data('Channel_1', i) for i in range(4)], [1, 1, 1, 0])
+        self.assertEqual(list(trace.data['Channel_0'].indices), [0, 2])
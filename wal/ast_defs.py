@@ -111,11 +111,19 @@ class Operator(Enum):
     # special
     FIND = 'find'
     FIND_G = 'find/g'
+    FIND_FIRST = 'find-first'
+    FIND_NEXT = 'find-next'
+    FIND_PREV = 'find-prev'
     WHENEVER = 'whenever'
     FOLD_SIGNAL = 'fold/signal'
     SIGNAL_WIDTH = 'signal-width'
     SAMPLE_AT = 'sample-at'
     TRIM_TRACE = 'trim-trace'
+    RISING = 'rising'
+    FALLING = 'falling'
+    CHANGED = 'changed?'
+    NEXT_CHANGE = 'next-change'
+    PREV_CHANGE = 'prev-change'
     # system
     EXIT = 'exit'
     # virtual signals
@@ -129,6 +137,13 @@ operators = set([op.value for op in Operator])
 
 class WList(UserList):
 
+    # compiled code of this expression, it is not stored when pickling
+    code = None
+    # compiled code that is used while profiling
+    profiled = None
+    # frame layout of the parameters of fn and the bindings of let, set by the resolve pass
+    layout = None
+
     def __init__(self, data, line_info=None):
         super().__init__(data)
         self.line_info = line_info
@@ -146,13 +161,27 @@ class WList(UserList):
     def strip_line_info(self):
         return [d.strip_line_info() if isinstance(d, WList) else d for d in self.data]
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('code', None)
+        state.pop('profiled', None)
+        return state
+
 
 class Symbol:
     '''Symbol class'''
 
-    def __init__(self, name, steps=None, line_info=('', 0, 0)):
+    # compiled code of this symbol, it is not stored when pickling
+    code = None
+    profiled = None
+    index = None
+
+    def __init__(self, name, steps=None, line_info=('', 0, 0), index=None):
         self.name = name
+        # number of environments between the symbol and its definition
         self.steps = steps
+        # slot of the variable in the frame of its definition
+        self.index = index
         self.line_info = line_info
 
     def __repr__(self):
@@ -164,6 +193,12 @@ class Symbol:
 
         return False
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('code', None)
+        state.pop('profiled', None)
+        return state
+
 
 class UserOperator:
     '''Class that wraps a user specified operator'''
@@ -222,6 +257,98 @@ class Environment:
         assert self.parent, f'variable {name} is undefined'
         return self.parent.read(name)
 
+    def read_slot(self, index, name): # pylint: disable=W0613
+        '''Read from a variable addressed by the resolve pass'''
+        return self.read(name)
+
+    def write_slot(self, index, name, value): # pylint: disable=W0613
+        '''Write to a variable addressed by the resolve pass'''
+        self.environment[name] = value
+
+
+class Undefined:
+    '''Marks slots of frames whose variables are not defined yet'''
+
+    def __reduce__(self):
+        return 'UNDEFINED'
+
+
+UNDEFINED = Undefined()
+
+
+class Frame:
+    '''Environment of a closure call or let with the layout computed by the resolve pass.
+    Variables are stored in slots and addressed by their index in the layout.'''
+
+    __slots__ = ('names', 'slots', 'parent')
+
+    def __init__(self, names, slots, parent=None):
+        # names maps variable names to slot indices and is shared by all frames of a scope
+        self.names = names
+        self.slots = slots
+        self.parent = parent
+
+    def define(self, name, value):
+        '''Define new variable in this context '''
+        index = self.names.get(name)
+        if index is None:
+            # variables unknown to the resolve pass (e.g. defined by eval) get new slots
+            self.names = {**self.names, name: len(self.slots)}
+            self.slots.append(value)
+        else:
+            assert self.slots[index] is UNDEFINED, f'variable {name} already defined'
+            self.slots[index] = value
+
+    def undefine(self, name):
+        '''Remove definition from this context'''
+        index = self.names.get(name)
+        assert index is not None and self.slots[index] is not UNDEFINED, f'variable {name} is not defined'
+        self.slots[index] = UNDEFINED
+
+    def is_defined(self, name):
+        '''Check if name is defined somewhere and return that environment'''
+        index = self.names.get(name)
+        if index is not None and self.slots[index] is not UNDEFINED:
+            return self
+
+        if self.parent:
+            return self.parent.is_defined(name)
+
+        return False
+
+    def write(self, name, value):
+        '''Write to variable name'''
+        index = self.names.get(name)
+        if index is not None and self.slots[index] is not UNDEFINED:
+            self.slots[index] = value
+        else:
+            assert self.parent
+            self.parent.write(name, value)
+
+    def read(self, name):
+        '''Read from variable name'''
+        index = self.names.get(name)
+        if index is not None and self.slots[index] is not UNDEFINED:
+            return self.slots[index]
+
+        assert self.parent, f'variable {name} is undefined'
+        return self.parent.read(name)
+
+    def read_slot(self, index, name):
+        '''Read from a variable addressed by the resolve pass'''
+        if index is not None:
+            value = self.slots[index]
+            if value is not UNDEFINED:
+                return value
+
+        return self.read(name)
+
+    def write_slot(self, index, name, value):
+        '''Write to a variable addressed by the resolve pass'''
+        if index is None:
+            self.write(name, value)
+        else:
+            self.slots[index] = value
 
 
 class Closure:
@@ -241,6 +368,21 @@ class Macro:
         self.name = name
         self.args = args
         self.expression = expression
+        # expansions by the structure of the argument forms, they are not stored when pickling
+        self.expansions = {}
+        # global functions called by the macro, False if its expansions can not be reused
+        self.functions = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('expansions', None)
+        state.pop('functions', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.expansions = {}
+        self.functions = None
 
 
 @dataclass
@@ -0,0 +1,537 @@
+'''Compiles WAL expressions into trees of Python closures'''
+# pylint: disable=C0116
+from wal.ast_defs import Operator, UserOperator, Symbol, Frame, UNDEFINED, Closure, Macro, WList, WalEvalError
+from wal.util import wal_str
+from wal.implementation.math import add
+from wal.profiler import profiled
+from wal.passes import PURE_OPERATORS, common_subexpressions, form_key, pure, relocatable
+from wal.implementation.special import in_bounds
+
+
+def compile_expr(seval, expr):
+    '''Compiles expr into a function that evaluates expr when called with an SEval object.
+    The function is cached on expr so that each expression is only compiled once.'''
+    code = compile_symbol(expr) if isinstance(expr, Symbol) else compile_list(seval, expr)
+    if seval.profile is not None:
+        # code compiled while profiling measures itself and is kept apart from the regular code
+        code = profiled(expr, code)
+        expr.profiled = code
+    else:
+        expr.code = code
+    return code
+
+
+def code_of(seval, expr):
+    '''Returns the cached code of expr and compiles it if necessary'''
+    if isinstance(expr, (WList, Symbol)):
+        return (expr.code if seval.profile is None else expr.profiled) or compile_expr(seval, expr)
+
+    if isinstance(expr, (int, float, str)):
+        return lambda seval: expr
+
+    return lambda seval: seval.interpret(expr)
+
+
+def checked(expr, function):
+    '''Reports assertions raised by function as errors of expr'''
+    def code(seval):
+        try:
+            return function(seval)
+        except AssertionError as error:
+            seval.print_error(expr, error)
+            raise WalEvalError() # pylint: disable=W0707
+
+    return code
+
+
+def compile_symbol(expr):
+    name = expr.name
+    if expr.steps is None:
+        # this symbol has not been resolved, it can be a signal
+        # the signal is bound once and rebound when traces or aliases change
+        binding = [None, None, None, None]
+
+        def read(seval):
+            traces = seval.traces
+            if binding[0] is not traces or binding[1] != traces.epoch or binding[2] is not seval.aliases:
+                signal = seval.aliases.get(name, name)
+                binding[:] = [traces, traces.epoch, seval.aliases, traces.bind(signal)]
+
+            reader = binding[3]
+            if reader is not None:
+                return reader(seval.scope, seval.offset)
+            return seval.environment.read(seval.aliases.get(name, name))
+    elif expr.index is None:
+        read = read_variable(name, expr.steps)
+    else:
+        read = read_slot(name, expr.steps, expr.index)
+
+    return checked(expr, read)
+
+
+def read_variable(name, depth):
+    '''Reads a variable by name from the environment depth steps up'''
+    if depth == 0:
+        return lambda seval: seval.environment.read(name)
+
+    if depth == 1:
+        return lambda seval: seval.environment.parent.read(name)
+
+    def read(seval):
+        env = seval.environment
+        for _ in range(depth):
+            env = env.parent
+        return env.read(name)
+
+    return read
+
+
+def read_slot(name, depth, index):
+    '''Reads a variable from slot index of the frame depth steps up'''
+    def read_frame(env):
+        if env.__class__ is Frame:
+            value = env.slots[index]
+            if value is not UNDEFINED:
+                return value
+        return env.read_slot(index, name)
+
+    if depth == 0:
+        def read(seval):
+            env = seval.environment
+            if env.__class__ is Frame:
+                value = env.slots[index]
+                if value is not UNDEFINED:
+                    return value
+            return env.read_slot(index, name)
+    elif depth == 1:
+        read = lambda seval: read_frame(seval.environment.parent)
+    else:
+        def read(seval):
+            env = seval.environment
+            for _ in range(depth):
+                env = env.parent
+            return read_frame(env)
+
+    return read
+
+
+def compile_list(seval, expr):
+    if not expr:
+        return lambda seval: seval.interpret(expr)
+
+    head = expr[0]
+    tail = expr[1:]
+    if isinstance(head, Operator):
+        if head in SHARING:
+            repeated = common_subexpressions(seval, expr)
+            if repeated:
+                return compile_shared(seval, expr, repeated)
+
+        code = SPECIALIZED[head](seval, expr, tail) if head in SPECIALIZED else None
+        if code:
+            return code
+
+        function = seval.dispatch.get(head.value)
+        if function is None:
+            return lambda seval: seval.interpret(expr)
+
+        return checked(expr, lambda seval: function(seval, tail))
+
+    if isinstance(head, Closure):
+        return checked(expr, lambda seval: seval.eval_closure(head, tail))
+
+    if isinstance(head, UserOperator):
+        def dispatch(seval):
+            res = seval.eval_user_dispatch(head, tail)
+            if isinstance(res, Exception):
+                raise NotImplementedError(str(expr))
+            return res
+
+        return checked(expr, dispatch)
+
+    if isinstance(head, Macro):
+        expansion = []
+
+        def apply(seval):
+            if not expansion:
+                expansion.append(code_of(seval, seval.expand_call(head, tail)))
+            return expansion[0](seval)
+
+        return checked(expr, apply)
+
+    if isinstance(head, (int, str)):
+        return lambda seval: seval.interpret(expr)
+
+    if callable(head):
+        return checked(expr, lambda seval: head(*tail))
+
+    head_code = code_of(seval, head)
+    arg_codes = []
+    # macros that are defined after expr was expanded are expanded on their first application
+    expansion = [None, None]
+
+    def call(seval):
+        function = head_code(seval)
+        if function.__class__ is Closure:
+            if function.args.__class__ is WList and function.args.layout is not None:
+                # arguments are compiled on the first call to a closure
+                if len(arg_codes) != len(tail):
+                    arg_codes[:] = [code_of(seval, arg) for arg in tail]
+                return seval.call_closure(function, [code(seval) for code in arg_codes])
+            return seval.eval_closure(function, tail)
+        if function.__class__ is Macro:
+            if expansion[0] is not function:
+                expansion[:] = [function, code_of(seval, seval.expand_call(function, tail))]
+            return expansion[1](seval)
+        return seval.interpret([function] + tail)
+
+    return checked(expr, call)
+
+
+def compile_shared(seval, expr, repeated):
+    '''Compiles expr such that each of its subexpressions with a key in repeated is evaluated
+    at most once per evaluation of expr. The values are stored in seval.shared.
+    Like in common_subexpressions, nothing is shared after the first expression that is not pure.'''
+    shared = {}
+    stopped = []
+
+    def share(sub):
+        if stopped or not isinstance(sub, WList) or not sub or sub[0] == Operator.QUOTE:
+            return sub
+
+        if sub.code is not None:
+            if not pure(sub):
+                stopped.append(sub)
+            return sub
+
+        key = form_key(sub)
+        if key not in repeated:
+            head = sub[0]
+            if not isinstance(head, Operator) or head not in PURE_OPERATORS:
+                if not pure(sub):
+                    stopped.append(sub)
+                return sub
+            return WList([head, *map(share, sub[1:])], line_info=sub.line_info)
+
+        if key not in shared:
+            index = len(shared)
+            form = sub if sub[0] == Operator.REL_EVAL else WList([sub[0], *map(share, sub[1:])], line_info=sub.line_info)
+            code = code_of(seval, form)
+
+            def read(seval):
+                values = seval.shared
+                value = values[index]
+                if value is UNDEFINED:
+                    value = values[index] = code(seval)
+                return value
+
+            shared[key] = read
+
+        # the occurrence keeps the expression for printing and for the interpreter
+        occurrence = WList(sub.data, line_info=sub.line_info)
+        occurrence.code = occurrence.profiled = shared[key]
+        return occurrence
+
+    body = code_of(seval, WList([expr[0], *map(share, expr[1:])], line_info=expr.line_info))
+    size = len(shared)
+
+    def evaluate(seval):
+        save = seval.shared
+        seval.shared = [UNDEFINED] * size
+        try:
+            return body(seval)
+        finally:
+            seval.shared = save
+
+    return evaluate
+
+
+def compile_do(seval, expr, args):
+    if not args:
+        return None
+
+    *codes, last = [code_of(seval, arg) for arg in args]
+
+    def do(seval):
+        for code in codes:
+            code(seval)
+        return last(seval)
+
+    return do
+
+
+def compile_if(seval, expr, args):
+    if len(args) == 2:
+        condition, then = [code_of(seval, arg) for arg in args]
+        return lambda seval: then(seval) if condition(seval) else None
+
+    if len(args) == 3:
+        condition, then, otherwise = [code_of(seval, arg) for arg in args]
+        return lambda seval: then(seval) if condition(seval) else otherwise(seval)
+
+    return None
+
+
+def compile_while(seval, expr, args):
+    if len(args) < 2:
+        return None
+
+    condition = code_of(seval, args[0])
+    body = [code_of(seval, arg) for arg in args[1:]]
+
+    def loop(seval):
+        res = None
+        while condition(seval):
+            for code in body:
+                res = code(seval)
+        return res
+
+    return loop
+
+
+def compile_and(seval, expr, args):
+    if not args:
+        return None
+
+    codes = [code_of(seval, arg) for arg in args]
+
+    def conjunction(seval):
+        for code in codes:
+            if not code(seval):
+                return False
+        return True
+
+    return conjunction
+
+
+def compile_or(seval, expr, args):
+    if not args:
+        return None
+
+    codes = [code_of(seval, arg) for arg in args]
+
+    def disjunction(seval):
+        for code in codes:
+            if code(seval):
+                return True
+        return False
+
+    return disjunction
+
+
+def compile_not(seval, expr, args):
+    if len(args) != 1:
+        return None
+
+    code = code_of(seval, args[0])
+
+    def negation(seval):
+        value = code(seval)
+        assert isinstance(value, int), wal_str([value])
+        return not value
+
+    return checked(expr, negation)
+
+
+def compile_eq(seval, expr, args):
+    if len(args) != 2:
+        return None
+
+    a, b = [code_of(seval, arg) for arg in args]
+
+    def equal(seval):
+        first = a(seval)
+        second = b(seval)
+        return first == first and second == first # pylint: disable=R0124
+
+    return equal
+
+
+def compile_neq(seval, expr, args):
+    equal = compile_eq(seval, expr, args)
+    if equal is None:
+        return None
+
+    return lambda seval: not equal(seval)
+
+
+def numeric(function):
+    '''Returns a compiler for operators on exactly two numbers'''
+    def compile_numeric(seval, expr, args):
+        if len(args) != 2:
+            return None
+
+        a, b = [code_of(seval, arg) for arg in args]
+
+        def apply(seval):
+            first = a(seval)
+            second = b(seval)
+            assert isinstance(first, (int, float)) and isinstance(second, (int, float))
+            return function(first, second)
+
+        return checked(expr, apply)
+
+    return compile_numeric
+
+
+def compile_add(seval, expr, args):
+    if len(args) != 2:
+        return None
+
+    a, b = [code_of(seval, arg) for arg in args]
+
+    def addition(seval):
+        first = a(seval)
+        second = b(seval)
+        if first.__class__ is int and second.__class__ is int:
+            return first + second
+        return add([first, second])
+
+    return addition
+
+
+def compile_let(seval, expr, args):
+    if len(args) < 2 or not isinstance(args[0], WList) or args[0].layout is None:
+        return None
+
+    layout = args[0].layout
+    names = []
+    for pair in args[0]:
+        if not isinstance(pair, WList) or len(pair) != 2 or not isinstance(pair[0], Symbol):
+            return None
+        names.append(pair[0].name)
+
+    # repeated names are redefinitions which op_let reports as errors
+    if len(set(names)) != len(names):
+        return None
+
+    bindings = [(layout[pair[0].name], code_of(seval, pair[1])) for pair in args[0]]
+    *codes, last = [code_of(seval, arg) for arg in args[1:]]
+    size = len(layout)
+
+    def let(seval):
+        save_env = seval.environment
+        frame = Frame(layout, [UNDEFINED] * size, save_env)
+        seval.environment = frame
+        slots = frame.slots
+        for index, code in bindings:
+            slots[index] = code(seval)
+
+        for code in codes:
+            code(seval)
+        res = last(seval)
+        seval.environment = save_env
+        return res
+
+    return let
+
+
+def compile_rel_eval(seval, expr, args):
+    if len(args) != 2:
+        return None
+
+    body = code_of(seval, args[0])
+    offset_code = code_of(seval, args[1])
+    stepping = seval.dispatch[Operator.REL_EVAL.value]
+    # whether args[0] can be read at an offset, checked again when traces or aliases change
+    analysis = [None, None, False]
+
+    def rel_eval(seval):
+        traces = seval.traces
+        if analysis[0] is not traces or analysis[1] != traces.epoch:
+            analysis[:] = [traces, traces.epoch, relocatable(seval, args[0])]
+
+        if not analysis[2]:
+            return stepping(seval, args)
+
+        offset = offset_code(seval)
+        assert isinstance(offset, int), 'reval: second argument must evaluate to int'
+        outer = seval.offset
+        offset += outer
+        for trace in traces.traces.values():
+            index = trace.index + offset
+            if index > trace.max_index or index < 0:
+                return False
+
+        # signals are read at the offset instead of stepping all traces there and back
+        seval.offset = offset
+        try:
+            return body(seval)
+        finally:
+            seval.offset = outer
+
+    return checked(expr, rel_eval)
+
+
+def compile_edge(seval, expr, args):
+    if len(args) != 1:
+        return None
+
+    head = expr[0]
+    step = -1 if head == Operator.CHANGED else 1
+    value = code_of(seval, args[0])
+    adjacent = code_of(seval, WList([Operator.REL_EVAL, args[0], step], line_info=expr.line_info))
+
+    # reval evaluates to false outside of the trace, the bounds only matter if this looks like an edge
+    if head == Operator.RISING:
+        return lambda seval: value(seval) == 0 and adjacent(seval) == 1
+
+    if head == Operator.FALLING:
+        return lambda seval: value(seval) == 1 and adjacent(seval) == 0
+
+    return lambda seval: value(seval) != adjacent(seval) and in_bounds(seval, -1)
+
+
+def compile_set(seval, expr, args):
+    if len(args) != 1 or not isinstance(args[0], WList) or len(args[0]) != 2:
+        return None
+
+    key, value = args[0]
+    if not isinstance(key, Symbol) or key.steps is None:
+        return None
+
+    name = key.name
+    depth = key.steps
+    index = key.index
+    code = code_of(seval, value)
+
+    def write(seval):
+        res = code(seval)
+        env = seval.environment
+        for _ in range(depth):
+            env = env.parent
+        if env.__class__ is Frame and index is not None:
+            env.slots[index] = res
+        else:
+            env.write_slot(index, name, res)
+        return res
+
+    return write
+
+
+SPECIALIZED = {
+    Operator.DO: compile_do,
+    Operator.IF: compile_if,
+    Operator.WHILE: compile_while,
+    Operator.AND: compile_and,
+    Operator.OR: compile_or,
+    Operator.NOT: compile_not,
+    Operator.EQ: compile_eq,
+    Operator.NEQ: compile_neq,
+    Operator.LARGER: numeric(lambda a, b: a > b),
+    Operator.SMALLER: numeric(lambda a, b: a < b),
+    Operator.LARGER_EQUAL: numeric(lambda a, b: a >= b),
+    Operator.SMALLER_EQUAL: numeric(lambda a, b: a <= b),
+    Operator.ADD: compile_add,
+    Operator.SUB: numeric(lambda a, b: a - b),
+    Operator.MUL: numeric(lambda a, b: a * b),
+    Operator.LET: compile_let,
+    Operator.REL_EVAL: compile_rel_eval,
+    Operator.RISING: compile_edge,
+    Operator.FALLING: compile_edge,
+    Operator.CHANGED: compile_edge,
+    Operator.SET: compile_set,
+}
+
+# operators of conditions whose common subexpressions are shared
+SHARING = {Operator.AND, Operator.OR, Operator.IF, Operator.EQ, Operator.NEQ}
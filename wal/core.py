@@ -1,14 +1,17 @@
 '''The WAL core module'''
 
+from contextlib import contextmanager
+
 from wal.trace.container import TraceContainer
 from wal.eval import SEval
 from wal.reader import read_wal_sexpr, read_wal_sexprs, ParseError
 from wal.ast_defs import Operator as Op
-from wal.ast_defs import Symbol as S
 from wal.ast_defs import UserOperator
 from wal.ast_defs import WList
 from wal.ast_defs import WalEvalError
 from wal.passes import expand, optimize, resolve
+from wal.snapshot import stdlib_snapshot
+from wal.profiler import Profile
 
 
 class Wal:
@@ -18,12 +21,11 @@ class Wal:
         self.traces = TraceContainer()
         self.eval_context = SEval(self.traces)
         self.eval_context.wal = self
-        self.eval_context.eval(WList([Op.EVAL_FILE, S('std/std')]))
-        self.eval_context.eval(WList([Op.EVAL_FILE, S('std/module')]))
+        stdlib_snapshot(self.eval_context).restore(self.eval_context)
 
-    def load(self, file, tid='DEFAULT', from_string=False, keep_signals=None):
+    def load(self, file, tid='DEFAULT', from_string=False, keep_signals=None, cache=True, lazy=False, jobs=1, cache_mb=None):
         '''Load trace from file and add it using id to WAL'''
-        self.traces.load(file, tid, from_string=from_string, keep_signals=keep_signals)
+        self.traces.load(file, tid, from_string=from_string, keep_signals=keep_signals, cache=cache, lazy=lazy, jobs=jobs, cache_mb=cache_mb)
 
     def step(self, steps=1, tid=None):
         '''Step one or all traces.
@@ -83,8 +85,7 @@ class Wal:
         res = None
         if sexpr:
             self.eval_context.reset()
-            self.eval_context.eval(WList([Op.EVAL_FILE, S('std/std')]))
-            self.eval_context.eval(WList([Op.EVAL_FILE, S('std/module')]))
+            stdlib_snapshot(self.eval_context).restore(self.eval_context)
 
             for name, val in args.items():
                 self.eval_context.global_environment.define(name, val)
@@ -102,6 +103,19 @@ class Wal:
             return self.eval(WList([Op.DO, *read_wal_sexprs(fin.read())]))
 
 
+    @contextmanager
+    def profile(self):
+        '''Profiles all WAL expressions evaluated inside of the with block.
+        with wal.profile() as profile:
+            wal.run_file('analysis.wal')
+        profile.print()'''
+        profile = Profile()
+        profile.start(self.eval_context)
+        try:
+            yield profile
+        finally:
+            profile.stop(self.eval_context)
+
     def register_operator(self, name, function):
         self.eval_context.global_environment.define(name, UserOperator(name))
         self.eval_context.user_dispatch[name] = function
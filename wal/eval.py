@@ -1,12 +1,14 @@
 '''S-Exprssion eval functions'''
 
 import os
-import wal
+from collections import Counter
 
-from importlib.resources import files
+import wal
 
 from wal.util import wal_str
-from wal.ast_defs import Operator, UserOperator, Symbol, Environment, Closure, Macro, WList, WalEvalError
+from wal.ast_defs import Operator, UserOperator, Symbol, Environment, Frame, UNDEFINED, Closure, Macro, WList, WalEvalError
+from wal.compiler import compile_expr
+from wal.passes import expand, expand_macro, unresolve
 from wal.implementation.types import type_operators
 from wal.implementation.math import math_operators
 from wal.implementation.bitwise import bitwise_operators
@@ -38,8 +40,17 @@ class SEval:
             **type_operators, **list_operators, **array_operators, \
             **wal_operators, **special_operators, **virtual_operators}
         self.user_dispatch = {}
-        initial_walpath = ['.', os.path.expanduser('~/.wal/libs/'), str(files(wal).joinpath('libs/'))]
+        initial_walpath = ['.', os.path.expanduser('~/.wal/libs/'), os.path.join(os.path.dirname(wal.__file__), 'libs/')]
         self.walpath = initial_walpath + os.getenv('WALPATH', '').split(';')
+        # number of evaluated and of reused macro expansions by macro name
+        self.macro_expansions = Counter()
+        self.macro_hits = Counter()
+        # profile that measures the evaluation, see wal.profiler
+        self.profile = None
+        # offset from the trace indices at which signals are read, see compile_rel_eval
+        self.offset = 0
+        # values of the common subexpressions of the expression being evaluated, see compile_shared
+        self.shared = None
 
     def reset(self):
         '''Resets all traces back to time 0 and resets all WAL elements (e.g. aliases, imports, ...) '''
@@ -75,6 +86,9 @@ class SEval:
 
     def eval_closure(self, closure, args):
         '''Evaluate a closure.'''
+        if closure.args.__class__ is WList and closure.args.layout is not None:
+            return self.call_closure(closure, [self.eval(val) for val in args])
+
         save_env = self.environment
         new_env = Environment(parent=closure.environment)
 
@@ -97,8 +111,46 @@ class SEval:
         self.environment = save_env
         return res
 
+    def call_closure(self, closure, values):
+        '''Calls a closure with a frame layout on already evaluated arguments'''
+        layout = closure.args.layout
+        assert len(closure.args) == len(values), f'{closure.name}: number of passed arguments does not match expected number'
+        if len(layout) > len(values):
+            values += [UNDEFINED] * (len(layout) - len(values))
+
+        save_env = self.environment
+        self.environment = Frame(layout, values, closure.environment)
+        try:
+            res = self.eval(closure.expression)
+        except WalEvalError as error:
+            error.add(closure.name)
+            raise error
+
+        self.environment = save_env
+        return res
+
+    def expand_call(self, macro, args):
+        '''Expands an application of macro that was not expanded before evaluation'''
+        # the arguments were resolved for the call site but the expansion can put them into new scopes
+        expanded = expand_macro(self, macro, unresolve(args), self.environment)
+        return expand(self, expanded, parent=self.environment)
+
     def eval(self, expr):
-        '''Main s-expression eval function'''
+        '''Main s-expression eval function, runs the compiled code of expr'''
+        if expr.__class__ is WList or expr.__class__ is Symbol:
+            return (expr.code or compile_expr(self, expr))(self)
+
+        return self.interpret(expr)
+
+    def eval_profiled(self, expr):
+        '''Replaces eval while profiling, runs the code of expr that measures itself'''
+        if expr.__class__ is WList or expr.__class__ is Symbol:
+            return (expr.profiled or compile_expr(self, expr))(self)
+
+        return self.interpret(expr)
+
+    def interpret(self, expr):
+        '''Evaluates expr by walking its tree'''
         res = NotImplementedError()
         try:
             if isinstance(expr, Symbol):
@@ -109,14 +161,12 @@ class SEval:
                 # this symbol was already resolved
                 if expr.steps is not None:
                     env = self.environment
-                    steps = expr.steps
-                    while steps > 0:
-                        env = self.environment.parent
-                        steps -= 1
+                    for _ in range(expr.steps):
+                        env = env.parent
 
-                    res = env.read(expr.name)
+                    res = env.read_slot(expr.index, expr.name)
                 elif self.traces.contains(name):  # if symbol is a signal from wavefile
-                    res = self.traces.signal_value(name, scope=self.scope)
+                    res = self.traces.signal_value(name, offset=self.offset, scope=self.scope)
                 else:
                     # this symbol has not been resolved
                     res = self.environment.read(name)
@@ -131,10 +181,14 @@ class SEval:
                 elif isinstance(head, UserOperator):
                     res = self.eval_user_dispatch(head, tail)
                 elif isinstance(head, Macro):
-                    expanded = self.eval(head.expression)
+                    expanded = self.expand_call(head, tail)
+                    if not isinstance(expanded, WList):
+                        return self.eval(expanded)
                     expr.clear()
                     for expression in expanded:
                         expr.append(expression)
+                    if isinstance(expr, WList):
+                        expr.code = None
                     res = self.eval(expr)
                 elif callable(expr[0]):
                     res = expr[0](*expr[1:])
@@ -5,10 +5,11 @@ import os
 import sys
 import importlib
 
-from wal.ast_defs import Operator, Symbol, Closure, Environment, Macro, Unquote, UnquoteSplice, WList
+from wal.ast_defs import Operator, Symbol, Closure, Environment, Frame, UNDEFINED, Macro, Unquote, UnquoteSplice, WList
 from wal.reader import read_wal_sexpr
 from wal.passes import expand, optimize, resolve
 from wal.util import wal_str
+from wal.trace.logic import LogicValue
 
 
 def op_not(seval, args):
@@ -77,7 +78,8 @@ def op_or(seval, args):
 def op_let(seval, args):
     assert isinstance(args[0], WList), 'let: expects a list of pairs as first argument'
     save_env = seval.environment
-    new_env = Environment(parent=save_env)
+    layout = args[0].layout
+    new_env = Environment(parent=save_env) if layout is None else Frame(layout, [UNDEFINED] * len(layout), save_env)
     seval.environment = new_env
 
     for pair in args[0]:
@@ -103,20 +105,13 @@ def op_set(seval, args):
         # this signal was already resolved
         if key.steps is not None:
             defined_at = seval.environment
-            steps = key.steps
-            while steps > 0:
-                defined_at = seval.environment.parent
-                steps -= 1
+            for _ in range(key.steps):
+                defined_at = defined_at.parent
 
-            # get the dict out of the environment
-            defined_at = defined_at.environment
+            defined_at.write_slot(key.index, key.name, res)
         else:
-            defined_at = seval.environment.is_defined(key.name)
-
-        if defined_at:
-            defined_at[key.name] = res
-        else:
-            assert False, f'Write to undefined symbol {key.name}'
+            assert seval.environment.is_defined(key.name), f'Write to undefined symbol {key.name}'
+            seval.environment.write(key.name, res)
 
     return res
 
@@ -215,6 +210,7 @@ def op_alias(seval, args):
         name = name.name
 
     seval.aliases[args[0].name] = name
+    seval.traces.invalidate()
 
 
 def op_unalias(seval, args):
@@ -223,6 +219,7 @@ def op_unalias(seval, args):
         assert isinstance(arg, Symbol), 'unalias: argument must be a symbol'
         assert arg.name in seval.aliases, f'unalias: no alias {arg.name} known. Can\'t unalias'
         del seval.aliases[arg.name]
+        seval.traces.invalidate()
 
 
 def op_quote(seval, args):  # pylint: disable=W0613
@@ -371,6 +368,9 @@ def op_rel_eval(seval, args):
     assert isinstance(args[0], (Symbol, int, str, WList, list, float)), 'reval: first argument must be a valid expression'
     offset = seval.eval(args[1])
     assert isinstance(offset, int), 'reval: second argument must evaluate to int'
+    # signals may already be read at an offset, see compile_rel_eval
+    outer = seval.offset
+    offset += outer
     # check if any trace becomes oob with offset
     for trace in seval.traces.traces.values():
         if trace.index + offset > trace.max_index or trace.index + offset < 0:
@@ -378,8 +378,12 @@ def op_rel_eval(seval, args):
 
     seval.traces.store_indices()
     seval.traces.step(offset)
-    res = seval.eval(args[0])
-    seval.traces.restore_indices()
+    seval.offset = 0
+    try:
+        res = seval.eval(args[0])
+    finally:
+        seval.offset = outer
+        seval.traces.restore_indices()
     return res
 
 
@@ -547,7 +551,13 @@ def op_slice(seval, args):
     evaluated = seval.eval_args(args)
     assert isinstance(evaluated[0], (int, WList, list, str)), 'slice: first argument must evaluate to a number or a list'
 
-    if isinstance(evaluated[0], int):
+    if isinstance(evaluated[0], LogicValue):
+        assert all(isinstance(index, int) for index in evaluated[1:]), 'slice: indices must evaluate to int'
+        if len(args) == 2:
+            return evaluated[0].bit(evaluated[1])
+
+        return evaluated[0].slice(evaluated[1], evaluated[2])
+    elif isinstance(evaluated[0], int):
         if len(args) == 2: # pylint: disable=R1705
             index = evaluated[1]
             assert isinstance(index, int), 'slice: index must evaluate to int'
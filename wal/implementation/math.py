@@ -8,7 +8,11 @@ from wal.ast_defs import Operator, WList
 
 
 def op_add(seval, args):
-    evaluated = seval.eval_args(args)
+    return add(seval.eval_args(args))
+
+
+def add(evaluated):
+    '''Adds numbers or concatenates lists and strings'''
     if any(map(lambda x: isinstance(x, (WList, list)), evaluated)):
         res = []
         for item in evaluated:
@@ -1,5 +1,164 @@
 '''Implementations for special hardware related functions'''
+from bisect import bisect_left, bisect_right
+
 from wal.ast_defs import Operator, Symbol, WList
+from wal.passes import never_fails, signal_dependencies
+from wal.implementation.core import op_rel_eval
+
+
+def condition_ranges(seval, condition, allow_variables=True):
+    '''Returns the sorted half-open ranges of indices from the current index on in which condition is true.
+    Returns None if the signals read by the condition can not be determined.'''
+    trace = indexed_trace(seval, condition, allow_variables)
+    if trace is None:
+        return None
+
+    return true_ranges(seval, trace, condition, [(trace.index, trace.max_index + 1)])
+
+
+def indexed_trace(seval, condition, allow_variables=True):
+    '''Returns the trace in which condition is evaluated if the indices at which
+    the value of condition can change are known. Returns None otherwise.'''
+    if seval.traces.n_traces != 1:
+        return None
+
+    dependencies = signal_dependencies(seval, condition)
+    if dependencies is None:
+        return None
+
+    signals, _, variables = dependencies
+    if variables and not allow_variables:
+        return None
+
+    trace = next(iter(seval.traces.traces.values()))
+    if any(trace.change_points(name) is None for name, _ in signals):
+        return None
+
+    return trace
+
+
+def true_ranges(seval, trace, condition, ranges, vectorize=True):
+    '''Returns the parts of ranges in which condition is true.
+    The condition is only evaluated at the indices at which its value can change.
+    Vectorization converts whole signals, it does not pay off for small ranges.'''
+    # vectorization imports numpy which is only worth it once a condition is searched
+    from wal.vectorize import vector_ranges # pylint: disable=C0415
+
+    found = vector_ranges(seval, trace, condition, ranges) if vectorize else None
+    if found is None:
+        found = edge_ranges(seval, trace, condition, ranges)
+    if found is not None:
+        return found
+
+    if isinstance(condition, WList) and len(condition) > 2 and condition[0] == Operator.AND:
+        # conjuncts that can not fail are checked first, starting with the least active one,
+        # all other conjuncts are only evaluated where all conjuncts before them are true
+        conjuncts = condition[1:]
+        total = sorted((c for c in conjuncts if never_fails(seval, c)), key=lambda c: activity(seval, trace, c))
+        conjuncts = total + [c for c in conjuncts if not never_fails(seval, c)]
+        for conjunct in conjuncts:
+            ranges = true_ranges(seval, trace, conjunct, ranges, vectorize)
+            if not ranges:
+                break
+
+        return ranges
+
+    signals, offsets, _ = signal_dependencies(seval, condition)
+    end = trace.max_index
+    found = []
+    for low, high in ranges:
+        points = {low}
+        # reval evaluates to false when its offset leaves the trace
+        for offset in offsets:
+            points.update((-offset, end - offset + 1))
+
+        for name, offset in signals:
+            indices = trace.change_points(name)
+            first = bisect_right(indices, low + offset)
+            last = bisect_left(indices, high + offset)
+            points.update(index - offset for index in indices[first:last])
+
+        points = sorted(point for point in points if low <= point < high)
+        for point, next_point in zip(points, points[1:] + [high]):
+            trace.index = point
+            if seval.eval(condition):
+                if found and found[-1][1] == point:
+                    found[-1] = (found[-1][0], next_point)
+                else:
+                    found.append((point, next_point))
+
+    return found
+
+
+def edge_ranges(seval, trace, condition, ranges):
+    '''Returns the parts of ranges in which an edge of a single signal is found.
+    The edges are enumerated from the change list of the signal without evaluating the condition.
+    Returns None if condition is not an edge of a signal with a known change list.'''
+    if not ranges or not isinstance(condition, WList) or len(condition) != 2 \
+       or not isinstance(condition[0], Operator) or condition[0] not in EDGES:
+        return None
+
+    signal = condition[1]
+    if not isinstance(signal, Symbol) or signal.steps is not None:
+        return None
+
+    name = seval.aliases.get(signal.name, signal.name)
+    changes = trace.change_list(seval.traces.locate(name)[1]) if seval.traces.recorded(name) else None
+    if changes is None:
+        return None
+
+    head = condition[0]
+    before, after = EDGES[head]
+    # rising and falling are true at the index before the change
+    shift = 0 if head == Operator.CHANGED else 1
+    first = max(bisect_left(changes.indices, ranges[0][0] + shift), 1)
+    last = bisect_left(changes.indices, min(ranges[-1][1] + shift, trace.max_index + 1))
+    indices = []
+    for position in range(first, last):
+        index = changes.indices[position]
+        previous, value = changes.value(position - 1), changes.value(position)
+        if head == Operator.CHANGED:
+            if previous != value:
+                indices.append(index)
+        elif previous == before and value == after:
+            indices.append(index - 1)
+
+    # reval evaluates to false after the last index, which compares equal to 0
+    if head == Operator.FALLING and ranges[-1][1] > trace.max_index:
+        position = bisect_right(changes.indices, trace.max_index) - 1
+        if position >= 0 and changes.value(position) == before:
+            indices.append(trace.max_index)
+
+    found = []
+    for low, high in ranges:
+        for index in indices[bisect_left(indices, low):bisect_left(indices, high)]:
+            if found and found[-1][1] == index:
+                found[-1] = (found[-1][0], index + 1)
+            else:
+                found.append((index, index + 1))
+
+    return found
+
+
+def activity(seval, trace, condition):
+    '''Returns the number of changes of all signals read by condition'''
+    return sum(len(trace.change_points(name)) for name, _ in signal_dependencies(seval, condition)[0])
+
+
+def whenever_in_ranges(seval, trace, ranges, body):
+    '''Evaluates body at all indices in ranges.
+    Returns the result of the last body and false if the body moved or trimmed the trace.'''
+    res = None
+    end = trace.max_index
+    for low, high in ranges:
+        for index in range(low, high):
+            trace.index = index
+            res = seval.eval_args(body)[-1]
+            if trace.index != index or trace.max_index != end:
+                return res, False
+
+    return res, True
+
 
 def op_find(seval, args):
     '''Find
@@ -11,11 +170,15 @@ def op_find(seval, args):
     found = []
     for trace in seval.traces.traces.values():
         start_index = trace.index # store current index
-        ended = False
-        while not ended:
-            if seval.eval(args[0]):
-                found.append(trace.index)
-            ended = trace.step()
+        ranges = condition_ranges(seval, args[0])
+        if ranges is not None:
+            found += [index for low, high in ranges for index in range(low, high)]
+        else:
+            ended = False
+            while not ended:
+                if seval.eval(args[0]):
+                    found.append(trace.index)
+                ended = trace.step()
 
         trace.index = start_index # reset trace index
 
@@ -34,7 +197,12 @@ def op_find_g(seval, args):
 
     prev_indices = seval.traces.indices()
     found = []
+    ranges = condition_ranges(seval, args[0])
     ended = []
+    if ranges is not None:
+        found = [index for low, high in ranges for index in range(low, high)]
+        ended = True
+
     while not ended:
         if seval.eval(args[0]):
             indices = seval.traces.indices()
@@ -48,6 +216,76 @@ def op_find_g(seval, args):
     return found
 
 
+def seek(seval, condition, offset, direction):
+    '''Returns the first index at which condition is true, searching from the current
+    index + offset in direction (1 or -1). Returns false if there is no such index.'''
+    assert seval.traces.traces, 'no traces loaded'
+    prev_indices = seval.traces.indices()
+    try:
+        trace = indexed_trace(seval, condition)
+        if trace is not None:
+            return seek_ranges(seval, trace, condition, trace.index + offset, direction)
+
+        ended = seval.traces.step(offset) if offset else []
+        while not ended:
+            if seval.eval(condition):
+                indices = seval.traces.indices()
+                return indices if len(indices) > 1 else trace_index(indices)
+            ended = seval.traces.step(direction)
+
+        return False
+    finally:
+        for trace in seval.traces.traces.values():
+            trace.index = prev_indices[trace.tid]
+
+
+def trace_index(indices):
+    '''Returns the only index in indices'''
+    return next(iter(indices.values()))
+
+
+def seek_ranges(seval, trace, condition, start, direction):
+    '''Searches condition from start on in direction (1 or -1) in windows of growing size,
+    such that the search ends shortly after the first index at which condition is true.'''
+    size = SEEK_WINDOW
+    if direction > 0:
+        end = trace.max_index + 1
+        while start < end:
+            found = true_ranges(seval, trace, condition, [(start, min(start + size, end))], size >= VECTOR_WINDOW)
+            if found:
+                return found[0][0]
+            start += size
+            size *= 2
+    else:
+        start += 1
+        while start > 0:
+            found = true_ranges(seval, trace, condition, [(max(start - size, 0), start)], size >= VECTOR_WINDOW)
+            if found:
+                return found[-1][1] - 1
+            start -= size
+            size *= 2
+
+    return False
+
+
+def op_find_first(seval, args):
+    '''Returns the first index from the current index on at which the condition is true'''
+    assert len(args) == 1, 'find-first: expects exactly one argument (find-first condition)'
+    return seek(seval, args[0], 0, 1)
+
+
+def op_find_next(seval, args):
+    '''Returns the first index after the current index at which the condition is true'''
+    assert len(args) == 1, 'find-next: expects exactly one argument (find-next condition)'
+    return seek(seval, args[0], 1, 1)
+
+
+def op_find_prev(seval, args):
+    '''Returns the last index before the current index at which the condition is true'''
+    assert len(args) == 1, 'find-prev: expects exactly one argument (find-prev condition)'
+    return seek(seval, args[0], -1, -1)
+
+
 def op_whenever(seval, args):
     '''Evaluates body at each index at which condition evaluate to true '''
     assert len(args) >= 2, 'whenever: expects exactly two arguments (whenever condition body)'
@@ -56,6 +294,14 @@ def op_whenever(seval, args):
 
     res = None
     ended = []
+    # the body might change variables read by the condition
+    ranges = condition_ranges(seval, args[0], allow_variables=False)
+    if ranges is not None:
+        res, ended = whenever_in_ranges(seval, next(iter(seval.traces.traces.values())), ranges, args[1:])
+        # continue by stepping if the body moved the trace
+        if not ended:
+            ended = seval.traces.step()
+
     while not ended:
         if seval.eval(args[0]):
             res = seval.eval_args(args[1:])[-1]
@@ -68,6 +314,86 @@ def op_whenever(seval, args):
     return res
 
 
+def in_bounds(seval, offset):
+    '''Checks if all traces can be read at offset from the index at which signals are read'''
+    offset += seval.offset
+    for trace in seval.traces.traces.values():
+        index = trace.index + offset
+        if index < 0 or index > trace.max_index:
+            return False
+
+    return True
+
+
+def op_rising(seval, args):
+    '''Returns true if the value of expr is 0 at the current index and 1 at the next index'''
+    assert len(args) == 1, 'rising: expects exactly one argument (rising expr)'
+    # reval evaluates to false if the next index is outside of the trace
+    return seval.eval(args[0]) == 0 and op_rel_eval(seval, [args[0], 1]) == 1
+
+
+def op_falling(seval, args):
+    '''Returns true if the value of expr is 1 at the current index and 0 at the next index'''
+    assert len(args) == 1, 'falling: expects exactly one argument (falling expr)'
+    # like the falling macro, this is true at the last index if the value is 1
+    return seval.eval(args[0]) == 1 and op_rel_eval(seval, [args[0], 1]) == 0
+
+
+def op_changed(seval, args):
+    '''Returns true if the value of expr at the current index differs from its value at the previous index'''
+    assert len(args) == 1, 'changed?: expects exactly one argument (changed? expr)'
+    return seval.eval(args[0]) != op_rel_eval(seval, [args[0], -1]) and in_bounds(seval, -1)
+
+
+def change_index(seval, expr, direction):
+    '''Returns the closest index in direction (1 or -1) from the current index
+    at which the value of expr changes. Returns false if there is no such index.'''
+    assert seval.traces.traces, 'no traces loaded'
+    name = seval.aliases.get(expr.name, expr.name) if isinstance(expr, Symbol) and expr.steps is None else None
+    if name is not None and seval.traces.recorded(name):
+        trace, signal = seval.traces.locate(name)
+        points = trace.change_points(signal)
+        if points is not None:
+            index = trace.index + seval.offset
+            if direction > 0:
+                position = bisect_right(points, index)
+                return points[position] if position < len(points) and points[position] <= trace.max_index else False
+
+            # the first change point is the start of the trace
+            position = bisect_left(points, index) - 1
+            return points[position] if position > 0 else False
+
+    # all other expressions are evaluated index by index until their value changes
+    index = next(iter(seval.traces.traces.values())).index + seval.offset
+    # only changes strictly before the current index are searched backwards
+    offset = min(direction, 0)
+    if not in_bounds(seval, offset):
+        return False
+
+    value = op_rel_eval(seval, [expr, offset])
+    while in_bounds(seval, offset + direction):
+        adjacent = op_rel_eval(seval, [expr, offset + direction])
+        if adjacent != value:
+            # a change is at the later one of the two compared indices
+            return index + max(offset, offset + direction)
+        offset += direction
+        value = adjacent
+
+    return False
+
+
+def op_next_change(seval, args):
+    '''Returns the next index after the current index at which the value of expr changes'''
+    assert len(args) == 1, 'next-change: expects exactly one argument (next-change expr)'
+    return change_index(seval, args[0], 1)
+
+
+def op_prev_change(seval, args):
+    '''Returns the last index before the current index at which the value of expr changed'''
+    assert len(args) == 1, 'prev-change: expects exactly one argument (prev-change expr)'
+    return change_index(seval, args[0], -1)
+
+
 def op_fold_signal(seval, args):
     '''Performs a fold operation on the values of signal from index INDEX
     until the stop condition evaluates to true. '''
@@ -139,9 +465,24 @@ def op_trim_trace(seval, args):
 special_operators = {
     Operator.FIND.value: op_find,
     Operator.FIND_G.value: op_find_g,
+    Operator.FIND_FIRST.value: op_find_first,
+    Operator.FIND_NEXT.value: op_find_next,
+    Operator.FIND_PREV.value: op_find_prev,
     Operator.WHENEVER.value: op_whenever,
     Operator.FOLD_SIGNAL.value: op_fold_signal,
     Operator.SIGNAL_WIDTH.value: op_signal_width,
     Operator.SAMPLE_AT.value: op_sample_at,
     Operator.TRIM_TRACE.value: op_trim_trace,
+    Operator.RISING.value: op_rising,
+    Operator.FALLING.value: op_falling,
+    Operator.CHANGED.value: op_changed,
+    Operator.NEXT_CHANGE.value: op_next_change,
+    Operator.PREV_CHANGE.value: op_prev_change,
 }
+
+# number of indices searched by seek before the windows grow
+SEEK_WINDOW = 16
+# windows from this size on are searched by vectorized evaluation
+VECTOR_WINDOW = 1 << 14
+# values before and after the change of the signal of an edge
+EDGES = {Operator.RISING: (0, 1), Operator.FALLING: (1, 0), Operator.CHANGED: (None, None)}
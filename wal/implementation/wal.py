@@ -2,9 +2,7 @@
 import os
 
 from wal.ast_defs import Operator, Symbol, WList
-from wal.util import wal_decode
-from wal.reader import read_wal_sexprs
-from wal.passes import expand, optimize, resolve
+from wal.wo import eval_wal_file, eval_wo_file, stale
 from wal.repl import WalRepl
 
 
@@ -82,23 +80,14 @@ def op_eval_file(seval, args):
 
             return False
 
-        sexprs = None
-        if name := wal_file_exists(module + '.wo'):
-            sexprs = wal_decode(name)
+        if (name := wal_file_exists(module + '.wo')) and not stale(name):
+            eval_wo_file(seval, name)
         elif name := wal_file_exists(module + '.wal'):
-            with open(name, 'r', encoding='utf-8') as file:
-                sexprs = read_wal_sexprs(file.read(), name)
+            eval_wal_file(seval, name)
         else:
             print(f'require: cant find file {module}.wal')
             raise FileNotFoundError
 
-        if sexprs:
-            for sexpr in sexprs:
-                expanded = expand(seval, sexpr, parent=seval.global_environment)
-                optimized = optimize(expanded)
-                resolved = resolve(optimized, start=seval.global_environment.environment)
-                seval.eval(resolved)
-
 
 def op_require(seval, args):
     'Make bindings from a module available in current scope'
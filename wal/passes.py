@@ -1,7 +1,7 @@
 '''WAL Interpreter Passes '''
 from math import prod
 
-from wal.ast_defs import Operator, Symbol, Macro, Environment, WList
+from wal.ast_defs import Operator, Symbol, Closure, Macro, Environment, Unquote, UnquoteSplice, WList
 from wal.util import wal_str
 
 
@@ -15,6 +15,245 @@ def recursive_set_line_info(expr, line_info):
     return expr
 
 
+class ArgumentRef:
+    '''Placeholder for a part of the argument forms in a cached macro expansion'''
+
+    def __init__(self, path):
+        # indices leading from the argument forms to the referenced form, None selects unquoted content
+        self.path = path
+
+
+def form_key(expr):
+    '''Returns a hashable key that is equal for structurally equal forms
+    or None if expr contains values that can not be compared structurally'''
+    cls = expr.__class__
+    if cls is WList or cls is list:
+        key = [list]
+        for sub in expr:
+            sub_key = form_key(sub)
+            if sub_key is None:
+                return None
+            key.append(sub_key)
+        return tuple(key)
+
+    if cls is Symbol:
+        return (Symbol, expr.name, expr.steps, expr.index)
+
+    if cls is Unquote or cls is UnquoteSplice:
+        content = form_key(expr.content)
+        return None if content is None else (cls, content)
+
+    if expr is None or cls in (int, float, str, bool, Operator):
+        return (cls, expr)
+
+    return None
+
+
+def form_paths(expr, path, paths):
+    '''Maps the ids of all lists and symbols in expr to their path'''
+    if isinstance(expr, (WList, list, Symbol, Unquote, UnquoteSplice)):
+        paths.setdefault(id(expr), path)
+
+    if isinstance(expr, (WList, list)):
+        for i, sub in enumerate(expr):
+            form_paths(sub, path + (i,), paths)
+    elif isinstance(expr, (Unquote, UnquoteSplice)):
+        form_paths(expr.content, path + (None,), paths)
+
+
+def template(expr, paths):
+    '''Copies the expansion expr and replaces all forms that were passed to the macro by references'''
+    path = paths.get(id(expr))
+    if path is not None:
+        return ArgumentRef(path)
+
+    if isinstance(expr, WList):
+        return WList([template(sub, paths) for sub in expr], line_info=expr.line_info)
+
+    if isinstance(expr, list):
+        return [template(sub, paths) for sub in expr]
+
+    if isinstance(expr, (Unquote, UnquoteSplice)):
+        return expr.__class__(template(expr.content, paths))
+
+    return expr
+
+
+def instantiate(seval, expr, args, gensyms, renames):
+    '''Copies the cached expansion expr for the argument forms args.
+    Symbols in gensyms were created by gensym during the expansion and are replaced by fresh ones.'''
+    cls = expr.__class__
+    if cls is ArgumentRef:
+        for step in expr.path:
+            args = args.content if step is None else args[step]
+        return args
+
+    if cls is WList:
+        return WList([instantiate(seval, sub, args, gensyms, renames) for sub in expr], line_info=expr.line_info)
+
+    if cls is list:
+        return [instantiate(seval, sub, args, gensyms, renames) for sub in expr]
+
+    if cls is Symbol:
+        name = expr.name
+        if name in gensyms:
+            if name not in renames:
+                seval.gensymi += 1
+                renames[name] = f'${seval.gensymi}'
+            name = renames[name]
+        return Symbol(name, expr.steps, expr.line_info, expr.index)
+
+    if cls is Unquote or cls is UnquoteSplice:
+        return cls(instantiate(seval, expr.content, args, gensyms, renames))
+
+    return expr
+
+
+def unquoted(expr):
+    '''Yields the contents of all unquotes in the quasiquoted expr'''
+    if isinstance(expr, (Unquote, UnquoteSplice)):
+        yield expr.content
+    elif isinstance(expr, (WList, list)):
+        for sub in expr:
+            yield from unquoted(sub)
+
+
+def argument_only(seval, expr, bound, functions):
+    '''Returns true if evaluating expr has no side effects and only reads the variables in bound
+    or global functions that are argument only themselves. These functions are added to functions.'''
+    if isinstance(expr, Symbol):
+        name = expr.name
+        if name in bound or name in functions:
+            return True
+
+        env = seval.global_environment
+        function = env.read(name) if env.is_defined(name) else None
+        if not isinstance(function, Closure) or function.environment is not env:
+            return False
+
+        functions[name] = function
+        params = [function.args] if isinstance(function.args, Symbol) else function.args
+        return argument_only(seval, function.expression, {param.name for param in params}, functions)
+
+    if isinstance(expr, (WList, list)):
+        if not expr:
+            return True
+
+        head = expr[0]
+        if head == Operator.QUOTE:
+            return True
+
+        if head == Operator.QUASIQUOTE:
+            return all(argument_only(seval, sub, bound, functions) for sub in unquoted(expr[1:]))
+
+        if head == Operator.DO:
+            return argument_only_body(seval, expr[1:], set(bound), functions)
+
+        if head == Operator.LET:
+            scope = set(bound)
+            for pair in expr[1]:
+                if not isinstance(pair, WList) or len(pair) != 2 or not isinstance(pair[0], Symbol):
+                    return False
+                if not argument_only(seval, pair[1], scope, functions):
+                    return False
+                scope.add(pair[0].name)
+            return argument_only_body(seval, expr[2:], scope, functions)
+
+        if head == Operator.FN:
+            params = [expr[1]] if isinstance(expr[1], Symbol) else expr[1]
+            if not all(isinstance(param, Symbol) for param in params):
+                return False
+            return argument_only_body(seval, expr[2:], bound | {param.name for param in params}, functions)
+
+        if isinstance(head, Operator):
+            return head in MACRO_OPERATORS and all(argument_only(seval, arg, bound, functions) for arg in expr[1:])
+
+        # calls of local or global functions
+        return all(argument_only(seval, sub, bound, functions) for sub in expr)
+
+    return expr is None or isinstance(expr, (int, float, str))
+
+
+def argument_only_body(seval, body, scope, functions):
+    '''Like argument_only for the sequence of expressions body that can define variables in scope'''
+    last = body[-1] if body else None
+    if isinstance(last, WList) and last and last[0] == Operator.EXIT:
+        # the macro exits before it returns an expansion, e.g. after printing an error
+        return True
+
+    for expr in body:
+        if isinstance(expr, WList) and expr and expr[0] == Operator.DEFINE:
+            if len(expr) != 3 or not isinstance(expr[1], Symbol) or not argument_only(seval, expr[2], scope, functions):
+                return False
+            scope.add(expr[1].name)
+        elif not argument_only(seval, expr, scope, functions):
+            return False
+
+    return True
+
+
+def defines(env, functions):
+    '''Returns true if all functions are visible under their names from env'''
+    return env is not None and all(env.is_defined(name) and env.read(name) is function for name, function in functions.items())
+
+
+def memoizable(seval, macro, parent):
+    '''Returns true if the expansion of macro at parent depends only on its arguments.
+    This is the case if the body of the macro has no side effects and only reads its arguments,
+    its local variables and global functions with the same property. The analysis is repeated
+    and all cached expansions are dropped when one of these functions is redefined.'''
+    functions = macro.functions
+    if functions and not defines(seval.global_environment, functions):
+        macro.expansions.clear()
+        functions = None
+
+    if functions is None:
+        params = [macro.args] if isinstance(macro.args, Symbol) else macro.args
+        functions = {}
+        if not argument_only(seval, macro.expression, {param.name for param in params}, functions):
+            functions = False
+        macro.functions = functions
+
+    # local variables of the call site can shadow global functions
+    return functions is not False and (not functions or defines(parent, functions))
+
+
+def expand_macro(seval, macro, vals, parent):
+    '''Applies macro to the argument forms vals and returns the expansion.
+    The expansions of macros that depend only on their arguments are cached on the macro
+    by the structure of the argument forms and copied when they are reused.'''
+    key = form_key(vals) if memoizable(seval, macro, parent) else None
+    if key is not None and key in macro.expansions:
+        seval.macro_hits[macro.name] += 1
+        expansion, gensyms = macro.expansions[key]
+        return instantiate(seval, expansion, vals, gensyms, {})
+
+    macro_env = Environment(parent=parent)
+    if isinstance(macro.args, Symbol):
+        macro_env.define(macro.args.name, vals)
+    elif isinstance(macro.args, WList):
+        assert len(macro.args) == len(vals), f'{macro.name}: number of passed arguments does not match expected number'
+        for arg, val in zip(macro.args, vals):
+            macro_env.define(arg.name, val)
+    else:
+        assert False, f'cannot evaluate {wal_str(macro)}'
+
+    save_env = seval.environment
+    seval.environment = macro_env
+    first_gensym = seval.gensymi
+    expanded = seval.eval(macro.expression)
+    seval.environment = save_env
+    seval.macro_expansions[macro.name] += 1
+
+    if key is not None:
+        paths = {}
+        form_paths(vals, (), paths)
+        gensyms = frozenset(f'${i}' for i in range(first_gensym + 1, seval.gensymi + 1))
+        macro.expansions[key] = (template(expanded, paths), gensyms)
+
+    return expanded
+
+
 def expand(seval, exprs, parent=None):
     '''Macroexpansion Pass'''
     if isinstance(exprs, (WList, list)):
@@ -23,32 +262,21 @@ def expand(seval, exprs, parent=None):
         if len(exprs) > 0 and isinstance(exprs[0], Symbol) and seval.environment.is_defined(exprs[0].name):
             expr = seval.environment.read(exprs[0].name)
             if isinstance(expr, Macro):
-                macro_env = Environment(parent=parent)
-                vals = exprs[1:]
-
-                if isinstance(expr.args, Symbol):
-                    macro_env.define(expr.args.name, vals)
-                elif isinstance(expr.args, WList):
-                    assert len(expr.args) == len(vals), f'{expr.name}: number of passed arguments does not match expected number'
-                    for arg, val in zip(expr.args, vals):
-                        macro_env.define(arg.name, val)
-                else:
-                    assert False, f'cannot evaluate {wal_str(expr)}'
-
-                save_env = seval.environment
-                seval.environment = macro_env
-                expanded = seval.eval(expr.expression)
-                expanded.line_info = exprs[0].line_info
+                expanded = expand_macro(seval, expr, exprs[1:], parent)
+                if isinstance(expanded, (WList, Symbol)):
+                    expanded.line_info = exprs[0].line_info
                 expanded = expand(seval, expanded, parent)
 
-                seval.environment = save_env
-
                 if isinstance(expanded, WList):
                     exprs.clear()
                     for expr in expanded:
                         exprs.append(expr)
-                else:
-                    return expanded
+                    if isinstance(exprs, WList):
+                        exprs.code = None
+                        # the expansion is already fully expanded
+                        return exprs
+
+                return expanded
 
 
         line_info = exprs.line_info if isinstance(exprs, WList) else None
@@ -57,6 +285,20 @@ def expand(seval, exprs, parent=None):
     return exprs
 
 
+def unresolve(expr):
+    '''Copies expr without the resolution of its symbols, such that it can be moved into other scopes'''
+    if isinstance(expr, WList):
+        return WList([unresolve(sub) for sub in expr], line_info=expr.line_info)
+
+    if isinstance(expr, list):
+        return [unresolve(sub) for sub in expr]
+
+    if isinstance(expr, Symbol) and expr.steps is not None:
+        return Symbol(expr.name, line_info=expr.line_info)
+
+    return expr
+
+
 def optimize(expr):
     '''Optimization Pass'''
     try:
@@ -120,6 +362,17 @@ def optimize(expr):
 def resolve(expr, start={}):
     '''Variable environment resolution pass '''
     scopes=[None, dict(start)]
+
+    def define(name):
+        scopes[-1][name] = len(scopes[-1])
+
+    def with_layout(names, layout):
+        if not isinstance(names, WList):
+            return names
+        names = WList(names.data, line_info=names.line_info)
+        names.layout = layout
+        return names
+
     def resolve_vars(expr):
         if isinstance(expr, WList) and len(expr) > 0:
             op = expr[0]
@@ -127,17 +380,17 @@ def resolve(expr, start={}):
                 id = expr[1]
                 assert id.name not in scopes[-1], f'symbol {id} already defined'
                 body = resolve_vars(expr[2])
-                scopes[-1][expr[1].name] = True
+                define(expr[1].name)
                 return WList([Operator.DEFINE, id, body], line_info=expr.line_info)
             elif op == Operator.LET:
                 env = {}
                 scopes.append(env)
                 for binding in expr[1]:
-                    env[binding[0].name] = True
+                    env.setdefault(binding[0].name, len(env))
 
                 body = [resolve_vars(sub) for sub in expr[2:]]
                 scopes.pop()
-                return WList([Operator.LET, expr[1], *body], line_info=expr.line_info)
+                return WList([Operator.LET, with_layout(expr[1], env), *body], line_info=expr.line_info)
             elif op == Operator.FN:
                 args = expr[1]
                 env = {}
@@ -145,17 +398,20 @@ def resolve(expr, start={}):
                 if isinstance(args, (WList, list)):
                     for arg in expr[1]:
                         assert isinstance(arg, Symbol), 'fn: parameters must be symbols'
-                        env[arg.name] = True
+                        env.setdefault(arg.name, len(env))
                 elif isinstance(args, Symbol):
-                    env[args.name] = True
+                    env[args.name] = 0
                 else:
                     assert False, 'fn: first argument must be a list or a symbol'
 
                 body = [resolve_vars(sub) for sub in expr[2:]]
                 scopes.pop()
-                return WList([Operator.FN, expr[1], *body])
+                # parameters are assigned to slots by position, so they must be unique
+                if isinstance(args, (WList, list)) and len(set(arg.name for arg in args)) == len(args):
+                    args = with_layout(args, env)
+                return WList([Operator.FN, args, *body])
             elif op == Operator.DEFMACRO:
-                scopes[-1][expr[1].name] = True
+                define(expr[1].name)
                 return expr
             elif op in [Operator.QUOTE, Operator.QUASIQUOTE, Operator.ALIAS]:
                 return expr
@@ -168,6 +424,9 @@ def resolve(expr, start={}):
                 steps += 1
 
             if scopes[-steps-1]:
+                # variables of fn and let are stored in frames, global variables by name
+                if len(scopes) - steps - 1 > 1:
+                    return Symbol(expr.name, steps, index=scopes[-steps-1][id])
                 return Symbol(expr.name, steps)
             else:
                 # if the symbol is not defined it still can be a signal
@@ -179,3 +438,183 @@ def resolve(expr, start={}):
 
     return(resolve_vars(expr))
 
+
+
+# operators that read no state besides their arguments and have no side effects
+PURE_OPERATORS = set([
+    Operator.ADD, Operator.SUB, Operator.MUL, Operator.DIV, Operator.EXP,
+    Operator.FLOOR, Operator.CEIL, Operator.ROUND, Operator.MOD,
+    Operator.BOR, Operator.BAND, Operator.BXOR,
+    Operator.NOT, Operator.EQ, Operator.NEQ, Operator.LARGER, Operator.SMALLER,
+    Operator.LARGER_EQUAL, Operator.SMALLER_EQUAL, Operator.AND, Operator.OR,
+    Operator.IF, Operator.SLICE, Operator.SIGNAL_WIDTH,
+    Operator.IS_ATOM, Operator.IS_SYMBOL, Operator.IS_STRING, Operator.IS_INT, Operator.IS_LIST,
+    Operator.CONVERT_BINARY, Operator.STRING_TO_INT, Operator.BITS_TO_SINT, Operator.INT_TO_STRING
+])
+
+
+# operators that macros can use to build their expansions from their arguments
+MACRO_OPERATORS = (PURE_OPERATORS - {Operator.SIGNAL_WIDTH}) | set([
+    Operator.GENSYM, Operator.LIST, Operator.FIRST, Operator.SECOND, Operator.LAST, Operator.REST,
+    Operator.IN, Operator.MAP, Operator.FOLD, Operator.LENGTH, Operator.ZIP, Operator.RANGE,
+    Operator.MAX, Operator.MIN, Operator.TYPE, Operator.STRING_TO_SYMBOL, Operator.SYMBOL_TO_STRING
+])
+
+
+# operators that compare the value of their argument with the value at an adjacent index
+ADJACENT = {Operator.RISING: 1, Operator.FALLING: 1, Operator.CHANGED: -1}
+
+
+def signal_dependencies(seval, expr):
+    '''Collects the signals read by a side effect free expression.
+    Returns a set of (signal, offset) pairs, the set of all reval offsets and
+    the set of variables read by the expression, or None if the signal reads
+    of the expression can not be determined statically.'''
+    signals = set()
+    offsets = set()
+    variables = set()
+
+    def collect(expr, offset):
+        if isinstance(expr, Symbol):
+            name = seval.aliases.get(expr.name, expr.name)
+            if expr.steps is None and seval.traces.contains(name):
+                signals.add((name, offset))
+            else:
+                variables.add(expr.name)
+            return True
+
+        if isinstance(expr, (WList, list)):
+            if not expr:
+                return False
+
+            head = expr[0]
+            if head == Operator.QUOTE:
+                return True
+
+            if head == Operator.REL_EVAL:
+                # only constant offsets can be analyzed
+                if len(expr) != 3 or not isinstance(expr[2], int) or isinstance(expr[2], bool):
+                    return False
+
+                offsets.add(offset + expr[2])
+                return collect(expr[1], offset + expr[2])
+
+            if isinstance(head, Operator) and head in ADJACENT:
+                # edges compare the value of their argument with its value at an adjacent index
+                if len(expr) != 2:
+                    return False
+
+                offsets.add(offset + ADJACENT[head])
+                return collect(expr[1], offset) and collect(expr[1], offset + ADJACENT[head])
+
+            return isinstance(head, Operator) and head in PURE_OPERATORS and all(collect(arg, offset) for arg in expr[1:])
+
+        return isinstance(expr, (int, float, str))
+
+    return (signals, offsets, variables) if collect(expr, 0) else None
+
+
+def relocatable(seval, expr):
+    '''Returns true if expr can be evaluated at an offset from the current index by reading
+    its signals at the offset, i.e. without stepping the traces. This is the case if expr only
+    consists of constants, variables, recorded signals and pure operators.'''
+    if isinstance(expr, Symbol):
+        name = seval.aliases.get(expr.name, expr.name)
+        return expr.steps is not None or not seval.traces.contains(name) or seval.traces.recorded(name)
+
+    if isinstance(expr, (WList, list)):
+        if not expr:
+            return False
+
+        head = expr[0]
+        if not isinstance(head, Operator):
+            return False
+
+        if head == Operator.QUOTE:
+            return True
+
+        # operators reading signals at other indices respect the offset as well
+        relative = head == Operator.REL_EVAL or head in ADJACENT or head in (Operator.NEXT_CHANGE, Operator.PREV_CHANGE)
+        return (head in PURE_OPERATORS or relative) and all(relocatable(seval, arg) for arg in expr[1:])
+
+    return isinstance(expr, (int, float, str))
+
+
+def never_fails(seval, expr):
+    '''Returns true if expr reads only signals and constants and can not fail for any signal values'''
+    if isinstance(expr, Symbol):
+        return expr.steps is None and seval.traces.contains(seval.aliases.get(expr.name, expr.name))
+
+    if isinstance(expr, (WList, list)):
+        if not expr:
+            return False
+
+        head = expr[0]
+        if head == Operator.QUOTE:
+            return True
+
+        if head == Operator.REL_EVAL:
+            return len(expr) == 3 and isinstance(expr[2], int) and never_fails(seval, expr[1])
+
+        # the arity of these operators is checked at evaluation
+        arity = {Operator.EQ: len(expr) > 2, Operator.NEQ: len(expr) > 2, Operator.AND: len(expr) > 1,
+                 Operator.OR: len(expr) > 1, Operator.IF: len(expr) in (3, 4), Operator.RISING: len(expr) == 2,
+                 Operator.FALLING: len(expr) == 2, Operator.CHANGED: len(expr) == 2}
+        return isinstance(head, Operator) and arity.get(head, False) and all(never_fails(seval, arg) for arg in expr[1:])
+
+    return isinstance(expr, (int, float, str))
+
+
+def pure(expr):
+    '''Returns true if evaluating expr has no side effects'''
+    if isinstance(expr, (WList, list)):
+        if not expr:
+            return False
+
+        head = expr[0]
+        if not isinstance(head, Operator):
+            return False
+
+        if head == Operator.QUOTE:
+            return True
+
+        # reval restores the indices it steps to
+        reading = head == Operator.REL_EVAL or head in ADJACENT
+        return (reading or head in PURE_OPERATORS) and all(pure(arg) for arg in expr[1:])
+
+    return True
+
+
+def common_subexpressions(seval, expr):
+    '''Common subexpression analysis.
+    Returns the keys (see form_key) of all subexpressions of expr that read only signals
+    and constants, can not fail and occur more than once. Expressions that already
+    have compiled code and expressions inside of reval are not searched.
+    Side effects can change the values read after them, so the search ends at the
+    first expression (in evaluation order) that is not pure.'''
+    counts = {}
+
+    def count(sub):
+        # returns false if sub is not pure
+        if not isinstance(sub, WList) or not sub or sub[0] == Operator.QUOTE:
+            return True
+
+        if sub.code is not None:
+            return pure(sub)
+
+        if never_fails(seval, sub):
+            key = form_key(sub)
+            counts[key] = counts.get(key, 0) + 1
+
+        head = sub[0]
+        if not isinstance(head, Operator) or head not in PURE_OPERATORS:
+            # expressions inside of reval are read at another index
+            return pure(sub)
+
+        return all(count(arg) for arg in sub[1:])
+
+    for arg in expr[1:]:
+        if not count(arg):
+            break
+
+    return {key for key, n in counts.items() if n > 1 and key is not None}
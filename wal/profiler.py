@@ -0,0 +1,170 @@
+'''Profiler for WAL programs'''
+import sys
+import time
+
+from wal.ast_defs import Operator, UserOperator, WList
+
+
+def location(line_info):
+    '''Returns the source location of an expression with line_info'''
+    if isinstance(line_info, dict) and line_info.get('line'):
+        return f"{line_info['filename'] or '<string>'}:{line_info['line']}"
+
+    return None
+
+
+def profiled(expr, code):
+    '''Wraps the compiled code of expr such that it is measured by the profile of the evaluating context'''
+    if expr.__class__ is not WList or not expr or not isinstance(expr[0], (Operator, UserOperator)):
+        return code
+
+    head = expr[0]
+    key = ('operator', head.value if isinstance(head, Operator) else head.name)
+    line = location(expr.line_info)
+
+    def measured(seval):
+        profile = seval.profile
+        if profile is None:
+            return code(seval)
+        return profile.measure(key, line, code, seval)
+
+    return measured
+
+
+class Profile:
+    '''Call counts and times of the operators, functions and source lines
+    evaluated while the profile is started.
+    The total time of an entry includes the time of everything it called,
+    the self time excludes it.'''
+
+    # methods of the evaluation context that are replaced while profiling
+    HOOKS = ['eval', 'eval_closure', 'call_closure']
+
+    def __init__(self):
+        # [calls, total time, self time] by (kind, name) and by source location
+        self.functions = {}
+        self.lines = {}
+        # number of active measurements by entry, recursive calls only count once towards the total time
+        self.active = {}
+        # tree of call stacks, each node is [self time, children by name]
+        self.root = [0.0, {}]
+        # stack of [node, time spent in calls] of the active measurements
+        self.stack = [[self.root, 0.0]]
+        # macro expansions by name [expanded, reused]
+        self.macros = {}
+        self.time = 0.0
+        self.started = None
+        self.counters = None
+
+    def measure(self, key, line, function, *args):
+        '''Calls function with args and measures it under key and line'''
+        children = self.stack[-1][0][1]
+        node = children.get(key[1])
+        if node is None:
+            node = children[key[1]] = [0.0, {}]
+
+        frame = [node, 0.0]
+        self.stack.append(frame)
+        active = self.active
+        outer = active.get(key, 0)
+        active[key] = outer + 1
+        outer_line = active.get(line, 0)
+        if line:
+            active[line] = outer_line + 1
+
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stack.pop()
+            self.stack[-1][1] += elapsed
+            own = elapsed - frame[1]
+            node[0] += own
+            Profile.record(self.functions, key, 0 if outer else elapsed, own)
+            active[key] = outer
+            if line:
+                Profile.record(self.lines, line, 0 if outer_line else elapsed, own)
+                active[line] = outer_line
+
+    @staticmethod
+    def record(table, key, total, own):
+        entry = table.get(key)
+        if entry is None:
+            table[key] = [1, total, own]
+        else:
+            entry[0] += 1
+            entry[1] += total
+            entry[2] += own
+
+    def start(self, seval):
+        '''Starts profiling everything evaluated in seval'''
+        assert seval.profile is None, 'profile: the evaluation context is already profiled'
+        cls = seval.__class__
+
+        def call_closure(closure, values):
+            return self.measure(('function', str(closure.name)), None, cls.call_closure, seval, closure, values)
+
+        def eval_closure(closure, args):
+            if closure.args.__class__ is WList and closure.args.layout is not None:
+                # measured by call_closure
+                return cls.eval_closure(seval, closure, args)
+            return self.measure(('function', str(closure.name)), None, cls.eval_closure, seval, closure, args)
+
+        seval.profile = self
+        seval.eval = seval.eval_profiled
+        seval.eval_closure = eval_closure
+        seval.call_closure = call_closure
+        self.counters = (dict(seval.macro_expansions), dict(seval.macro_hits))
+        self.started = time.perf_counter()
+
+    def stop(self, seval):
+        '''Stops profiling seval'''
+        self.time += time.perf_counter() - self.started
+        seval.profile = None
+        for name in Profile.HOOKS:
+            seval.__dict__.pop(name, None)
+
+        expansions, hits = self.counters
+        for name in set(seval.macro_expansions) | set(seval.macro_hits):
+            expanded = seval.macro_expansions[name] - expansions.get(name, 0)
+            reused = seval.macro_hits[name] - hits.get(name, 0)
+            if expanded or reused:
+                previous = self.macros.get(name, [0, 0])
+                self.macros[name] = [previous[0] + expanded, previous[1] + reused]
+
+    def collapsed(self):
+        '''Returns the measured call stacks in the collapsed stack format of flame graph tools.
+        Each line contains the names on a stack separated by semicolons and the self time in microseconds.'''
+        lines = []
+
+        def collect(node, path):
+            for name, child in node[1].items():
+                stack = f'{path};{name}' if path else name
+                if round(child[0] * 1e6) > 0:
+                    lines.append(f'{stack} {round(child[0] * 1e6)}')
+                collect(child, stack)
+
+        collect(self.root, '')
+        return '\n'.join(lines)
+
+    def print(self, limit=20, file=None):
+        '''Prints the entries with the highest self time'''
+        file = file or sys.stdout
+        print(f'WAL profile: {self.time:.3f}s', file=file)
+
+        def table(title, entries):
+            print(file=file)
+            print(f'{"calls":>10} {"total [s]":>10} {"self [s]":>10}  {title}', file=file)
+            ordered = sorted(entries.items(), key=lambda entry: entry[1][2], reverse=True)
+            for name, (calls, total, own) in ordered[:limit]:
+                print(f'{calls:>10} {total:>10.4f} {own:>10.4f}  {name}', file=file)
+
+        table('operator/function', {f'{name} ({kind})': entry for (kind, name), entry in self.functions.items()})
+        table('line', self.lines)
+
+        if self.macros:
+            print(file=file)
+            print(f'{"expanded":>10} {"reused":>10}  macro', file=file)
+            for name, (expanded, reused) in sorted(self.macros.items(), key=lambda entry: sum(entry[1]), reverse=True)[:limit]:
+                print(f'{expanded:>10} {reused:>10}  {name}', file=file)
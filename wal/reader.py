@@ -1,12 +1,17 @@
 '''WAL Reader'''
 
 import ast
+import functools
+import os
+import re
+from bisect import bisect_left
 from lark import Lark, Transformer
 from lark import UnexpectedToken, UnexpectedEOF, UnexpectedCharacters
 from lark.visitors import v_args
 from lark.exceptions import VisitError
 from wal.ast_defs import Symbol, Operator, Unquote, UnquoteSplice, operators, WList
 from wal.ast_defs import Symbol as S
+from wal.util import cache_dir
 
 WAL_GRAMMAR = r"""
     _NL: /(\r?\n)+/
@@ -192,15 +197,216 @@ def read(code, reader, filename=''):
         raise ParseError("", str(context)) from u
 
 
-reader_sexpr = Lark(WAL_GRAMMAR, start='sexpr', parser='lalr', propagate_positions=True)
+@functools.cache
+def parser(start):
+    '''Returns the Lark parser for WAL programs starting at the rule start.
+    Parsers are built on first use and their tables are stored in the
+    cache directory, Lark rebuilds them whenever the grammar changes.'''
+    try:
+        cache = os.path.join(cache_dir('parser'), f'wal-{start}.lark')
+    except OSError:
+        cache = False
+
+    return Lark(WAL_GRAMMAR, start=start, parser='lalr', propagate_positions=True, cache=cache)
+
+
+# terminals of WAL_GRAMMAR in the order in which the Lark lexer tries them
+INTER = re.compile(r'(?:[ \t\f\r\n]+|;.*)*')
+SYMBOL = re.compile(r'[a-zA-Z_\.][=$\*/>:\.\-_\?=%§^!\\~+<>|,\w]*|\\\S+')
+ATOM = re.compile('|'.join([
+    r'(?P<string>".*?(?<!\\)(?:\\\\)*?")',
+    r'(?P<float>[+-]?[0-9]+\.[0-9]*)',
+    r'(?P<hex_int>0x[0-9a-fA-F]+)',
+    r'(?P<dec_int>[+-]?[0-9]+)',
+    f'(?P<symbol>{SYMBOL.pattern})',
+    r'(?P<operator>\*\*|&&|\|\||!=|>=|<=|[-+*/=><!])']))
+BASH_LINE = re.compile(r'#![^\n]+\n')
+CLOSING = {'(': ')', '[': ']', '{': '}'}
+
+
+class SexprReader:
+    '''Recursive descent reader that builds WAL expressions directly from text.
+    It accepts the language of WAL_GRAMMAR and produces the same expressions
+    and line information as the Lark parser with TreeToWal.'''
+
+    def __init__(self, code, filename=''):
+        self.text = code
+        self.filename = filename
+        self.pos = 0
+        self.newlines = [match.start() for match in re.finditer('\n', code)]
+
+    def line_info(self, start, end):
+        newlines = self.newlines
+        line = bisect_left(newlines, start)
+        end_line = bisect_left(newlines, end)
+        return {
+            'filename': self.filename,
+            'line': line + 1,
+            'end_line': end_line + 1,
+            'column': start - (newlines[line - 1] if line else -1),
+            'end_column': end - (newlines[end_line - 1] if end_line else -1)
+        }
+
+    def error(self, pos):
+        '''Returns a ParseError for unexpected input at pos'''
+        text = self.text
+        before = text[max(pos - 40, 0):pos].rsplit('\n', 1)[-1]
+        after = text[pos:pos + 40].split('\n', 1)[0]
+        context = before + after + '\n' + ' ' * len(before.expandtabs()) + '^\n'
+        line = bisect_left(self.newlines, pos)
+        column = pos - (self.newlines[line - 1] if line else -1)
+        if pos >= len(text):
+            return ParseError(context, f'Unexpected end of file at line {line + 1}:{column}.\nDid you forget a closing )?')
+
+        return ParseError(context, f'Unexpected "{text[pos]}" at line {line + 1}:{column}')
+
+    def read_sexpr(self):
+        '''Reads a single expression that spans the whole text'''
+        res = self.sexpr()
+        if self.pos != len(self.text):
+            raise self.error(self.pos)
+
+        return res
+
+    def read_sexprs(self):
+        '''Reads a program, which can start with a #! line'''
+        text = self.text
+        if not text:
+            raise self.error(0)
+
+        if text.startswith('#!') and (bash_line := BASH_LINE.match(text)):
+            self.pos = bash_line.end()
+
+        sexprs = []
+        self.pos = INTER.match(text, self.pos).end()
+        while self.pos < len(text):
+            sexprs.append(self.sexpr())
+
+        return WList(sexprs, line_info=self.line_info(0, len(text)))
+
+    def sexpr(self):
+        '''Reads an expression and the whitespace and comments around it'''
+        text = self.text
+        self.pos = INTER.match(text, self.pos).end()
+        start = self.pos
+        res = self.strict()
+        if text.startswith('@', self.pos):
+            self.pos += 1
+            res = WList([Operator.REL_EVAL, res, self.strict()], line_info=self.line_info(start, self.pos))
+
+        self.pos = INTER.match(text, self.pos).end()
+        return res
+
+    def strict(self):
+        '''Reads an expression without surrounding whitespace and its bit and slice suffixes'''
+        text = self.text
+        start = pos = self.pos
+        if pos >= len(text):
+            raise self.error(pos)
+
+        char = text[pos]
+        if char in CLOSING:
+            closing = CLOSING[char]
+            self.pos += 1
+            data = []
+            while not text.startswith(closing, self.pos):
+                data.append(self.sexpr())
+            self.pos += 1
+            res = WList(data, line_info=self.line_info(start, self.pos))
+        elif char == "'":
+            self.pos += 1
+            res = WList([Operator.QUOTE, self.sexpr()], line_info=self.line_info(start, self.pos))
+        elif char == '`':
+            self.pos += 1
+            res = WList([Operator.QUASIQUOTE, self.sexpr()], line_info=self.line_info(start, self.pos))
+        elif char == ',':
+            if text.startswith(',@', pos):
+                self.pos += 2
+                res = UnquoteSplice(self.sexpr())
+            else:
+                self.pos += 1
+                res = Unquote(self.sexpr())
+        elif char in '~#':
+            match = SYMBOL.match(text, pos + 1)
+            if not match:
+                raise self.error(pos + 1)
+
+            self.pos = match.end()
+            name = match.group()
+            symbol = S(name, line_info=self.line_info(pos + 1, self.pos))
+            if char == '~':
+                res = WList([Operator.RESOLVE_SCOPE, symbol], line_info=self.line_info(start, self.pos))
+            elif name == 't':
+                res = True
+            elif name == 'f':
+                res = False
+            else:
+                res = WList([Operator.RESOLVE_GROUP, symbol], line_info=self.line_info(start, self.pos))
+        else:
+            res = self.atom()
+
+        while text.startswith('[', self.pos):
+            self.pos += 1
+            index = self.sexpr()
+            if text.startswith(':', self.pos):
+                self.pos += 1
+                res = WList([Operator.SLICE, res, index, self.sexpr()])
+            else:
+                res = WList([Operator.SLICE, res, index])
+
+            if not text.startswith(']', self.pos):
+                raise self.error(self.pos)
+
+            self.pos += 1
+            res.line_info = self.line_info(start, self.pos)
+
+        return res
+
+    def atom(self):
+        '''Reads a string, number, symbol or operator'''
+        match = ATOM.match(self.text, self.pos)
+        if not match:
+            raise self.error(self.pos)
+
+        start = self.pos
+        self.pos = match.end()
+        kind = match.lastgroup
+        token = match.group()
+        if kind == 'symbol':
+            if token in operators:
+                return Operator(token)
+            if token == 'true':
+                return True
+            if token == 'false':
+                return False
+            return S(token, line_info=self.line_info(start, self.pos))
+
+        if kind == 'dec_int':
+            return int(token)
+
+        if kind == 'string':
+            if '\\' not in token:
+                return token[1:-1]
+            try:
+                return ast.literal_eval(token)
+            except (SyntaxError, ValueError) as error:
+                raise ParseError('', str(error)) from error
+
+        if kind == 'float':
+            return float(token)
+
+        if kind == 'hex_int':
+            return int(token, 16)
+
+        return Operator(token)
+
+
 def read_wal_sexpr(code, filename=''):
-    return read(code, reader_sexpr, filename=filename)
+    return SexprReader(code, filename).read_sexpr()
 
 
-reader_sexprs = Lark(WAL_GRAMMAR, start='sexpr_list', parser='lalr', propagate_positions=True)
 def read_wal_sexprs(code, filename=''):
-    sexprs = read(code, reader_sexprs, filename=filename)
-    return sexprs
+    return SexprReader(code, filename).read_sexprs()
 
 
 class ParseError(Exception):
@@ -0,0 +1,156 @@
+'''Snapshots of the global WAL state after the standard library was loaded'''
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+
+from wal.ast_defs import Environment, Frame, Closure, WList
+from wal.ast_defs import Symbol as S
+from wal.ast_defs import Operator as Op
+from wal.util import cache_dir
+from wal.version import __version__
+
+STDLIB = ['std/std', 'std/module']
+FORMAT_VERSION = 1
+# snapshots of this process by the contents of the standard library files
+SNAPSHOTS = {}
+
+
+def clone(value, memo):
+    '''Copies environments, frames, closures and plain containers reachable from value.
+    All other values (e.g. expressions, macros and numbers) are shared with the original.
+    memo maps the ids of already copied objects to their copies.'''
+    copied = memo.get(id(value))
+    if copied is not None:
+        return copied
+
+    cls = value.__class__
+    if cls is Environment:
+        copied = Environment()
+        memo[id(value)] = copied
+        copied.environment = {name: clone(binding, memo) for name, binding in value.environment.items()}
+        copied.parent = clone(value.parent, memo) if value.parent else None
+    elif cls is Frame:
+        copied = Frame(value.names, [])
+        memo[id(value)] = copied
+        copied.slots = [clone(slot, memo) for slot in value.slots]
+        copied.parent = clone(value.parent, memo) if value.parent else None
+    elif cls is Closure:
+        copied = Closure(None, value.args, value.expression, name=value.name)
+        memo[id(value)] = copied
+        copied.environment = clone(value.environment, memo)
+    elif cls is list:
+        copied = []
+        memo[id(value)] = copied
+        copied.extend(clone(element, memo) for element in value)
+    elif cls is dict:
+        copied = {}
+        memo[id(value)] = copied
+        copied.update((key, clone(element, memo)) for key, element in value.items())
+    else:
+        return value
+
+    return copied
+
+
+class Snapshot:
+    '''Frozen global state of an evaluation context.
+    Every context restored from a snapshot gets its own copies of the global
+    environment and of all closures, while the expressions are shared.'''
+
+    STATE = ['global_environment', 'gensymi', 'imports', 'aliases', 'macros', 'scope', 'group', 'virtual_signals']
+
+    def __init__(self, seval):
+        memo = {}
+        self.state = {name: clone(getattr(seval, name), memo) for name in Snapshot.STATE}
+
+    def restore(self, seval):
+        '''Replaces the global state of seval by a copy of this snapshot'''
+        memo = {}
+        for name, value in self.state.items():
+            setattr(seval, name, clone(value, memo))
+
+        seval.environment = seval.global_environment
+
+
+def stdlib_files(walpath):
+    '''Returns the files from which the standard library is loaded using walpath'''
+    files = []
+    for module in STDLIB:
+        for path in walpath:
+            found = [f'{path}/{module}{ext}' for ext in ('.wo', '.wal') if os.path.isfile(f'{path}/{module}{ext}')]
+            if found:
+                files.append(found[0])
+                break
+
+    return files
+
+
+def snapshot_path(files):
+    '''Returns the path of the on-disk snapshot of the standard library in files'''
+    key = hashlib.sha1(f'{__version__}\0{FORMAT_VERSION}\0{sys.version}'.encode('utf-8'))
+    for filename in files:
+        with open(filename, 'rb') as f:
+            key.update(filename.encode('utf-8') + b'\0' + f.read())
+
+    return os.path.join(cache_dir('stdlib'), key.hexdigest() + '.pickle')
+
+
+def load_stdlib(seval):
+    '''Loads the standard library into seval'''
+    for module in STDLIB:
+        seval.eval(WList([Op.EVAL_FILE, S(module)]))
+
+
+def stdlib_snapshot(seval):
+    '''Returns the snapshot of the global state after the standard library is loaded into
+    a fresh context like seval. Snapshots are taken once per process and are stored on disk,
+    such that later processes do not have to evaluate the standard library.'''
+    files = stdlib_files(seval.walpath)
+    try:
+        path = snapshot_path(files)
+    except OSError:
+        path = None
+
+    if path in SNAPSHOTS:
+        return SNAPSHOTS[path]
+
+    snapshot = None
+    if path:
+        try:
+            with open(path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, TypeError, ValueError):
+            snapshot = None
+
+    if snapshot is None:
+        # evaluate the standard library in an empty context that is not reachable by users
+        fresh = seval.__class__(seval.traces.__class__())
+        fresh.walpath = seval.walpath
+        load_stdlib(fresh)
+        snapshot = Snapshot(fresh)
+        if path:
+            store(path, snapshot)
+
+    if path:
+        SNAPSHOTS[path] = snapshot
+
+    return snapshot
+
+
+def store(path, snapshot):
+    '''Writes snapshot to path'''
+    try:
+        # write to a temporary file first such that readers never see partial files
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    except (OSError, pickle.PicklingError, RecursionError):
+        pass
@@ -0,0 +1,59 @@
+'''Memory bounded cache for decoded signals'''
+from collections import OrderedDict
+
+
+class ColumnCache:
+    '''Holds the change lists of decoded signals. If a budget in bytes is set,
+    the least recently used change lists are evicted when the budget is exceeded.'''
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.columns = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        '''Returns the change list stored under key or None if it is not cached'''
+        column = self.columns.get(key)
+        if column is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            if self.budget is not None:
+                self.columns.move_to_end(key)
+
+        return column
+
+    def put(self, key, column):
+        '''Stores a change list under key and evicts others if the budget is exceeded'''
+        if key in self.columns:
+            self.size -= self.sizes.pop(key)
+
+        self.columns[key] = column
+        self.sizes[key] = column.nbytes()
+        self.size += self.sizes[key]
+        # the newest change list is never evicted
+        while self.budget is not None and self.size > self.budget and len(self.columns) > 1:
+            evicted, _ = self.columns.popitem(last=False)
+            self.size -= self.sizes.pop(evicted)
+            self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def __len__(self):
+        return len(self.columns)
+
+    def stats(self):
+        '''Returns the counters of this cache'''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'columns': len(self.columns),
+            'bytes': self.size,
+            'budget': self.budget
+        }
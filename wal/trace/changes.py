@@ -0,0 +1,436 @@
+'''Sparse storage for the value changes of a single signal'''
+import sys
+from array import array
+from bisect import bisect_right
+from itertools import chain, compress, islice, product
+from operator import lt, ne
+
+from wal.trace.logic import encode_bits, planes_value
+
+
+class ChangeList:
+    '''Holds the values of one signal as a sorted array of the indices
+    at which the signal changes and the values it changes to.'''
+
+    # packed subclasses store their values differently in the same slots
+    __slots__ = ('indices', 'values', 'masks', 'width')
+
+    def __init__(self, initial='x'):
+        self.indices = array('q', [0])
+        self.values = [initial]
+        self.masks = None
+        self.width = None
+
+    def change(self, index, value):
+        '''Records that the signal takes value at index.
+        Changes must be recorded in non-decreasing index order.'''
+        if self.indices[-1] == index:
+            self.values[-1] = value
+            # a change back to the previous value at the same index is no change
+            if len(self.values) > 1 and self.values[-2] == value:
+                self.indices.pop()
+                self.values.pop()
+        elif self.values[-1] != value:
+            self.indices.append(index)
+            self.values.append(value)
+
+    def record(self, indices, values):
+        '''Records that the signal takes values at indices, like a change for each of them.
+        Runs of changes that can be stored without merging are appended at once.'''
+        if not indices:
+            return
+
+        # after the first change, the others are at later indices if none of them shares an index
+        self.change(indices[0], values[0])
+        if len(indices) > 1 and all(map(lt, indices, islice(indices, 1, None))) \
+           and self.append(array('q', indices[1:]), values[1:]):
+            return
+
+        for index, value in zip(indices[1:], values[1:]):
+            self.change(index, value)
+
+    def append(self, indices, values):
+        '''Appends changes at increasing indices after the last change, dropping those that repeat a value.
+        Returns false if the values can not be stored by this change list.'''
+        changed = list(map(ne, values, chain([self.values[-1]], values)))
+        if not all(changed):
+            indices = array('q', compress(indices, changed))
+            values = list(compress(values, changed))
+
+        self.indices.extend(indices)
+        self.values.extend(values)
+        return True
+
+    def extend(self, changes, offset):
+        '''Appends the changes of another change list whose indices start at offset.
+        A leading None value of changes marks that the previous value is carried forward.'''
+        start = 1 if changes.value(0) is None else 0
+        if start < len(changes):
+            self.change(changes.indices[start] + offset, changes.value(start))
+            self.indices.extend(index + offset for index in changes.indices[start + 1:])
+            self.values.extend(changes.value(i) for i in range(start + 1, len(changes)))
+
+    def value(self, position):
+        '''Returns the value of the change at position'''
+        return self.values[position]
+
+    def at(self, index):
+        '''Returns the value of the signal at index'''
+        return self.values[bisect_right(self.indices, index) - 1]
+
+    def nbytes(self):
+        '''Returns the approximate number of bytes used by this change list'''
+        size = memoryview(self.indices).nbytes
+        if isinstance(self.values, list):
+            return size + sys.getsizeof(self.values) + sum(sys.getsizeof(value) for value in self.values)
+
+        size += memoryview(self.values).nbytes
+        if self.masks is not None:
+            size += memoryview(self.masks).nbytes
+
+        return size
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class PackedChangeList(ChangeList):
+    '''Base class for change lists that store their values in compact buffers.
+    If a value can not be represented, the change list falls back to a plain ChangeList.'''
+
+    __slots__ = ()
+
+    def unpack(self):
+        '''Converts this change list to a plain ChangeList'''
+        values = [self.value(i) for i in range(len(self))]
+        self.__class__ = ChangeList
+        self.values = values
+
+    def append(self, indices, values):
+        return False
+
+    def extend(self, changes, offset):
+        start = 1 if changes.value(0) is None else 0
+        if isinstance(changes.values, list):
+            values = changes.values[start:]
+        else:
+            values = list(map(changes.value, range(start, len(changes))))
+
+        self.record([index + offset for index in changes.indices[start:]], values)
+
+    def at(self, index):
+        return self.value(bisect_right(self.indices, index) - 1)
+
+
+class BitChangeList(PackedChangeList):
+    '''Change list of a 1-bit signal, four values are packed into each byte'''
+
+    __slots__ = ()
+    CODES = {0: 0, 1: 1, 'z': 2, 'Z': 2, 'x': 3, 'X': 3}
+    VALUES = (0, 1, 'z', 'x')
+    # runs of a code and bytes of four codes, used when appending many changes at once
+    REPEATED = tuple(bytes((code, code)) for code in range(4))
+    PACKED = {codes: codes[0] | codes[1] << 2 | codes[2] << 4 | codes[3] << 6
+              for codes in product(range(4), repeat=4)}
+
+    def __init__(self, initial='x'):
+        super().__init__()
+        self.values = bytearray([BitChangeList.CODES[initial]])
+        self.width = 1
+
+    def code(self, position):
+        '''Returns the 2-bit code of the change at position'''
+        return (self.values[position >> 2] >> ((position & 3) << 1)) & 3
+
+    def set_code(self, position, code):
+        '''Sets the 2-bit code of the change at position'''
+        shift = (position & 3) << 1
+        self.values[position >> 2] = (self.values[position >> 2] & ~(3 << shift)) | (code << shift)
+
+    def change(self, index, value):
+        code = BitChangeList.CODES.get(value)
+        if code is None or value.__class__ is float:
+            self.unpack()
+            self.change(index, value)
+            return
+
+        indices = self.indices
+        last = len(indices) - 1
+        values = self.values
+        shift = (last & 3) << 1
+        if indices[last] == index:
+            self.set_code(last, code)
+            # a change back to the previous value at the same index is no change
+            if last and self.code(last - 1) == code:
+                indices.pop()
+                if shift == 0:
+                    values.pop()
+                else:
+                    self.set_code(last, 0)
+        elif (values[-1] >> shift) & 3 != code:
+            indices.append(index)
+            # unused codes in the last byte are always zero
+            if shift == 6:
+                values.append(code)
+            else:
+                values[-1] |= code << (shift + 2)
+
+    def append(self, indices, values):
+        # 0 and 1 are their own codes, bytes rejects floats and strings
+        try:
+            codes = bytes(values)
+        except (TypeError, ValueError):
+            codes = None
+
+        if codes is None or max(codes) > 1:
+            # floats compare equal to the integer codes
+            if float in set(map(type, values)):
+                return False
+
+            try:
+                codes = bytes(map(BitChangeList.CODES.__getitem__, values))
+            except KeyError:
+                return False
+
+        # x and X are stored as the same code
+        previous = self.code(len(self.indices) - 1)
+        if codes[0] == previous or any(repeated in codes for repeated in BitChangeList.REPEATED):
+            changed = list(map(ne, codes, chain([previous], codes)))
+            codes = bytes(compress(codes, changed))
+            indices = array('q', compress(indices, changed))
+
+        position = len(self.indices)
+        self.indices.extend(indices)
+        packed = self.values
+        # fill the last byte before packing four codes into each new byte
+        head = min(-position & 3, len(codes))
+        for i in range(head):
+            packed[-1] |= codes[i] << (((position + i) & 3) << 1)
+
+        codes = codes[head:] + bytes(-(len(codes) - head) & 3)
+        packed.extend(map(BitChangeList.PACKED.__getitem__, zip(*[iter(codes)] * 4)))
+        return True
+
+    def value(self, position):
+        return BitChangeList.VALUES[self.code(position)]
+
+    def at(self, index):
+        position = bisect_right(self.indices, index) - 1
+        return BitChangeList.VALUES[(self.values[position >> 2] >> ((position & 3) << 1)) & 3]
+
+
+class VectorChangeList(PackedChangeList):
+    '''Change list of a signal with up to 64 bits. Value and x/z mask planes
+    are stored in two arrays of the smallest fitting integer type.'''
+
+    __slots__ = ()
+
+    def __init__(self, width, initial='x'):
+        super().__init__()
+        self.width = width
+        typecode = next(code for code in 'BHILQ' if array(code).itemsize * 8 >= width)
+        value, mask = self.encode(initial)
+        self.values = array(typecode, [value])
+        self.masks = array(typecode, [mask])
+
+    def encode(self, value):
+        '''Returns the value and mask planes of value'''
+        if isinstance(value, int):
+            if value < 0 or value >> self.width:
+                raise OverflowError(f'{value} does not fit into {self.width} bits')
+            return value, 0
+
+        if isinstance(value, str):
+            return encode_bits(value, self.width)
+
+        raise TypeError(f'{value} is not a logic value')
+
+    def unpack(self):
+        super().unpack()
+        self.masks = None
+
+    def change(self, index, value):
+        if value.__class__ is int and 0 <= value and not value >> self.width:
+            mask = 0
+        else:
+            try:
+                value, mask = self.encode(value)
+            except (OverflowError, TypeError, ValueError):
+                self.unpack()
+                self.change(index, value)
+                return
+
+        indices = self.indices
+        values = self.values
+        masks = self.masks
+        if indices[-1] == index:
+            values[-1] = value
+            masks[-1] = mask
+            # a change back to the previous value at the same index is no change
+            if len(values) > 1 and values[-2] == value and masks[-2] == mask:
+                indices.pop()
+                values.pop()
+                masks.pop()
+        elif values[-1] != value or masks[-1] != mask:
+            indices.append(index)
+            values.append(value)
+            masks.append(mask)
+
+    def append(self, indices, values):
+        # values with x or z bits are encoded one by one
+        try:
+            values = array(self.values.typecode, values)
+        except (OverflowError, TypeError):
+            return False
+
+        if max(values) >> self.width:
+            return False
+
+        changed = list(map(ne, values, chain([self.value(len(self.indices) - 1)], values)))
+        if not all(changed):
+            values = array(self.values.typecode, compress(values, changed))
+            indices = array('q', compress(indices, changed))
+
+        self.indices.extend(indices)
+        self.values.extend(values)
+        self.masks.frombytes(bytes(len(values) * self.masks.itemsize))
+        return True
+
+    def value(self, position):
+        mask = self.masks[position]
+        if mask:
+            return planes_value(self.values[position], mask, self.width)
+
+        return self.values[position]
+
+    def at(self, index):
+        position = bisect_right(self.indices, index) - 1
+        mask = self.masks[position]
+        if mask:
+            return planes_value(self.values[position], mask, self.width)
+
+        return self.values[position]
+
+
+class WideChangeList(PackedChangeList):
+    '''Change list of a signal with more than 64 bits. Each value is stored
+    as a value plane followed by an x/z mask plane in a single buffer.'''
+
+    __slots__ = ()
+
+    def __init__(self, width, initial='x'):
+        super().__init__()
+        self.width = width
+        self.values = bytearray(self.encode(initial))
+
+    def encode(self, value):
+        '''Returns the value and mask planes of value as bytes'''
+        width = self.width
+        if isinstance(value, int):
+            if value < 0 or value >> width:
+                raise OverflowError(f'{value} does not fit into {width} bits')
+            mask = 0
+        elif isinstance(value, str):
+            value, mask = encode_bits(value, width)
+        else:
+            raise TypeError(f'{value} is not a logic value')
+
+        size = (width + 7) >> 3
+        return value.to_bytes(size, 'little') + mask.to_bytes(size, 'little')
+
+    def planes(self, position):
+        '''Returns the value and mask planes of the change at position as bytes'''
+        stride = ((self.width + 7) >> 3) << 1
+        return self.values[position * stride:(position + 1) * stride]
+
+    def change(self, index, value):
+        try:
+            planes = self.encode(value)
+        except (OverflowError, TypeError, ValueError):
+            self.unpack()
+            self.change(index, value)
+            return
+
+        n = len(self.indices)
+        stride = len(planes)
+        if self.indices[-1] == index:
+            self.values[-stride:] = planes
+            # a change back to the previous value at the same index is no change
+            if n > 1 and self.planes(n - 2) == planes:
+                self.indices.pop()
+                del self.values[-stride:]
+        elif self.values[-stride:] != planes:
+            self.indices.append(index)
+            self.values += planes
+
+    def value(self, position):
+        size = (self.width + 7) >> 3
+        start = position * (size << 1)
+        value = int.from_bytes(self.values[start:start + size], 'little')
+        mask = int.from_bytes(self.values[start + size:start + (size << 1)], 'little')
+        return planes_value(value, mask, self.width)
+
+
+class RealChangeList(PackedChangeList):
+    '''Change list of a real signal, x is stored as NaN'''
+
+    __slots__ = ()
+
+    def __init__(self, initial='x'):
+        super().__init__()
+        self.values = array('d', [self.encode(initial)])
+
+    @staticmethod
+    def encode(value):
+        '''Returns value as float'''
+        if value in ('x', 'X'):
+            return float('nan')
+
+        if not isinstance(value, float):
+            raise TypeError(f'{value} is not a real value')
+
+        return value
+
+    @staticmethod
+    def same(a, b):
+        '''Compares two stored values, all NaNs are the same'''
+        return a == b or (a != a and b != b) # pylint: disable=R0124
+
+    def change(self, index, value):
+        try:
+            value = self.encode(value)
+        except TypeError:
+            self.unpack()
+            self.change(index, value)
+            return
+
+        if self.indices[-1] == index:
+            self.values[-1] = value
+            # a change back to the previous value at the same index is no change
+            if len(self.values) > 1 and RealChangeList.same(self.values[-2], value):
+                self.indices.pop()
+                self.values.pop()
+        elif not RealChangeList.same(self.values[-1], value):
+            self.indices.append(index)
+            self.values.append(value)
+
+    def value(self, position):
+        value = self.values[position]
+        return 'x' if value != value else value # pylint: disable=R0124
+
+
+def column(kind, width):
+    '''Returns an empty change list that stores signals of kind and width compactly'''
+    if kind in ('real', 'realtime'):
+        return RealChangeList()
+
+    if width == 1:
+        return BitChangeList()
+
+    if width and width > 64:
+        return WideChangeList(width)
+
+    if width and width > 1:
+        return VectorChangeList(width)
+
+    return ChangeList()
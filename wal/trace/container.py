@@ -4,8 +4,6 @@ import pathlib
 
 from wal.ast_defs import VirtualSignal
 from wal.trace.trace import Trace
-from wal.trace.vcd import TraceVcd
-from wal.trace.csvtrace import TraceCsv
 
 class TraceContainer:
     '''Can hold multiple traces and dispatches value access to the correct trace.'''
@@ -14,33 +12,47 @@ class TraceContainer:
         self.traces = {}
         self.n_traces = 0
         self.index_stack = []
-
-
-    def load(self, file, tid=None, from_string=False, keep_signals=None):
-        '''Load a trace from file and add it under trace id tid.'''
+        # incremented whenever signal bindings become invalid, e.g. when traces are loaded
+        self.epoch = 0
+        # readers of the bound signals of the current epoch
+        self.readers = {}
+
+
+    def load(self, file, tid=None, from_string=False, keep_signals=None, cache=True, lazy=False, jobs=1, cache_mb=None):
+        '''Load a trace from file and add it under trace id tid.
+        If cache is set, parsed VCD and CSV traces are stored in and loaded from a sidecar cache.
+        If lazy is set, VCD signals are only decoded when they are accessed for the first time.
+        VCD files that are not loaded from the sidecar cache are parsed by up to jobs processes
+        in parallel, files too small to profit from it are parsed sequentially.
+        If cache_mb is set, signals of lazy VCD and FST traces decoded on demand are
+        kept in a least recently used cache of at most cache_mb megabytes.'''
         if tid is None:
             tid = f't{len(self.traces)}'
 
         assert tid not in self.traces, f'load: trace id {tid} already in use'
         
         file_extension = pathlib.Path(file).suffix
+        # trace backends are only imported when a trace of their type is loaded
         if file_extension == '.vcd':
-            self.traces[tid] = TraceVcd(file, tid, self, from_string=from_string, keep_signals=keep_signals)
+            from wal.trace.vcd import TraceVcd
+            self.traces[tid] = TraceVcd(file, tid, self, from_string=from_string, keep_signals=keep_signals, cache=cache, lazy=lazy, jobs=jobs, cache_mb=cache_mb)
         elif file_extension == '.fst':
             try:
                 from wal.trace.fst import TraceFst
-                self.traces[tid] = TraceFst(file, tid, self, from_string=from_string, keep_signals=keep_signals)
+                self.traces[tid] = TraceFst(file, tid, self, from_string=from_string, keep_signals=keep_signals, cache_mb=cache_mb)
             except ModuleNotFoundError:
                 print(f'Can not open file "{file}"')
                 print('To get support for the "fst" filetype install "pylibfst" package')
                 print('More information on pylibfst: https://pypi.org/project/pylibfst/')
                 sys.exit(1)
         elif file_extension == '.csv':
-            self.traces[tid] = TraceCsv(file, tid, self, from_string=from_string, keep_signals=keep_signals)
+            from wal.trace.csvtrace import TraceCsv
+            self.traces[tid] = TraceCsv(file, tid, self, from_string=from_string, keep_signals=keep_signals, cache=cache)
         else:
             print(f'File extension "{file_extension}" not supported.')
 
         self.n_traces += 1
+        self.invalidate()
 
 
     def unload(self, tid='DEFAULT'):
@@ -48,6 +60,7 @@ class TraceContainer:
         if tid in self.traces:
             del self.traces[tid]
             self.n_traces -= 1
+            self.invalidate()
 
 
     def signal_value(self, name, offset=0, scope=''):
@@ -99,6 +112,43 @@ class TraceContainer:
 
         return False
 
+    def locate(self, name):
+        '''Returns the trace that contains signal name and the name of the signal in this trace'''
+        if Trace.SCOPE_SEPERATOR in name:
+            separator = name.index(Trace.SCOPE_SEPERATOR)
+            return self.traces[name[:separator]], name[separator+1:]
+
+        return next(iter(self.traces.values())), name
+
+    def recorded(self, name):
+        '''Return true if name is a signal whose values are stored in a trace,
+        special and virtual signals are computed from the current index.'''
+        if not self.contains(name):
+            return False
+
+        trace, name = self.locate(name)
+        return name not in Trace.SPECIAL_SIGNALS_SET and name not in trace.virtual_signals
+
+    def invalidate(self):
+        '''Invalidates all signal bindings'''
+        self.epoch += 1
+        self.readers.clear()
+
+    def bind(self, name):
+        '''Returns a function that reads signal name at the current index + offset for a scope
+        or None if no loaded trace contains name. The function is valid until epoch changes.'''
+        if name in self.readers:
+            return self.readers[name]
+
+        reader = None
+        if self.contains(name):
+            trace, signal = self.locate(name)
+            reader = trace.signal_reader(signal)
+
+        # all symbols reading the same signal share its reader
+        self.readers[name] = reader
+        return reader
+
     def step(self, steps=1, tid=None):
         '''Step one or all traces.
         If steps is not defined step trace(s) by +1.
@@ -171,6 +221,7 @@ class TraceContainer:
 
     def add_virtual_signal(self, name, expr, seval):
         '''Add a virtual signal to the trace'''
+        self.invalidate()
 
         if self.n_traces == 1:
             trace = list(self.traces.values())[0]
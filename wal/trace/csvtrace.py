@@ -1,53 +1,82 @@
 '''Trace implementation for the CSV file format, as exported by Logic 2 '''
+import csv
+import io
 import re
 import sys
+from array import array
 
+from wal.trace import sidecar
 from wal.trace.trace import Trace
+from wal.trace.changes import column
+
+
+def decode_value(value):
+    '''Decodes a csv cell to an int, a float or the raw string'''
+    try:
+        return int(value, 2)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
 
 class TraceCsv(Trace):
     '''Holds data for one csv trace.'''
 
-    def __init__(self, filename, tid, container, from_string=False, keep_signals=None):
+    # parsed data that is stored in the sidecar cache
+    CACHED_FIELDS = ['timestamps', 'scopes', 'rawsignals', 'data', 'signalinfo']
+
+    def __init__(self, filename, tid, container, from_string=False, keep_signals=None, cache=True):
         super().__init__(tid, filename, container)
-        self.timestamps = []
+        self.timestamps = array('q')
         self.lookup = None # performs index translation after set-sampling
         self.scopes = []
         self.rawsignals = []
-        self.index2ts = []
         self.data = {}
         self.signalinfo = {}
         self.filename = filename
         self.keep_signals = set(keep_signals) if keep_signals else None
         if from_string:
-            self.parse(filename)
+            self.parse(io.StringIO(filename.strip()))
         else:
             try:
-                with open(filename) as f:
-                    self.parse(f.read())
+                cached = sidecar.load(filename, self.keep_signals, 'csv') if cache else None
+                if cached:
+                    self.__dict__.update(cached)
+                else:
+                    with open(filename, newline='') as f:
+                        self.parse(f)
+
+                    if cache:
+                        state = {field: getattr(self, field) for field in TraceCsv.CACHED_FIELDS}
+                        sidecar.store(filename, self.keep_signals, 'csv', state)
             except FileNotFoundError:
                 print(f'Error while loading {filename}. File not found.')
                 sys.exit(1)
 
 
-        self.all_timestamps = self.timestamps.copy()
+        self.index2ts = self.timestamps
+        self.all_timestamps = array('q', self.timestamps)
         self.index = 0
         self.max_index = len(self.index2ts) - 1
         self.signals = set(Trace.SPECIAL_SIGNALS + self.rawsignals)
         self.rawsignals_by_handle = [s for s in self.rawsignals]
         self.signals_by_handle = set(self.rawsignals_by_handle)
 
-    def parse(self, csvdata):
-        data = csvdata.strip().split("\n")  # assume row delimiter \n
-        header = data[0].split(",") # assume col delimiter ,
-        data = [line.split(",") for line in data[1:]]
+    def parse(self, lines):
+        '''Parses csv rows from an iterable of lines into one change list per signal'''
+        rows = csv.reader(lines)
+        header = next(rows)
         time_idx = header.index("Time [s]") # assume timestamp in seconds
-        names = [v for v in header if v != "Time [s]"]
-        self.data = {}
-        
-        for name in names:
+        columns = []
+
+        for x, name in enumerate(header):
+            if x == time_idx:
+                continue
+
             kind = "wire"
             width = 1
-            orig_name = name
             # replace space with underscore
             name = re.sub(' ', '_', name)
             # remove slice info from names
@@ -55,8 +84,6 @@ class TraceCsv(Trace):
             # array signals should not clash with WAL operators
             name = re.sub(r'\[([0-9]+)\]', r'<\1>', name)
             name = re.sub(r'\(([0-9]+)\)', r'<\1>', name)
-            header[header.index(orig_name)] = name
-            self.data[name] = []
             if not self.keep_signals or (name in self.keep_signals):
                 self.rawsignals.append(name)
                 self.signalinfo[name] = {
@@ -65,20 +92,26 @@ class TraceCsv(Trace):
                     'kind': kind,
                     'data': {}
                 }
-        
+                self.data[name] = column(kind, width)
+                columns.append((x, self.data[name]))
+
+        timestamps = self.timestamps
+        previous = [None] * len(columns)
+        for row in rows:
+            if not row:
+                continue
 
-        pattern = re.compile(r"^(\d+)\.?(\d+)?$")
-        for i in range(len(data)):
             # convert timestamp to nanoseconds
-            m = pattern.match(data[i][time_idx])
-            time_pre, time_post = m.groups("0")
-            time_ns = int(f"{time_pre}{time_post.ljust(9, '0')}", base=10)
-            
-            for x in range(len(data[i])):
-                if x != time_idx:
-                    self.data[header[x]].append(data[i][x])
-            self.timestamps.append(time_ns)
-            self.index2ts.append(time_ns)
+            time_pre, _, time_post = row[time_idx].partition('.')
+            index = len(timestamps)
+            timestamps.append(int(time_pre + time_post[:9].ljust(9, '0')))
+
+            # only cells that differ from the previous row are decoded
+            for i, (x, changes) in enumerate(columns):
+                cell = row[x]
+                if cell != previous[i]:
+                    previous[i] = cell
+                    changes.change(index, decode_value(cell))
 
     def set_sampling_points(self, new_indices):
         '''Updates the indices at which data is sampled'''
@@ -89,21 +122,23 @@ class TraceCsv(Trace):
         # stores current time stamp
         self.index = 0
         self.max_index = len(self.timestamps.keys()) - 1
+        self.reads_index = None
+        self.container.invalidate()
+
+    def change_list(self, name):
+        if self.lookup or name in self.virtual_signals or name not in self.data:
+            return None
+
+        return self.data[name]
+
+    def resident_changes(self, name):
+        return self.change_list(name)
 
     def access_signal_data(self, name, index):
-        value = None
         if self.lookup:
-            value = self.data[name][self.lookup[index]]
-        else:
-            value = self.data[name][index]
+            return self.data[name].at(self.lookup[index])
 
-        try:
-            return int(value, 2)
-        except ValueError:
-            try:
-                return float(value)
-            except ValueError:
-                return value
+        return self.data[name].at(index)
 
     def signal_width(self, name):
         '''Returns the width of a signal'''
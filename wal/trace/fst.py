@@ -2,16 +2,35 @@
 
 import re
 import sys
+from array import array
 import pylibfst as fst
 
 from wal.trace.trace import Trace
+from wal.trace.logic import LogicValue
+from wal.trace.cache import ColumnCache
+from wal.trace.changes import column
+
+
+def decode_value(value):
+    '''Decodes a value as returned by libfst'''
+    try:
+        return int(value, 2)
+    except ValueError:
+        if value[0] == 'r':
+            return float(value[1:])
+
+        try:
+            return LogicValue.parse(value)
+        except ValueError:
+            return value
+
 
 class TraceFst(Trace):
     '''Holds data for one fst trace.'''
 
-    def __init__(self, file, tid, container, from_string=False, keep_signals=None):
+    def __init__(self, file, tid, container, from_string=False, keep_signals=None, cache_mb=None):
         super().__init__(tid, file, container)
-        self.buf = fst.ffi.new("char[256]")
+        self.cache = ColumnCache(cache_mb * 1024 * 1024 if cache_mb else None)
 
         if from_string:
             raise ValueError("FST traces do not support the from_string argument")
@@ -49,24 +68,66 @@ class TraceFst(Trace):
         # remove duplicate timestamps, enumerate all timestamps and create look up table
         fst.lib.fstReaderSetFacProcessMaskAll(self.fst)
         raw_timestamps = fst.lib.fstReaderGetTimestamps(self.fst)
-        self.all_timestamps = raw_timestamps.val
+        self.all_timestamps = array('q', fst.ffi.unpack(raw_timestamps.val, raw_timestamps.nvals))
         self.timestamps = self.all_timestamps
+        self.ts_index = {ts: index for index, ts in enumerate(self.all_timestamps)}
+
+        if keep_signals:
+            self.load_signals([name for name in keep_signals if name in self.references_to_ids])
 
         # stores current time stamp
         self.index = 0
         self.max_index = raw_timestamps.nvals - 1
 
+    def load_signals(self, names):
+        '''Decodes the changes of all signals in names in one pass over the value change blocks.
+        Returns the newly decoded change lists by handle.'''
+        changes = {}
+        for name in names:
+            signal = self.references_to_ids[name]
+            if signal.handle not in self.cache:
+                changes[signal.handle] = column(None, signal.length)
+
+        if not changes:
+            return changes
+
+        # only the blocks of the requested signals are decompressed
+        fst.lib.fstReaderClrFacProcessMaskAll(self.fst)
+        for handle in changes:
+            fst.lib.fstReaderSetFacProcessMask(self.fst, handle)
+
+        ts_index = self.ts_index
+
+        def value_change(_, time, handle, value):
+            changes[handle].change(ts_index[time], decode_value(fst.ffi.string(value).decode('latin-1')))
+
+        def value_change_varlen(_, time, handle, value, length):
+            changes[handle].change(ts_index[time], fst.ffi.unpack(value, length).decode('latin-1'))
+
+        fst.fstReaderIterBlocks2(self.fst, value_change, value_change_varlen)
+        for handle, column_changes in changes.items():
+            self.cache.put(handle, column_changes)
+
+        return changes
+
+    def signal_changes(self, name):
+        '''Returns the change list of signal name'''
+        handle = self.references_to_ids[name].handle
+        changes = self.cache.get(handle)
+        if changes is None:
+            changes = self.load_signals([name])[handle]
+
+        return changes
+
+    def change_list(self, name):
+        if self.timestamps is not self.all_timestamps or name in self.virtual_signals or name not in self.references_to_ids:
+            return None
+
+        return self.signal_changes(name)
+
     def access_signal_data(self, name, index):
         '''Backend specific function for accessing signals in the waveform'''
-        handle = self.references_to_ids[name].handle
-        value = fst.helpers.string(fst.lib.fstReaderGetValueFromHandleAtTime(self.fst, self.timestamps[index], handle, self.buf))
-        try:
-            return int(value, 2)
-        except ValueError:
-            if value[0] == 'r':
-                return float(value[1:])
-            else:
-                return value
+        return self.signal_changes(name).at(self.ts_index[self.timestamps[index]])
 
     def set_sampling_points(self, new_indices):
         super().set_sampling_points(new_indices)
@@ -0,0 +1,65 @@
+'''4-state logic values represented as a value and an x/z mask plane'''
+
+# x bits are encoded as value 1 and mask 1, z bits as value 0 and mask 1
+VALUE_PLANE = str.maketrans('01xXzZ', '011100')
+MASK_PLANE = str.maketrans('01xXzZ', '001111')
+BITS = ('0', '1', 'z', 'x')
+
+
+def encode_bits(bits, width):
+    '''Returns the value and mask planes of a bit string.
+    Bit strings shorter than width are extended to the left as defined by the VCD standard.'''
+    if len(bits) < width:
+        pad = bits[0] if bits[0] in 'xXzZ' else '0'
+        bits = pad * (width - len(bits)) + bits
+    elif len(bits) > width:
+        raise OverflowError(f'{bits} does not fit into {width} bits')
+
+    return int(bits.translate(VALUE_PLANE), 2), int(bits.translate(MASK_PLANE), 2)
+
+
+def decode_bits(value, mask, width):
+    '''Returns the bit string of a value and mask plane'''
+    return ''.join(BITS[((value >> i) & 1) | (((mask >> i) & 1) << 1)] for i in range(width - 1, -1, -1))
+
+
+class LogicValue(str):
+    '''A vector value that contains x or z bits.
+    It behaves like its bit string, but can be sliced using its value and mask planes.'''
+
+    def __new__(cls, value, mask, width):
+        logic = super().__new__(cls, decode_bits(value, mask, width))
+        logic.value = value
+        logic.mask = mask
+        logic.width = width
+        return logic
+
+    def __getnewargs__(self):
+        return (self.value, self.mask, self.width)
+
+    @staticmethod
+    def parse(bits):
+        '''Converts a bit string to the value observed by WAL programs'''
+        value, mask = encode_bits(bits, len(bits))
+        return planes_value(value, mask, len(bits))
+
+    def bit(self, index):
+        '''Returns the bit at index as int or as 'x' or 'z' '''
+        return planes_value((self.value >> index) & 1, (self.mask >> index) & 1, 1)
+
+    def slice(self, upper, lower):
+        '''Returns the bits from upper down to lower'''
+        width = upper - lower + 1
+        selected = (1 << width) - 1
+        return planes_value((self.value >> lower) & selected, (self.mask >> lower) & selected, width)
+
+
+def planes_value(value, mask, width):
+    '''Converts value and mask planes to the value observed by WAL programs'''
+    if not mask:
+        return value
+
+    if width == 1:
+        return BITS[value | 2]
+
+    return LogicValue(value, mask, width)
@@ -0,0 +1,69 @@
+'''Persistent binary cache for parsed traces'''
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+
+from wal.util import cache_dir
+
+MAGIC = b'WALTRACE'
+FORMAT_VERSION = 4
+# magic, format version, kind, size and mtime of the trace file
+HEADER = struct.Struct('<8sI16sqq')
+# parsing small traces is faster than reading and writing the cache
+MIN_SIZE = 1 << 20
+
+
+def sidecar_path(filename, keep_signals):
+    '''Returns the path of the cache file for a trace loaded with keep_signals'''
+    kept = '\0'.join(sorted(keep_signals)) if keep_signals else ''
+    key = f'{os.path.abspath(filename)}\0{kept}'.encode('utf-8')
+    return os.path.join(cache_dir('traces'), hashlib.sha1(key).hexdigest() + '.wtc')
+
+
+def load(filename, keep_signals, kind):
+    '''Returns the cached state of a trace or None if no valid cache exists'''
+    try:
+        stat = os.stat(filename)
+        if stat.st_size < MIN_SIZE:
+            return None
+
+        with open(sidecar_path(filename, keep_signals), 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                magic, version, cached_kind, size, mtime = HEADER.unpack_from(mapped)
+                valid = magic == MAGIC and version == FORMAT_VERSION \
+                    and cached_kind.rstrip(b'\0') == kind.encode('utf-8') \
+                    and size == stat.st_size and mtime == stat.st_mtime_ns
+                if valid:
+                    with memoryview(mapped) as view:
+                        return pickle.loads(view[HEADER.size:])
+    except (OSError, ValueError, struct.error, pickle.UnpicklingError, EOFError):
+        pass
+
+    return None
+
+
+def store(filename, keep_signals, kind, state):
+    '''Writes the parsed state of a trace to its cache file'''
+    try:
+        stat = os.stat(filename)
+        if stat.st_size < MIN_SIZE:
+            return
+
+        path = sidecar_path(filename, keep_signals)
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, kind.encode('utf-8'), stat.st_size, stat.st_mtime_ns)
+        # write to a temporary file first such that readers never see partial files
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header)
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    except OSError:
+        pass
@@ -1,10 +1,12 @@
 '''Generic trace class '''
 # pylint: disable=E1101, W0201
 
+from wal.trace.cache import ColumnCache
+
 class Trace:
     '''A generic class for representing waveforms'''
     SCOPE_SEPERATOR = '^'
-    SPECIAL_SIGNALS = ['SIGNALS', 'SIGNALS-NO-ALIAS', 'VIRTUAL-SIGNALS', 'LOCAL-SIGNALS', 'INDEX', 'MAX-INDEX', 'TS', 'TRACE-NAME', 'TRACE-FILE', 'SCOPES', 'LOCAL-SCOPES']
+    SPECIAL_SIGNALS = ['SIGNALS', 'SIGNALS-NO-ALIAS', 'VIRTUAL-SIGNALS', 'LOCAL-SIGNALS', 'INDEX', 'MAX-INDEX', 'TS', 'TRACE-NAME', 'TRACE-FILE', 'SCOPES', 'LOCAL-SCOPES', 'CACHE-STATS']
     SPECIAL_SIGNALS_SET = set(SPECIAL_SIGNALS)
 
 
@@ -14,6 +16,11 @@ class Trace:
         self.container = container
         self.virtual_signals = {}
         self.index = 0
+        # decoded signals of backends that decode signals on demand
+        self.cache = ColumnCache()
+        # values read at the index reads_index by (signal, absolute index)
+        self.reads = {}
+        self.reads_index = None
 
 
     def set(self, index=0):
@@ -79,21 +86,73 @@ class Trace:
                     res = [s for s in self.scopes if (s.startswith(scope)) and ('.' not in s[len(scope) + 1:])]
                 elif name == 'SCOPES':
                     res = self.scopes
+                elif name == 'CACHE-STATS':
+                    res = self.cache.stats()
             elif name in self.virtual_signals:
                 res = self.virtual_signals[name].value
             else:
-                res = self.access_signal_data(name, rel_index)
+                res = self.read(name, rel_index)
         elif rel_index >= self.max_index:
-            res = self.access_signal_data(name, self.max_index)
+            res = self.read(name, self.max_index)
         else:
             raise ValueError(f'can not access {name} at negative timestamp')
 
         return res
 
+    def read(self, name, index):
+        '''Reads signal name at index. Values are cached until the index of this trace changes,
+        such that signals read repeatedly in one step are only accessed once.'''
+        if self.reads_index != self.index:
+            self.reads.clear()
+            self.reads_index = self.index
+
+        key = (name, index)
+        try:
+            return self.reads[key]
+        except KeyError:
+            res = self.reads[key] = self.access_signal_data(name, index)
+            return res
+
+    def signal_reader(self, name):
+        '''Returns a function that reads signal name at the current index + offset for a scope.
+        Signals with resident change lists are read from them directly.'''
+        changes = None if name in Trace.SPECIAL_SIGNALS_SET else self.resident_changes(name)
+        if changes is None:
+            return lambda scope, offset: self.signal_value(name, offset, scope)
+
+        at = changes.at
+        # index and value of the last read
+        last = [None, None]
+
+        def read(scope, offset):
+            index = self.index + offset
+            if index != last[0]:
+                last[0] = index
+                last[1] = at(index if index <= self.max_index else self.max_index)
+            return last[1]
+
+        return read
+
+    def resident_changes(self, name):
+        '''Returns the change list of signal name if it is indexed like this trace and stays in memory.
+        Returns None otherwise.'''
+        return None
+
     def signal_width(self, name):
         '''Returns the signal width'''
         raise NotImplementedError
 
+    def change_list(self, name):
+        '''Returns the change list of signal name indexed like this trace.
+        Returns None if the changes of the signal are not known.'''
+        return None
+
+    def change_points(self, name):
+        '''Returns the sorted indices at which the value of signal name changes.
+        The first entry is always index 0. Returns None if the indices are not known.'''
+        changes = self.change_list(name)
+        return None if changes is None else changes.indices
+
     @property
     def ts(self):
         '''Converts the index to the current timestamp.'''
@@ -107,6 +166,8 @@ class Trace:
         # stores current time stamp
         self.index = 0
         self.max_index = len(self.timestamps.keys()) - 1
+        self.reads_index = None
+        self.container.invalidate()
 
     def add_virtual_signal(self, signal):
         '''Adds a virtual signal to this trace'''
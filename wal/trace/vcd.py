@@ -1,39 +1,308 @@
 '''Trace implementation for the VCD file format '''
+import io
+import mmap
+import os
 import re
 import sys
+from array import array
+from bisect import bisect_right
+from itertools import chain, repeat
+from operator import add
 
+from wal.trace import sidecar
 from wal.trace.trace import Trace
+from wal.trace.cache import ColumnCache
+from wal.trace.changes import ChangeList, column
+
+# number of bytes read from a VCD file at once
+BLOCK_SIZE = 1 << 20
+# number of timestamps after which collected changes are stored in their change lists
+RECORD_INTERVAL = 1 << 14
+# minimal number of bytes parsed by each process, smaller files are parsed sequentially
+PARALLEL_CHUNK_SIZE = 1 << 22
+
+
+def token_blocks(f, block_size):
+    '''Yields lists of the whitespace separated tokens of consecutive blocks of the binary file f'''
+    rest = ''
+    while block := f.read(block_size):
+        block = rest + block.decode('latin-1')
+        tokens = block.split()
+        # the last token might continue in the next block
+        rest = '' if block[-1].isspace() or not tokens else tokens.pop()
+        yield tokens
+
+    if rest:
+        yield [rest]
+
+
+def tokenize(f, block_size=BLOCK_SIZE):
+    '''Returns an iterator over the whitespace separated tokens of the binary file f.
+    The file is read in blocks of block_size bytes and never held in memory at once.
+    Blocks are decoded as latin-1 such that character positions match byte offsets.'''
+    # chaining the blocks avoids resuming a generator for every token
+    return chain.from_iterable(token_blocks(f, block_size))
+
+
+def decode_name(name):
+    '''Converts a latin-1 decoded token back to its original utf-8 text'''
+    try:
+        return name.encode('latin-1').decode('utf-8')
+    except UnicodeError:
+        return name
+
+
+def decode_value(token):
+    '''Decodes the value of a vector change. 2-state vectors are returned as int,
+    reals as float and vectors containing x or z bits as their bit string.'''
+    if token[0] in 'rR':
+        return float(token[1:])
+
+    try:
+        return int(token[1:], 2)
+    except ValueError:
+        return token[1:]
+
+
+def decode_values(values):
+    '''Decodes the values collected for a vector signal, in which binary tokens are not yet decoded'''
+    try:
+        # int accepts the 0b prefix, such that 2-state vectors are decoded without a Python loop
+        return list(map(int, map(add, repeat('0'), values), repeat(2)))
+    except (TypeError, ValueError):
+        return [decode_value(value) if value.__class__ is str and value[0] == 'b' else value for value in values]
+
+
+def skip_command(tokens):
+    '''Consumes all tokens until the next $end and returns them'''
+    skipped = []
+    for token in tokens:
+        if token == '$end':
+            break
+        skipped.append(token)
+
+    return skipped
+
+
+WHITESPACE = b' \t\r\n\f\v'
+VECTOR_CHARS = b'bBrR'
+TIMESTAMP_PATTERN = re.compile(rb'\s#(\d+)(?!\S)')
+END_PATTERN = re.compile(rb'\s\$end(?!\S)')
+
+
+def change_pattern(id):
+    '''Returns a pattern that matches all scalar and vector value changes of signal id'''
+    id = re.escape(id.encode('latin-1'))
+    # only the leading whitespace is consumed such that candidates can overlap
+    return re.compile(rb'\s(?=(?:([01xzXZ])|([bBrR]\S*)\s+)' + id + rb'(?!\S))')
+
+
+def comment_regions(data, start):
+    '''Returns the byte ranges of all $comment commands after start as a flat array of begin and end offsets'''
+    regions = array('q')
+    position = data.find(b'$comment', start)
+    while position != -1:
+        end = position + len(b'$comment')
+        # only whole $comment tokens start a comment
+        if data[position - 1] in WHITESPACE and (end == len(data) or data[end] in WHITESPACE):
+            # like skip_command, an unterminated comment extends to the end of the file
+            match = END_PATTERN.search(data, end)
+            end = match.end() if match else len(data)
+            regions.extend((position, end))
+
+        position = data.find(b'$comment', end)
+
+    return regions
+
+
+def in_comment(regions, pos):
+    '''Returns true if pos lies within one of the comment regions'''
+    return bisect_right(regions, pos) % 2 == 1
+
+
+def at_value_position(data, pos, start):
+    '''Returns true if the token at pos is a value change, a timestamp or a command,
+    i.e. it is not the identifier that follows the value of a vector change.'''
+    vectors = 0
+    while True:
+        end = pos
+        while end > start and data[end - 1] in WHITESPACE:
+            end -= 1
+
+        begin = end
+        while begin > start and data[begin - 1] not in WHITESPACE:
+            begin -= 1
+
+        # vector values and identifiers alternate after the last token that is neither
+        if begin == end or data[begin] not in VECTOR_CHARS:
+            return vectors % 2 == 0
+
+        vectors += 1
+        pos = begin
+
+
+def parse_changes(tokens, changes, timestamps):
+    '''Consumes the tokens of a dump section, appends all timestamps to timestamps
+    and records all value changes in the change lists of changes'''
+    # changes before the first timestamp define the values at index 0
+    index = 0
+    SCALARS = ['x', 'z', 'X', 'Z']
+    # the changes of each signal are collected and recorded at once every RECORD_INTERVAL timestamps
+    pending = {id: [] for id in changes}
+    collect = {id: collected.append for id, collected in pending.items()}
+    # binary tokens of vectors are decoded at once when their changes are recorded
+    vectors = {id: collect[id] for id in changes if (changes[id].width or 0) > 1}
+
+    def record():
+        for id, collected in pending.items():
+            if collected:
+                indices, values = zip(*collected)
+                changes[id].record(indices, decode_values(values) if id in vectors else values)
+                collected.clear()
+
+    for token in tokens:
+        first_char = token[0]
+        if first_char == '0':
+            append = collect.get(token[1:])
+            if append is not None:
+                append((index, 0))
+        elif first_char == '1':
+            append = collect.get(token[1:])
+            if append is not None:
+                append((index, 1))
+        elif first_char == '#':
+            index = len(timestamps)
+            timestamps.append(int(token[1:]))
+            if not index % RECORD_INTERVAL:
+                record()
+        elif first_char == 'b':
+            # n-bit vector of format b0000 id
+            id = next(tokens)
+            append = vectors.get(id)
+            if append is not None:
+                append((index, token))
+            else:
+                append = collect.get(id)
+                if append is not None:
+                    append((index, decode_value(token)))
+        elif first_char == 'r':
+            append = collect.get(next(tokens))
+            if append is not None:
+                append((index, decode_value(token)))
+        elif first_char in SCALARS:
+            # scalar value change
+            append = collect.get(token[1:])
+            if append is not None:
+                append((index, first_char))
+        elif token == '$comment':
+            skip_command(tokens)
+        # all other tokens are most likely one of ['$dumpvars', '$dumpall', '$dumpoff', '$dumpon', '$end']
+        # we skip these commands and just read the following changes
+
+    record()
+    return changes
+
+
+def chunk_bounds(data, start, jobs, ids):
+    '''Splits the dump section starting at start into up to jobs chunks.
+    All chunks except the first one begin with a timestamp.'''
+    ambiguous = any(re.fullmatch(r'#\d+', id) for id in ids)
+    # a chunk must not begin with a timestamp inside of a comment
+    comments = comment_regions(data, start)
+    bounds = [start]
+    for i in range(1, jobs):
+        position = max(start + (len(data) - start) * i // jobs, bounds[-1])
+        while match := TIMESTAMP_PATTERN.search(data, position):
+            position = match.start() + 1
+            if comments and in_comment(comments, position):
+                continue
+
+            if not ambiguous or at_value_position(data, position, start):
+                break
+        else:
+            break
+
+        if position > bounds[-1]:
+            bounds.append(position)
+
+    bounds.append(len(data))
+    return bounds
+
+
+def parallel_jobs(filename, jobs):
+    '''Returns the number of processes that pay off for parsing the VCD file, at most jobs.
+    Each process gets at least PARALLEL_CHUNK_SIZE bytes and no process waits for a free CPU.'''
+    if not jobs or jobs < 2:
+        return 1
+
+    return max(1, min(jobs, os.cpu_count() or 1, os.path.getsize(filename) // PARALLEL_CHUNK_SIZE))
+
+
+def parse_chunk(filename, start, end, ids):
+    '''Decodes the changes between the byte offsets start and end of a VCD file.
+    Indices are relative to the chunk, the values of signals are None until their first change.'''
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        tokens = iter(f.read(end - start).decode('latin-1').split())
+
+    timestamps = array('q')
+    changes = {id: ChangeList(None) for id in ids}
+    parse_changes(tokens, changes, timestamps)
+    return timestamps, changes
+
 
 class TraceVcd(Trace):
     '''Holds data for one vcd trace.'''
 
     SKIPPED_COMMANDS_HEADER = set(['$comment', '$version', '$date'])
+    # parsed data that is stored in the sidecar cache
+    CACHED_FIELDS = ['timestamps', 'scopes', 'rawsignals', 'all_ids', 'name2id', 'data', 'signalinfo', 'timescale']
 
-    def __init__(self, filename, tid, container, from_string=False, keep_signals=None):
+    def __init__(self, filename, tid, container, from_string=False, keep_signals=None, cache=True, lazy=False, jobs=1, cache_mb=None):
         super().__init__(tid, filename, container)
-        self.timestamps = []
+        self.cache = ColumnCache(cache_mb * 1024 * 1024 if cache_mb else None)
+        self.timestamps = array('q')
         self.lookup = None # performs index translation after set-sampling
         self.scopes = []
         self.rawsignals = []
         self.all_ids = set()
-        self.index2ts = []
+        self.file_ids = set()
         self.name2id = {}
         self.data = {}
         self.signalinfo = {}
+        self.timescale = None
         self.filename = filename
         self.keep_signals = set(keep_signals) if keep_signals else None
+        self.lazy = lazy and not from_string
         if from_string:
-            self.parse(filename)
-        else:
+            self.parse(tokenize(io.BytesIO(filename.encode('utf-8'))))
+        elif self.lazy:
             try:
-                with open(filename) as f:
-                    self.parse(f.read())
+                self.index_file(filename)
             except FileNotFoundError:
                 print(f'Error while loading {filename}. File not found.')
                 sys.exit(1)
+        else:
+            try:
+                cached = sidecar.load(filename, self.keep_signals, 'vcd') if cache else None
+                # jobs only applies if the file is parsed, loading the sidecar cache is faster
+                if cached:
+                    self.__dict__.update(cached)
+                elif (jobs := parallel_jobs(filename, jobs)) > 1:
+                    self.parse_parallel(filename, jobs)
+                else:
+                    with open(filename, 'rb') as f:
+                        self.parse(tokenize(f))
 
+                    if cache:
+                        state = {field: getattr(self, field) for field in TraceVcd.CACHED_FIELDS}
+                        sidecar.store(filename, self.keep_signals, 'vcd', state)
+            except FileNotFoundError:
+                print(f'Error while loading {filename}. File not found.')
+                sys.exit(1)
 
-        self.all_timestamps = self.timestamps.copy()
+        self.index2ts = self.timestamps
+        self.all_timestamps = array('q', self.timestamps)
         self.index = 0
         self.max_index = len(self.index2ts) - 1
         self.signals = set(Trace.SPECIAL_SIGNALS + self.rawsignals)
@@ -42,16 +311,66 @@ class TraceVcd(Trace):
         self.rawsignals_by_handle = [self.id2name[s] for s in self.all_ids]
         self.signals_by_handle = set(self.rawsignals_by_handle)
 
-    def parse(self, vcddata):
-        scope = []
-        tokens = vcddata.split()
+    def parse(self, tokens):
+        '''Parses a VCD file from an iterator over its tokens'''
+        self.parse_header(tokens)
+        self.parse_dump(tokens)
+
+    def index_file(self, filename):
+        '''Parses only the header and builds an index from timestamps to file offsets.
+        The changes of each signal are decoded on its first access.'''
+        with open(filename, 'rb') as f:
+            self.parse_header(tokenize(f))
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # the dump section starts at the $end of $enddefinitions such that each change is preceded by whitespace
+        self.dump_offset = self.mmap.find(b'$end', self.mmap.find(b'$enddefinitions') + 1)
+        # identifiers that look like timestamps have to be told apart from real ones
+        ambiguous = any(re.fullmatch(r'#\d+', id) for id in self.file_ids)
+        # comments are skipped by the eager parser and may contain anything
+        self.comments = comment_regions(self.mmap, self.dump_offset)
+        self.ts_offsets = array('q')
+        for match in TIMESTAMP_PATTERN.finditer(self.mmap, self.dump_offset):
+            position = match.start() + 1
+            if self.comments and in_comment(self.comments, position):
+                continue
+
+            if not ambiguous or at_value_position(self.mmap, position, self.dump_offset):
+                self.ts_offsets.append(position)
+                self.timestamps.append(int(match.group(1)))
+
+    def load_signal(self, name):
+        '''Decodes the changes of signal name from the dump section of a lazily loaded trace'''
+        id = self.name2id[name]
+        # a match might be the identifier of another change if identifiers look like values
+        ambiguous = id[0] in '01xzXZbBrR#$' or any(c + id in self.file_ids for c in '01xzXZ')
+        changes = self.new_changes(id)
+        data = self.mmap
+        for match in change_pattern(id).finditer(data, self.dump_offset):
+            position = match.start() + 1
+            if self.comments and in_comment(self.comments, position):
+                continue
+
+            if ambiguous and not at_value_position(data, position, self.dump_offset):
+                continue
+
+            index = max(bisect_right(self.ts_offsets, position) - 1, 0)
+            if match.group(1):
+                value = match.group(1).decode('latin-1')
+                changes.change(index, int(value) if value in '01' else value)
+            else:
+                changes.change(index, decode_value(match.group(2).decode('latin-1')))
 
-        i = 0
-        header_done = False
-        # header section
-        while (not header_done) and tokens:
-            if tokens[i] == '$scope':
-                name = tokens[i + 2]
+        # aliases share the same changes
+        self.cache.put(id, changes)
+        return changes
+
+    def parse_header(self, tokens):
+        '''Consumes the tokens of the header section up to $enddefinitions'''
+        scope = []
+        for token in tokens:
+            if token == '$scope':
+                name = decode_name(skip_command(tokens)[1])
 
                 # array entries should not clash with WAL operators
                 name = re.sub(r'\[([0-9]+)\]', r'<\1>', name)
@@ -59,12 +378,11 @@ class TraceVcd(Trace):
 
                 scope.append(name)
                 self.scopes.append('.'.join(scope))
-                i += 4
-            elif tokens[i] == '$var':
-                kind = tokens[i + 1]
-                width = tokens[i + 2]
-                id = tokens[i + 3]
-                name = tokens[i + 4]
+            elif token == '$var':
+                # $var kind width id name [slice] $end
+                kind, width, id, name = skip_command(tokens)[:4]
+                name = decode_name(name)
+                self.file_ids.add(id)
 
                 # remove slice info from names
                 name = re.sub(r'\[[0-9]+:[0-9]+\]', '', name)
@@ -77,7 +395,7 @@ class TraceVcd(Trace):
                     fullname = '.'.join(scope) + '.' + name
                 else:
                     fullname = name
-                
+
                 if not self.keep_signals or (fullname in self.keep_signals):
                     self.all_ids.add(id)
                     self.rawsignals.append(fullname)
@@ -89,90 +407,53 @@ class TraceVcd(Trace):
                         'kind': kind,
                         'data': {}
                     }
-
-                if tokens[i + 5] == '$end':
-                    i += 6
-                elif tokens[i + 5][0] == '[':
-                    i += 7
-                else:
-                    assert False, 'VCD error'
-            elif tokens[i] == '$upscope':
+            elif token == '$upscope':
                 scope.pop()
-                i += 2
-            elif tokens[i] == '$enddefinitions':
-                i += 2
-                header_done = True
-            elif tokens[i] == '$timescale':
-                if tokens[i + 3] == '$end':
-                    self.timescale = tokens[i + 1] + tokens[i + 2]
-                    i += 4
-                elif tokens[i + 2] == '$end':
-                    self.timescale = tokens[i + 1]
-                    i += 3
-            elif tokens[i] in TraceVcd.SKIPPED_COMMANDS_HEADER:
-                while tokens[i] != '$end':
-                    i += 1
-
-                i += 1
-            else:
-                # this should not happen
-                i += 1
-
-        # parse dump section
-        time = 0
-        n_tokens = len(tokens)
-        # fill initially with all Xs
-        self.data = {id: ['x'] for id in self.all_ids}
-        SCALARS = ['x', 'z', 'X', 'Z']
-
-        while i < n_tokens:
-            first_char = tokens[i][0]
-            if first_char == '0' or first_char == '1':
-                id = tokens[i][1:]
-                if id in self.all_ids:
-                    self.data[id][-1] = 'b' + first_char
-
-                i += 1
-            elif first_char == 'b' or first_char == 'r':
-                # n-bit vector of format b0000 id
-                id = tokens[i + 1]
-                if id in self.all_ids:
-                    self.data[id][-1] = tokens[i]
-
-                i += 2
-            elif first_char == '#':
-                time = int(tokens[i][1:])
-                i += 1
-                # copy old values
-                for id in self.all_ids:
-                    self.data[id].append(self.data[id][-1])
-
-                self.timestamps.append(time)
-                self.index2ts.append(time)
-            elif first_char in SCALARS:
-                # scalar value change
-                id = tokens[i][1:]
-                if id in self.all_ids:
-                    self.data[id][-1] = tokens[i][0]
-
-                i += 1
-            elif tokens[i] == '$comment':
-                while tokens[i] != '$end':
-                    i += 1
-
-                i += 1
-            else:
-                # token is most likely one of ['$dumpvars', '$dumpall', '$dumpoff', '$dumpon', '$end']
-                # we skip these commands and just read the following changes
-                i += 1                
+                skip_command(tokens)
+            elif token == '$enddefinitions':
+                skip_command(tokens)
+                return
+            elif token == '$timescale':
+                self.timescale = ''.join(skip_command(tokens))
+            elif token in TraceVcd.SKIPPED_COMMANDS_HEADER:
+                skip_command(tokens)
 
-        # remove inital values
-        for id in self.all_ids:
-            self.data[id].pop(0)
+    def new_changes(self, id):
+        '''Returns an empty change list for the signal with id, all signals are initially x'''
+        info = self.signalinfo[id]
+        return column(info['kind'], info['width'])
 
+    def parse_dump(self, tokens):
+        '''Consumes the tokens of the dump section and stores all value changes'''
+        changes = {id: self.new_changes(id) for id in self.all_ids}
+        parse_changes(tokens, changes, self.timestamps)
         # modify data to be a lookup by signal name, removes the indirection via the id
-        data_by_name = {signal: self.data[self.name2id[signal]] for signal in self.rawsignals}
-        self.data = data_by_name
+        self.data = {signal: changes[self.name2id[signal]] for signal in self.rawsignals}
+
+    def parse_parallel(self, filename, jobs):
+        '''Parses a VCD file by decoding chunks of the dump section in jobs processes'''
+        with open(filename, 'rb') as f:
+            self.parse_header(tokenize(f))
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                dump_offset = data.find(b'$end', data.find(b'$enddefinitions') + 1)
+                bounds = chunk_bounds(data, dump_offset, jobs, self.file_ids)
+
+        # process pools are expensive to import and only needed for parallel parsing
+        from concurrent.futures import ProcessPoolExecutor # pylint: disable=C0415
+
+        ids = self.all_ids
+        changes = {id: self.new_changes(id) for id in ids}
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            chunks = pool.map(parse_chunk, repeat(filename), bounds[:-1], bounds[1:], repeat(ids))
+            for timestamps, chunk_changes in chunks:
+                # carry the values of all signals forward across the chunk boundary
+                base = len(self.timestamps)
+                for id, chunk in chunk_changes.items():
+                    changes[id].extend(chunk, base)
+
+                self.timestamps.extend(timestamps)
+
+        self.data = {signal: changes[self.name2id[signal]] for signal in self.rawsignals}
 
     def set_sampling_points(self, new_indices):
         '''Updates the indices at which data is sampled'''
@@ -183,20 +464,36 @@ class TraceVcd(Trace):
         # stores current time stamp
         self.index = 0
         self.max_index = len(self.timestamps.keys()) - 1
+        self.reads_index = None
+        self.container.invalidate()
+
+    def signal_changes(self, name):
+        '''Returns the change list of signal name'''
+        if not self.lazy:
+            return self.data[name]
+
+        changes = self.cache.get(self.name2id[name])
+        if changes is None:
+            changes = self.load_signal(name)
+
+        return changes
+
+    def change_list(self, name):
+        if self.lookup or name in self.virtual_signals or name not in self.name2id:
+            return None
+
+        return self.signal_changes(name)
+
+    def resident_changes(self, name):
+        # lazily decoded signals can be evicted from the cache
+        return None if self.lazy else self.change_list(name)
 
     def access_signal_data(self, name, index):
         if self.lookup:
-            value = self.data[name][self.lookup[index]]
-        else:
-            value = self.data[name][index]
+            return self.signal_changes(name).at(self.lookup[index])
+
+        return self.signal_changes(name).at(index)
 
-        if value[0] == 'b':
-            return int(value[1:], 2)
-        elif value[0] == 'r':
-            return float(value[1:])
-        else:
-            return value
-    
     def signal_width(self, name):
         '''Returns the width of a signal'''
         return self.signalinfo[self.name2id[name]]['width']
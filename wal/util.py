@@ -1,7 +1,7 @@
 ''' Utility functions for WAL'''
 # pylint: disable=R0912
 
-import pickle
+import os
 from wal.ast_defs import Symbol, Operator, Closure, Macro, Unquote, UnquoteSplice, WList
 
 
@@ -51,8 +51,20 @@ def wal_str(sexpr):
 
 def wal_decode(filename):
     '''Decodes a compiled WAL file and returns its WAL expressions'''
-    with open(filename, 'br') as fin:
-        return pickle.load(fin)
+    from wal.wo import decode # pylint: disable=C0415
+    return decode(filename).sexprs
+
+
+def cache_dir(name):
+    '''Returns the directory in which cached data of kind name is stored.
+    The base directory is ~/.cache/wal and can be changed with WAL_CACHE_DIR.'''
+    base = os.getenv('WAL_CACHE_DIR')
+    if not base:
+        base = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'wal')
+
+    path = os.path.join(base, name)
+    os.makedirs(path, exist_ok=True)
+    return path
 
 
 class Colors:
@@ -0,0 +1,413 @@
+'''Vectorized evaluation of side effect free conditions over whole signal columns'''
+from functools import reduce
+from operator import and_, or_, xor
+
+try:
+    import numpy as np
+except (ModuleNotFoundError, ImportError):
+    np = None
+
+from wal.ast_defs import Operator, Symbol, WList
+from wal.passes import signal_dependencies
+from wal.trace.changes import BitChangeList, VectorChangeList, RealChangeList, PackedChangeList
+
+# integers must fit into int64 and must be converted to float exactly when mixed with floats
+INT_BITS = 62
+FLOAT_BITS = 53
+
+
+def column(changes):
+    '''Returns the change indices, values and undefined flags of a change list as arrays,
+    together with the kind and the maximum bit length of its values.
+    Values that are not plain numbers, such as x or z, are flagged as undefined.
+    Returns None if the values can not be represented as a single array.'''
+    indices = np.array(changes.indices, dtype=np.int64)
+    if isinstance(changes, BitChangeList):
+        packed = np.frombuffer(bytes(changes.values), dtype=np.uint8)
+        codes = ((packed[:, None] >> np.array([0, 2, 4, 6], dtype=np.uint8)) & 3).reshape(-1)[:len(changes)]
+        return indices, (codes & 1).astype(np.int64), codes > 1, int, 1
+
+    if isinstance(changes, VectorChangeList):
+        if changes.width > INT_BITS:
+            return None
+        return indices, np.array(changes.values, dtype=np.int64), np.array(changes.masks) != 0, int, changes.width
+
+    if isinstance(changes, RealChangeList):
+        values = np.array(changes.values, dtype=np.float64)
+        return indices, values, np.isnan(values), float, 0
+
+    if isinstance(changes, PackedChangeList):
+        return None
+
+    # plain change lists can hold any value
+    defined = [isinstance(value, float) and value == value # pylint: disable=R0124
+               or isinstance(value, int) and abs(value).bit_length() <= INT_BITS
+               for value in changes.values]
+    kinds = {float if isinstance(value, float) else int for value, ok in zip(changes.values, defined) if ok}
+    if len(kinds) > 1:
+        return None
+
+    kind = kinds.pop() if kinds else int
+    bits = max((abs(int(value)).bit_length() for value, ok in zip(changes.values, defined) if ok and kind is int), default=0)
+    values = np.array([value if ok else 0 for value, ok in zip(changes.values, defined)], dtype=np.float64 if kind is float else np.int64)
+    return indices, values, ~np.array(defined, dtype=bool), kind, bits
+
+
+def either(a, b):
+    '''Combines two undefined flag arrays, None means that all values are defined'''
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a | b
+
+
+def exact(nodes):
+    '''Checks that the values of nodes can be combined without leaving int64 or losing precision'''
+    limit = FLOAT_BITS if any(kind is float for _, kind, _ in nodes) else INT_BITS
+    return all(kind is float or bits <= limit for _, kind, bits in nodes)
+
+
+def compile_condition(seval, trace, expr):
+    '''Compiles expr into a function that evaluates it at an array of indices of trace.
+    The function returns the values of expr and flags for the indices at which expr
+    has to be evaluated by the interpreter. Returns None if expr can not be vectorized.'''
+    columns = {}
+    end = trace.max_index
+
+    def compile_signal(name, offset):
+        if name not in columns:
+            changes = trace.change_list(name)
+            columns[name] = None if changes is None else column(changes)
+
+        if columns[name] is None:
+            return None
+
+        indices, values, undefined, kind, bits = columns[name]
+
+        def evaluate(points):
+            positions = np.searchsorted(indices, points + offset, side='right') - 1
+            return values[positions], undefined[positions]
+
+        return evaluate, kind, bits
+
+    def compile_constant(value):
+        kind = float if isinstance(value, float) else int
+        bits = 0 if kind is float else abs(int(value)).bit_length()
+        if bits > INT_BITS:
+            return None
+
+        dtype = np.float64 if kind is float else np.int64
+        return (lambda points: (np.full(len(points), value, dtype=dtype), None)), kind, bits
+
+    def compile_rel_eval(args, offset):
+        if len(args) != 2 or not isinstance(args[1], int) or isinstance(args[1], bool):
+            return None
+
+        shift = offset + args[1]
+        node = compile_expr(args[0], shift)
+        if node is None:
+            return None
+
+        inner = node[0]
+
+        def evaluate(points):
+            # reval evaluates to false when its offset leaves the trace
+            inside = (points + shift >= 0) & (points + shift <= end)
+            values, undefined = inner(points)
+            return np.where(inside, values, 0).astype(values.dtype), None if undefined is None else undefined & inside
+
+        return evaluate, node[1], node[2]
+
+    def compile_edge(head, args, offset):
+        if len(args) != 1:
+            return None
+
+        step = -1 if head == Operator.CHANGED else 1
+        nodes = [compile_expr(args[0], offset), compile_expr(args[0], offset + step)]
+        if any(node is None for node in nodes) or not exact(nodes):
+            return None
+
+        def evaluate(points):
+            (value, adjacent), undefined = evaluate_all(nodes, points)
+            inside = (points + offset + step >= 0) & (points + offset + step <= end)
+            if head == Operator.CHANGED:
+                # changes need a value at the previous index
+                edges = (value != adjacent) & inside
+                return edges.astype(np.int64), None if undefined is None else undefined & inside
+
+            # like reval, the value after the last index is false
+            adjacent = np.where(inside, adjacent, 0)
+            if head == Operator.RISING:
+                edges = (value == 0) & (adjacent == 1)
+            else:
+                edges = (value == 1) & (adjacent == 0)
+            return edges.astype(np.int64), undefined
+
+        return evaluate, int, 1
+
+    def compile_slice(args, offset):
+        if not 2 <= len(args) <= 3 or not all(isinstance(arg, int) and not isinstance(arg, bool) for arg in args[1:]):
+            return None
+
+        upper, lower = args[1], args[-1]
+        if not 0 <= lower <= upper <= INT_BITS:
+            return None
+
+        node = compile_expr(args[0], offset)
+        if node is None or node[1] is not int:
+            return None
+
+        inner = node[0]
+        selected = (1 << (upper - lower + 1)) - 1
+
+        def evaluate(points):
+            values, undefined = inner(points)
+            return (values >> lower) & selected, undefined
+
+        return evaluate, int, upper - lower + 1
+
+    def compile_expr(expr, offset):
+        if isinstance(expr, Symbol):
+            if expr.steps is not None:
+                return None
+            return compile_signal(seval.aliases.get(expr.name, expr.name), offset)
+
+        if isinstance(expr, (int, float)):
+            return compile_constant(expr)
+
+        if not isinstance(expr, (WList, list)) or not expr or not isinstance(expr[0], Operator):
+            return None
+
+        head, args = expr[0], expr[1:]
+        if head == Operator.REL_EVAL:
+            return compile_rel_eval(args, offset)
+
+        if head == Operator.SLICE:
+            return compile_slice(args, offset)
+
+        if head in (Operator.RISING, Operator.FALLING, Operator.CHANGED):
+            return compile_edge(head, args, offset)
+
+        if head not in OPERATORS or not args:
+            return None
+
+        nodes = [compile_expr(arg, offset) for arg in args]
+        if any(node is None for node in nodes):
+            return None
+
+        return OPERATORS[head](nodes)
+
+    node = compile_expr(expr, 0)
+    return None if node is None else node[0]
+
+
+def evaluate_all(nodes, points):
+    '''Evaluates all nodes and combines their undefined flags'''
+    results = [node[0](points) for node in nodes]
+    return [values for values, _ in results], reduce(either, (undefined for _, undefined in results))
+
+
+def arithmetic(function, bits):
+    '''Returns the compiler of an arithmetic operator, bits calculates the bit length of its result'''
+    def compile_arithmetic(nodes):
+        kind = float if any(node[1] is float for node in nodes) else int
+        result_bits = bits([node[2] for node in nodes])
+        if not exact(nodes) or (kind is int and result_bits > INT_BITS):
+            return None
+
+        def evaluate(points):
+            values, undefined = evaluate_all(nodes, points)
+            return function(values), undefined
+
+        return evaluate, kind, result_bits
+
+    return compile_arithmetic
+
+
+def bitwise(function):
+    '''Returns the compiler of a bitwise operator'''
+    def compile_bitwise(nodes):
+        if any(node[1] is not int for node in nodes):
+            return None
+
+        def evaluate(points):
+            values, undefined = evaluate_all(nodes, points)
+            return reduce(function, values), undefined
+
+        return evaluate, int, max(node[2] for node in nodes)
+
+    return compile_bitwise
+
+
+def comparison(function, arity=None):
+    '''Returns the compiler of an operator that compares the values of its arguments'''
+    def compile_comparison(nodes):
+        if (arity and len(nodes) != arity) or len(nodes) < 2 or not exact(nodes):
+            return None
+
+        def evaluate(points):
+            values, undefined = evaluate_all(nodes, points)
+            return function(values).astype(np.int64), undefined
+
+        return evaluate, int, 1
+
+    return compile_comparison
+
+
+def compile_sub(nodes):
+    if len(nodes) == 1:
+        return arithmetic(lambda values: -values[0], lambda bits: bits[0])(nodes)
+    return arithmetic(lambda values: reduce(np.subtract, values), lambda bits: max(bits) + len(bits).bit_length())(nodes)
+
+
+def compile_div(nodes):
+    if len(nodes) != 2 or not all(node[1] is float or node[2] <= FLOAT_BITS for node in nodes):
+        return None
+
+    def evaluate(points):
+        (dividend, divisor), undefined = evaluate_all(nodes, points)
+        # the interpreter reports divisions by zero
+        zero = divisor == 0
+        return dividend / np.where(zero, 1, divisor), either(undefined, zero)
+
+    return evaluate, float, 0
+
+
+def compile_not(nodes):
+    if any(node[1] is not int for node in nodes):
+        return None
+
+    def evaluate(points):
+        values, undefined = evaluate_all(nodes, points)
+        return (~reduce(np.logical_or, [value != 0 for value in values])).astype(np.int64), undefined
+
+    return evaluate, int, 1
+
+
+def compile_and(nodes):
+    def evaluate(points):
+        # like the interpreter, arguments are only needed where all arguments before them are true
+        active = np.ones(len(points), dtype=bool)
+        undefined = np.zeros(len(points), dtype=bool)
+        for node in nodes:
+            values, unknown = node[0](points)
+            if unknown is not None:
+                undefined |= active & unknown
+                active &= ~unknown
+            active &= values != 0
+        return active.astype(np.int64), undefined
+
+    return evaluate, int, 1
+
+
+def compile_or(nodes):
+    def evaluate(points):
+        # like the interpreter, arguments are only needed where all arguments before them are false
+        active = np.ones(len(points), dtype=bool)
+        found = np.zeros(len(points), dtype=bool)
+        undefined = np.zeros(len(points), dtype=bool)
+        for node in nodes:
+            values, unknown = node[0](points)
+            if unknown is not None:
+                undefined |= active & unknown
+                active &= ~unknown
+            found |= active & (values != 0)
+            active &= values == 0
+        return found.astype(np.int64), undefined
+
+    return evaluate, int, 1
+
+
+def compile_if(nodes):
+    if len(nodes) != 3 or nodes[1][1] is not nodes[2][1]:
+        return None
+
+    def evaluate(points):
+        (condition, unknown), (then, then_unknown), (otherwise, otherwise_unknown) = [node[0](points) for node in nodes]
+        taken = condition != 0
+        undefined = reduce(either, [unknown,
+                                    None if then_unknown is None else taken & then_unknown,
+                                    None if otherwise_unknown is None else ~taken & otherwise_unknown])
+        return np.where(taken, then, otherwise), undefined
+
+    return evaluate, nodes[1][1], max(nodes[1][2], nodes[2][2])
+
+
+def all_equal(values):
+    return reduce(np.logical_and, [value == values[0] for value in values[1:]])
+
+
+OPERATORS = {
+    Operator.ADD: arithmetic(lambda values: reduce(np.add, values), lambda bits: max(bits) + (len(bits) - 1).bit_length()),
+    Operator.SUB: compile_sub,
+    Operator.MUL: lambda nodes: arithmetic(lambda values: reduce(np.multiply, values), sum)(nodes) if len(nodes) > 1 else None,
+    Operator.DIV: compile_div,
+    Operator.BOR: bitwise(or_),
+    Operator.BAND: bitwise(and_),
+    Operator.BXOR: bitwise(xor),
+    Operator.EQ: comparison(all_equal),
+    Operator.NEQ: comparison(lambda values: ~all_equal(values)),
+    Operator.LARGER: comparison(lambda values: values[0] > values[1], 2),
+    Operator.SMALLER: comparison(lambda values: values[0] < values[1], 2),
+    Operator.LARGER_EQUAL: comparison(lambda values: values[0] >= values[1], 2),
+    Operator.SMALLER_EQUAL: comparison(lambda values: values[0] <= values[1], 2),
+    Operator.NOT: compile_not,
+    Operator.AND: compile_and,
+    Operator.OR: compile_or,
+    Operator.IF: compile_if,
+}
+
+
+def vector_ranges(seval, trace, condition, ranges):
+    '''Returns the parts of ranges in which condition is true by evaluating the condition
+    at all change points at once. Points at which a signal is x or z are evaluated by the
+    interpreter. Returns None if NumPy is not available or if condition can not be vectorized.'''
+    if np is None or not ranges:
+        return None
+
+    evaluate = compile_condition(seval, trace, condition)
+    if evaluate is None:
+        return None
+
+    signals, offsets, _ = signal_dependencies(seval, condition)
+    starts = np.array([low for low, _ in ranges], dtype=np.int64)
+    ends = np.array([high for _, high in ranges], dtype=np.int64)
+    low, high = ranges[0][0], ranges[-1][1]
+
+    # mark all indices at which the value of condition can change
+    marks = np.zeros(high - low + 1, dtype=bool)
+    marks[starts - low] = True
+    marks[ends - low] = True
+    for offset in offsets:
+        for point in (-offset, trace.max_index - offset + 1):
+            if low <= point < high:
+                marks[point - low] = True
+
+    for name, offset in signals:
+        shifted = np.array(trace.change_points(name), dtype=np.int64) - offset
+        marks[shifted[(shifted >= low) & (shifted < high)] - low] = True
+
+    points = np.flatnonzero(marks[:-1]) + low
+    which = np.searchsorted(starts, points, side='right') - 1
+    inside = points < ends[which]
+    points = points[inside]
+    next_points = np.minimum(np.append(points[1:], high), ends[which[inside]])
+
+    with np.errstate(all='ignore'):
+        values, undefined = evaluate(points)
+
+    truth = values != 0
+    if undefined is not None:
+        for position in np.flatnonzero(undefined).tolist():
+            trace.index = int(points[position])
+            truth[position] = bool(seval.eval(condition))
+
+    # merge adjacent true parts
+    firsts = points[truth]
+    lasts = next_points[truth]
+    if not len(firsts):
+        return []
+
+    separate = firsts[1:] != lasts[:-1]
+    return list(zip(firsts[np.append(True, separate)].tolist(), lasts[np.append(separate, True)].tolist()))
@@ -7,9 +7,8 @@ import sys
 
 from wal.core import Wal
 from wal.repl import WalRepl
-from wal.util import wal_decode
-from wal.reader import read_wal_sexprs, ParseError
-from wal.passes import expand, optimize, resolve
+from wal.reader import ParseError
+from wal.wo import eval_wal_file, eval_wo_file
 from wal.version import __version__ as wal_version
 from wal.ast_defs import WalEvalError
 
@@ -22,11 +21,15 @@ class Arguments:  # pylint: disable=too-few-public-methods
         self.parser = parser
 
         parser.add_argument('-l', '--load', nargs='*', help='paths to waveforms to load')
+        parser.add_argument('-j', '--jobs', type=int, default=1, help='maximal number of processes used to parse large waveforms')
         parser.add_argument('-c', nargs='?', help='WAL expression to execute')
         parser.add_argument('program_path', nargs='?', help='path to wal/wo file')
         parser.add_argument('-v', '--version', action='version',
                             version=f'%(prog)s {wal_version}')
         parser.add_argument('--repl-on-failure', action='store_true', help='open REPL when a failure occurs')
+        parser.add_argument('--profile', action='store_true', help='print the time spent in operators, functions and lines')
+        parser.add_argument('--profile-stacks', metavar='FILE',
+                            help='write the profiled call stacks in the collapsed format of flame graph tools to FILE')
         parser.add_argument('ARGS', nargs='*',
                             default=None, help='runtime arguments')
 
@@ -58,8 +61,26 @@ def main():  # pylint: disable=R1710
 
     if args.load is not None:
         for i, path in enumerate(args.load):
-            wal.load(path, f't{i}')
+            wal.load(path, f't{i}', jobs=args.jobs)
 
+    if not (args.profile or args.profile_stacks):
+        return evaluate(wal, args)
+
+    with wal.profile() as profile:
+        status = evaluate(wal, args)
+
+    if args.profile:
+        profile.print(file=sys.stderr)
+
+    if args.profile_stacks:
+        with open(args.profile_stacks, 'w', encoding='utf-8') as f:
+            f.write(profile.collapsed() + '\n')
+
+    return status
+
+
+def evaluate(wal, args):
+    '''Evaluates the expression or program passed in args'''
     if args.c:
         try:
             wal.eval_str(args.c)
@@ -77,26 +98,15 @@ def main():  # pylint: disable=R1710
 
         filename = args.program_path
 
-        if filename[-3:] == '.wo':
-            sexprs = wal_decode(filename)
-        else:
-            with open(filename, 'r', encoding='utf8') as file:
-                try:
-                    sexprs = read_wal_sexprs(file.read(), filename)
-                except ParseError as e:
-                    e.show()
-                    sys.exit(os.EX_DATAERR)
-
         try:
-            for sexpr in sexprs:
-                try:
-                    expanded = expand(wal.eval_context, sexpr, parent=wal.eval_context.global_environment)
-                    optimized = optimize(expanded)
-                    resolved = resolve(optimized, start=wal.eval_context.global_environment.environment)
-                except AssertionError as error:
-                    wal.print_error(sexpr, error)
-
-                wal.eval(resolved)
+            if filename[-3:] == '.wo':
+                eval_wo_file(wal.eval_context, filename)
+            else:
+                # compiled files are cached and reused while the program is unchanged
+                eval_wal_file(wal.eval_context, filename)
+        except ParseError as e:
+            e.show()
+            sys.exit(os.EX_DATAERR)
         except WalEvalError as error:
             error.print()
             if args.repl_on_failure:
@@ -1,11 +1,11 @@
 '''wal command line compiler'''
 import argparse
-import pickle
 from pathlib import Path
 from wal.version import __version__
 
 from wal.reader import read_wal_sexprs
 from wal.passes import expand, optimize
+from wal.wo import WalObject, encode, source_hash
 
 
 class Arguments:  # pylint: disable=too-few-public-methods
@@ -46,8 +46,8 @@ def wal_compile(inname, outname, wal):
         else:
             name = Path(inname).with_suffix('.wo')
 
-        with open(name, 'wb') as fout:
-            pickle.dump(compiled, fout)
+        # the expressions are resolved when they are loaded, since resolving depends on the loading context
+        encode(name, WalObject(compiled, source_hash(code)))
 
 
 def run():  # pylint: disable=R1710
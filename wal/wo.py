@@ -0,0 +1,186 @@
+'''Versioned WAL object files (.wo) and the cache of compiled WAL files'''
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+
+from wal.ast_defs import Symbol, Operator, Macro, Unquote, UnquoteSplice, WList, WalEvalError
+from wal.reader import read_wal_sexprs
+from wal.passes import expand, optimize, resolve
+from wal.util import cache_dir, wal_str
+from wal.version import __version__
+
+MAGIC = b'WALOBJ\0\0'
+FORMAT_VERSION = 1
+# magic, format version, WAL version, sha256 of the source, sha256 of the
+# environment the file was compiled in, gensym counter after loading, resolved flag
+HEADER = struct.Struct('<8sI16s32s32sq?')
+
+
+class WalObject:
+    '''Contents of a .wo file'''
+
+    def __init__(self, sexprs, source=b'', environment=b'', gensyms=0, resolved=False, version=__version__):
+        self.sexprs = sexprs
+        # sha256 of the source code the expressions were compiled from
+        self.source = source
+        # fingerprint of the environment in which the expressions were resolved
+        self.environment = environment
+        self.gensyms = gensyms
+        # resolved expressions can be evaluated directly, others must be expanded and resolved first
+        self.resolved = resolved
+        self.version = version
+
+
+def source_hash(code):
+    '''Returns the digest of the source code code'''
+    return hashlib.sha256(code.encode('utf-8') if isinstance(code, str) else code).digest()
+
+
+def environment_hash(seval):
+    '''Returns a fingerprint of everything that influences how expand and resolve
+    translate a file in seval: the global names, the macros and the gensym counter'''
+    digest = hashlib.sha256(str(seval.gensymi).encode('utf-8'))
+    for name, value in sorted(seval.global_environment.environment.items(), key=lambda item: item[0]):
+        digest.update(name.encode('utf-8') + b'\0')
+        if isinstance(value, Macro):
+            digest.update(wal_str(value.args).encode('utf-8') + b'\0' + wal_str(value.expression).encode('utf-8'))
+
+    return digest.digest()
+
+
+def encode(filename, wal_object):
+    '''Writes wal_object to filename'''
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, wal_object.version.encode('utf-8'),
+                         wal_object.source, wal_object.environment, wal_object.gensyms, wal_object.resolved)
+    # write to a temporary file first such that readers never see partial files
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            pickle.dump(wal_object.sexprs, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def decode(filename):
+    '''Reads the .wo file filename.
+    Files written by older versions of walc only contain the pickled expressions.'''
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    if not data.startswith(MAGIC):
+        return WalObject(pickle.loads(data), version=None)
+
+    _, fmt, version, source, environment, gensyms, resolved = HEADER.unpack_from(data)
+    if fmt != FORMAT_VERSION:
+        raise ValueError(f'{filename} has unsupported format version {fmt}')
+
+    version = version.rstrip(b'\0').decode('utf-8')
+    return WalObject(pickle.loads(data[HEADER.size:]), source, environment, gensyms, resolved, version)
+
+
+def portable(expr):
+    '''Checks if expr only consists of values that can be stored independently of a WAL context'''
+    if isinstance(expr, (WList, list)):
+        return all(portable(sub) for sub in expr)
+
+    if isinstance(expr, (Unquote, UnquoteSplice)):
+        return portable(expr.content)
+
+    return expr is None or isinstance(expr, (Symbol, Operator, int, float, str))
+
+
+def cache_path(filename, environment):
+    '''Returns the path of the cached compilation of filename in an environment'''
+    key = hashlib.sha1(os.path.abspath(filename).encode('utf-8') + b'\0' + environment)
+    return os.path.join(cache_dir('wo'), key.hexdigest() + '.wo')
+
+
+def compile_wal(seval, sexprs):
+    '''Expands, optimizes, resolves and evaluates sexprs one after the other
+    and returns the resolved expressions'''
+    compiled = []
+    for sexpr in sexprs:
+        try:
+            expanded = expand(seval, sexpr, parent=seval.global_environment)
+            optimized = optimize(expanded)
+            resolved = resolve(optimized, start=seval.global_environment.environment)
+        except AssertionError as error:
+            seval.print_error(sexpr, error)
+            raise WalEvalError() # pylint: disable=W0707
+
+        compiled.append(resolved)
+        seval.eval(resolved)
+
+    return compiled
+
+
+def eval_wal_file(seval, filename):
+    '''Evaluates the WAL file filename in seval.
+    The resolved expressions are cached and reused as long as the source,
+    the WAL version and the environment in which the file is loaded are the same.'''
+    with open(filename, 'rb') as f:
+        source = f.read()
+
+    digest = source_hash(source)
+    environment = environment_hash(seval)
+    try:
+        path = cache_path(filename, environment)
+    except OSError:
+        path = None
+
+    try:
+        cached = decode(path) if path else None
+    except (OSError, ValueError, struct.error, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        cached = None
+
+    if cached and cached.resolved and cached.version == __version__ \
+       and cached.source == digest and cached.environment == environment:
+        for sexpr in cached.sexprs:
+            seval.eval(sexpr)
+
+        seval.gensymi = max(seval.gensymi, cached.gensyms)
+        return
+
+    compiled = compile_wal(seval, read_wal_sexprs(source.decode('utf-8'), filename))
+    # expressions containing closures or other runtime values created by macros can not be stored
+    if path and all(portable(sexpr) for sexpr in compiled):
+        try:
+            encode(path, WalObject(compiled, digest, environment, seval.gensymi, resolved=True))
+        except (OSError, pickle.PicklingError, RecursionError):
+            pass
+
+
+def eval_wo_file(seval, filename):
+    '''Evaluates the .wo file filename in seval'''
+    wal_object = decode(filename)
+    if wal_object.resolved and wal_object.environment == environment_hash(seval):
+        for sexpr in wal_object.sexprs:
+            seval.eval(sexpr)
+    else:
+        compile_wal(seval, wal_object.sexprs)
+
+
+def stale(filename):
+    '''Checks if the .wo file filename was compiled from a different
+    version of the .wal file next to it'''
+    source = os.path.splitext(filename)[0] + '.wal'
+    if not os.path.isfile(source):
+        return False
+
+    try:
+        wal_object = decode(filename)
+    except (OSError, ValueError, struct.error, pickle.UnpicklingError, EOFError):
+        return True
+
+    if wal_object.version is None:
+        # files of older versions of walc do not record their source
+        return False
+
+    with open(source, 'rb') as f:
+        return wal_object.version != __version__ or wal_object.source != source_hash(f.read())
@@ -1,5 +1,6 @@
 '''Parsers for WAWK'''
 # pylint: disable=C0103,C0116
+import functools
 from lark import Lark, Transformer
 from wawk.ast_defs import Statement
 from wal.ast_defs import Symbol as S
@@ -196,12 +197,15 @@ class TreeToWal(Transformer):
 
         return [Op(x[1].children[0].value), x[0], x[2]]
 
+@functools.cache
+def wawk_parser(start='program'):
+    # the grammar needs the Earley parser which Lark can not cache on disk
+    return Lark(WAWK_GRAMMAR, start=start)
+
 def parse_wawk(code):
-    json_parser = Lark(WAWK_GRAMMAR, start='program')
-    parsed = json_parser.parse(code)
+    parsed = wawk_parser().parse(code)
     return TreeToWal().transform(parsed)
 
 def test():
-    json_parser = Lark(WAWK_GRAMMAR, start='expr')
-    parsed = json_parser.parse('group (groups("ready", "valid")) {x}')
+    parsed = wawk_parser('expr').parse('group (groups("ready", "valid")) {x}')
     print(TreeToWal().transform(parsed))